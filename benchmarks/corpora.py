@@ -0,0 +1,255 @@
+"""Synthetic from and to image pairs for benchmarks.
+
+Each corpus is written in chunks from random generators seeded by the
+corpus seed and chunk index, so that any size, up to many GB, is
+generated with bounded memory and always identically.
+
+random         Unrelated random from and to data, the worst case.
+elf            Executable like code with relocations, where a few
+               functions are inserted and every address after them
+               changes.
+compressible   Text like data with replaced words and inserted lines.
+sparse         Mostly holes with data islands, of which some are
+               modified, added or removed.
+small-edit     Random data with a few small modifications.
+shifted-block  Random 64 KiB blocks of which some are moved, and a few
+               new blocks inserted.
+
+"""
+
+import os
+import random
+import struct
+
+
+CHUNK_SIZE = 1024 * 1024
+
+BLOCK_SIZE = 64 * 1024
+
+ISLAND_SIZE = 64 * 1024
+
+WORDS = [
+    'the', 'data', 'patch', 'update', 'firmware', 'device', 'version',
+    'error', 'value', 'config', 'network', 'memory', 'image', 'block',
+    'address', 'size', 'offset', 'status', 'request', 'response', 'timeout',
+    'buffer', 'segment', 'kernel', 'driver', 'sensor', 'message', 'header'
+]
+
+
+def chunk_rng(seed, name, index):
+    return random.Random('{}-{}-{}'.format(seed, name, index))
+
+
+def write_random(ffrom, fto, size, seed):
+    for index, offset in enumerate(range(0, size, CHUNK_SIZE)):
+        chunk_size = min(CHUNK_SIZE, size - offset)
+        ffrom.write(chunk_rng(seed, 'from', index).randbytes(chunk_size))
+        fto.write(chunk_rng(seed, 'to', index).randbytes(chunk_size))
+
+
+def write_small_edit(ffrom, fto, size, seed):
+    rng = random.Random(seed)
+    edits = sorted([rng.randrange(size) for _ in range(16)])
+
+    for index, offset in enumerate(range(0, size, CHUNK_SIZE)):
+        chunk = bytearray(chunk_rng(seed, 'from', index).randbytes(
+            min(CHUNK_SIZE, size - offset)))
+        ffrom.write(chunk)
+
+        for edit in edits:
+            if offset <= edit < offset + len(chunk):
+                edit -= offset
+                length = min(rng.randrange(1, 64), len(chunk) - edit)
+                chunk[edit:edit + length] = rng.randbytes(length)
+
+        fto.write(chunk)
+
+
+def text_chunk(rng, size):
+    words = rng.choices(WORDS, k=size // 4)
+    text = ' '.join(words).encode('ascii')
+
+    return text[:size].ljust(size, b'\n')
+
+
+def write_compressible(ffrom, fto, size, seed):
+    for index, offset in enumerate(range(0, size, CHUNK_SIZE)):
+        rng = chunk_rng(seed, 'from', index)
+        chunk = text_chunk(rng, min(CHUNK_SIZE, size - offset))
+        ffrom.write(chunk)
+        words = chunk.split(b' ')
+
+        for _ in range(len(words) // 100):
+            words[rng.randrange(len(words))] = rng.choice(WORDS).encode()
+
+        if rng.random() < 0.5:
+            position = rng.randrange(len(words))
+            words.insert(position, text_chunk(rng, 200))
+
+        fto.write(b' '.join(words))
+
+
+class ElfLayout(object):
+    """Functions chosen from a pool of bodies, each with a relocation
+    slot every 64 bytes holding the address of another function.
+
+    """
+
+    def __init__(self, bodies, functions):
+        self.bodies = bodies
+        self.functions = functions
+        self.addresses = []
+        address = 0x10000
+
+        for body in functions:
+            self.addresses.append(address)
+            address += len(bodies[body])
+
+    def write(self, fout, seed):
+        fout.write(b'\x7fELF\x02\x01\x01'.ljust(64, b'\x00'))
+        number_of_functions = len(self.functions)
+
+        for index, body in enumerate(self.functions):
+            function = bytearray(self.bodies[body])
+
+            for slot, offset in enumerate(range(16, len(function) - 4, 64)):
+                target = ((index * 2654435761 + slot * 40503 + seed)
+                          % number_of_functions)
+                struct.pack_into('<I',
+                                 function,
+                                 offset,
+                                 self.addresses[target] & 0xffffffff)
+
+            fout.write(function)
+
+
+def write_elf(ffrom, fto, size, seed):
+    rng = random.Random(seed)
+    opcodes = list(range(32))
+    weights = [1 / (1 + opcode) for opcode in opcodes]
+    bodies = [
+        bytes(rng.choices(opcodes, weights, k=rng.randrange(64, 2048)))
+        for _ in range(256)
+    ]
+    functions = []
+    function_size = 64
+
+    while function_size < size:
+        functions.append(rng.randrange(len(bodies)))
+        function_size += len(bodies[functions[-1]])
+
+    if len(functions) > 1:
+        function_size -= len(bodies[functions.pop()])
+
+    # A few new functions at 40 %, and one modified function at 70 %.
+    new_bodies = bodies + [rng.randbytes(rng.randrange(64, 2048))
+                           for _ in range(3)]
+    to_functions = list(functions)
+    position = 4 * len(functions) // 10
+    to_functions[position:position] = [256, 257, 258]
+    position = 7 * len(to_functions) // 10
+
+    if position < len(to_functions):
+        to_functions[position] = 258
+
+    ElfLayout(bodies, functions).write(ffrom, seed)
+    ElfLayout(new_bodies, to_functions).write(fto, seed)
+
+    # Padding so that the from image is exactly `size` bytes.
+    ffrom.write(text_chunk(rng, size - ffrom.tell()))
+    fto.write(text_chunk(rng, max(size - fto.tell(), 0)))
+
+
+def write_sparse(ffrom, fto, size, seed):
+    ffrom.truncate(size)
+    fto.truncate(size)
+
+    for index, offset in enumerate(range(0, size, CHUNK_SIZE)):
+        rng = chunk_rng(seed, 'from', index)
+        island_size = min(ISLAND_SIZE, size - offset)
+        probability = rng.random()
+
+        if probability < 0.1:
+            island = bytearray(rng.randbytes(island_size))
+            ffrom.seek(offset)
+            ffrom.write(island)
+
+            # Modified, removed or unchanged.
+            if probability < 0.05:
+                for _ in range(8):
+                    island[rng.randrange(island_size)] = rng.getrandbits(8)
+            elif probability < 0.06:
+                continue
+
+            fto.seek(offset)
+            fto.write(island)
+        elif probability < 0.11:
+            fto.seek(offset)
+            fto.write(rng.randbytes(island_size))
+
+
+def block_data(seed, index, size=BLOCK_SIZE):
+    return chunk_rng(seed, 'block', index).randbytes(size)
+
+
+def write_shifted_block(ffrom, fto, size, seed):
+    rng = random.Random(seed)
+    number_of_blocks = max(size // BLOCK_SIZE, 1)
+    last_size = size - (number_of_blocks - 1) * BLOCK_SIZE
+    blocks = list(range(number_of_blocks))
+
+    for index in blocks:
+        if index == number_of_blocks - 1:
+            ffrom.write(block_data(seed, index, last_size))
+        else:
+            ffrom.write(block_data(seed, index))
+
+    # Move about 5 % of the blocks, and insert a few new blocks.
+    for _ in range(max(number_of_blocks // 20, 1)):
+        block = blocks.pop(rng.randrange(len(blocks)))
+        blocks.insert(rng.randrange(len(blocks) + 1), block)
+
+    for index in range(max(number_of_blocks // 100, 1)):
+        blocks.insert(rng.randrange(len(blocks) + 1), number_of_blocks + index)
+
+    for index in blocks:
+        if index == number_of_blocks - 1:
+            fto.write(block_data(seed, index, last_size))
+        else:
+            fto.write(block_data(seed, index))
+
+
+CORPORA = {
+    'random': write_random,
+    'elf': write_elf,
+    'compressible': write_compressible,
+    'sparse': write_sparse,
+    'small-edit': write_small_edit,
+    'shifted-block': write_shifted_block
+}
+
+
+def create_corpus(directory, name, size, seed=0):
+    """Write the from and to images of given corpus to `directory`, unless
+    already written, and return their filenames.
+
+    """
+
+    from_filename = os.path.join(directory,
+                                 '{}-{}-{}.from'.format(name, size, seed))
+    to_filename = os.path.join(directory,
+                               '{}-{}-{}.to'.format(name, size, seed))
+
+    if not (os.path.exists(from_filename) and os.path.exists(to_filename)):
+        os.makedirs(directory, exist_ok=True)
+        tmp_from_filename = from_filename + '.tmp'
+        tmp_to_filename = to_filename + '.tmp'
+
+        with open(tmp_from_filename, 'wb') as ffrom:
+            with open(tmp_to_filename, 'wb') as fto:
+                CORPORA[name](ffrom, fto, size, seed)
+
+        os.replace(tmp_from_filename, from_filename)
+        os.replace(tmp_to_filename, to_filename)
+
+    return from_filename, to_filename
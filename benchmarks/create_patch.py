@@ -0,0 +1,149 @@
+"""Compare the patch creation time, peak memory and patch size of the
+diff algorithms.
+
+A from image with random and zero filled regions and a to image with
+inserted, removed and modified data are written to the cache
+directory once. Each algorithm is then measured in a new process, so
+that the peak resident memory is its own.
+
+Usage: python benchmarks/create_patch.py [--size MB] [algorithm ...]
+
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import resource
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import phdiff
+
+
+CHUNK_SIZE = 1024 * 1024
+
+# Name, create_patch() keyword arguments.
+ALGORITHMS = {
+    'match-blocks-zstd': {
+        'compression': 'zstd',
+        'algorithm': 'match-blocks',
+        'zstd_level': 19
+    },
+    'match-blocks-lzma': {
+        'compression': 'lzma',
+        'algorithm': 'match-blocks'
+    },
+    'suffix-array-lzma': {
+        'compression': 'lzma',
+        'algorithm': 'suffix-array'
+    },
+    'zstd-3': {
+        'compression': 'zstd',
+        'algorithm': 'zstd',
+        'zstd_level': 3
+    },
+    'zstd-19': {
+        'compression': 'zstd',
+        'algorithm': 'zstd',
+        'zstd_level': 19
+    }
+}
+
+
+def create_images(from_filename, to_filename, size, seed=0):
+    if os.path.exists(from_filename) and os.path.exists(to_filename):
+        return
+
+    rng = random.Random(seed)
+
+    with open(from_filename, 'wb') as ffrom:
+        with open(to_filename, 'wb') as fto:
+            left = size
+
+            while left > 0:
+                chunk_size = min(left, CHUNK_SIZE)
+
+                if rng.random() < 0.7:
+                    chunk = bytearray(rng.randbytes(chunk_size))
+                else:
+                    chunk = bytearray(chunk_size)
+
+                ffrom.write(chunk)
+
+                for _ in range(chunk_size // 4096):
+                    chunk[rng.randrange(chunk_size)] = rng.getrandbits(8)
+
+                if rng.random() < 0.1:
+                    offset = rng.randrange(chunk_size)
+                    chunk[offset:offset] = rng.randbytes(4096)
+
+                if rng.random() < 0.1:
+                    offset = rng.randrange(chunk_size)
+                    del chunk[offset:offset + 4096]
+
+                fto.write(chunk)
+                left -= chunk_size
+
+
+def measure(from_filename, to_filename, patch_filename, kwargs, queue):
+    start_time = time.time()
+    phdiff.create_patch(from_filename, to_filename, patch_filename, **kwargs)
+    elapsed = time.time() - start_time
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((elapsed, maxrss))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size',
+                        type=int,
+                        default=256,
+                        help='From image size in MB (default: 256).')
+    parser.add_argument('--cache-directory',
+                        default='build/benchmarks',
+                        help='Image directory (default: %(default)s).')
+    parser.add_argument('algorithm',
+                        nargs='*',
+                        default=list(ALGORITHMS),
+                        help='Algorithms to measure (default: all).')
+    args = parser.parse_args()
+
+    os.makedirs(args.cache_directory, exist_ok=True)
+    from_filename = os.path.join(args.cache_directory,
+                                 'create-patch-{}.from'.format(args.size))
+    to_filename = os.path.join(args.cache_directory,
+                               'create-patch-{}.to'.format(args.size))
+    create_images(from_filename, to_filename, args.size * 1024 * 1024)
+    context = multiprocessing.get_context('spawn')
+
+    print('{:20} {:>12} {:>10} {:>14}'.format('Algorithm',
+                                              'Patch size',
+                                              'Time [s]',
+                                              'Peak RSS [MB]'))
+
+    for algorithm in args.algorithm:
+        patch_filename = os.path.join(args.cache_directory,
+                                      'create-patch-{}.{}'.format(args.size,
+                                                                  algorithm))
+        queue = context.Queue()
+        process = context.Process(target=measure,
+                                  args=(from_filename,
+                                        to_filename,
+                                        patch_filename,
+                                        ALGORITHMS[algorithm],
+                                        queue))
+        process.start()
+        elapsed, maxrss = queue.get()
+        process.join()
+        print('{:20} {:>12} {:>10.2f} {:>14.1f}'.format(
+            algorithm,
+            os.path.getsize(patch_filename),
+            elapsed,
+            maxrss / 1024))
+
+
+if __name__ == '__main__':
+    main()
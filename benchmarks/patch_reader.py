@@ -0,0 +1,122 @@
+"""Measure the decompression throughput of PatchReader for each
+compression.
+
+Patch data that resembles a diff, mostly zeros with scattered changes
+and some extra data, is compressed once per compression and written to
+the cache directory, then read back with PatchReader.readinto().
+
+Usage: python benchmarks/patch_reader.py [--size MB] [--block-size BYTES]
+
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from phdiff.apply import PatchReader
+from phdiff.apply import READ_BLOCK_SIZE
+from phdiff.common import COMPRESSIONS
+from phdiff.create import create_compressor
+
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def generate_patch_data(size, seed=0):
+    """Yield chunks of diff like data of `size` bytes in total.
+
+    """
+
+    rng = random.Random(seed)
+
+    while size > 0:
+        chunk_size = min(size, CHUNK_SIZE)
+
+        if rng.random() < 0.1:
+            chunk = rng.randbytes(chunk_size)
+        else:
+            chunk = bytearray(chunk_size)
+
+            for _ in range(chunk_size // 256):
+                chunk[rng.randrange(chunk_size)] = rng.getrandbits(8)
+
+        yield bytes(chunk)
+        size -= chunk_size
+
+
+def create_patch_data_file(filename, compression, size):
+    if os.path.exists(filename):
+        return
+
+    compressor = create_compressor(compression, 8, 7, zstd_level=19)
+
+    with open(filename + '.tmp', 'wb') as fout:
+        for chunk in generate_patch_data(size):
+            fout.write(compressor.compress(chunk))
+
+        fout.write(compressor.flush())
+
+    os.rename(filename + '.tmp', filename)
+
+
+def measure(filename, compression, size, block_size):
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    start_time = time.time()
+
+    with open(filename, 'rb') as fpatch:
+        patch_reader = PatchReader(fpatch, compression, block_size)
+        left = size
+
+        while left > 0:
+            left -= patch_reader.readinto(view[:min(left, len(buf))])
+
+    return time.time() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size',
+                        type=int,
+                        default=128,
+                        help='Decompressed patch size in MB (default: 128).')
+    parser.add_argument('--block-size',
+                        type=int,
+                        default=READ_BLOCK_SIZE,
+                        help='Patch read block size (default: %(default)s).')
+    parser.add_argument('--cache-directory',
+                        default='build/benchmarks',
+                        help='Compressed data directory (default: %(default)s).')
+    parser.add_argument('compression',
+                        nargs='*',
+                        default=COMPRESSIONS,
+                        help='Compressions to measure (default: all).')
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+    os.makedirs(args.cache_directory, exist_ok=True)
+
+    print('{:12} {:>12} {:>10} {:>10}'.format('Compression',
+                                              'Patch size',
+                                              'Time [s]',
+                                              'MB/s'))
+
+    for compression in args.compression:
+        filename = os.path.join(args.cache_directory,
+                                'patch-reader-{}.{}'.format(args.size,
+                                                            compression))
+        create_patch_data_file(filename, compression, size)
+        elapsed = measure(filename, compression, size, args.block_size)
+        print('{:12} {:>12} {:>10.2f} {:>10.1f}'.format(
+            compression,
+            os.path.getsize(filename),
+            elapsed,
+            args.size / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,452 @@
+"""Measure patch creation and application across synthetic corpora,
+sizes, diff algorithms and compressions.
+
+The corpora are described in corpora.py and written to the cache
+directory once. Each patch is created, and then applied in each apply
+mode, in a new process, so that the peak resident memory is its own.
+Wall time, peak RSS increase during the call, patch size and
+throughput in to data MB/s are printed, and optionally written as
+JSON, with the absolute peak RSS, to compare later versions against
+with --compare.
+
+Usage: python benchmarks/suite.py [--sizes 1M,16M] [--corpora ...]
+                                  [--variants ...] [--compressions ...]
+                                  [--output FILE] [--compare FILE]
+
+"""
+
+import os
+import sys
+import json
+import time
+import filecmp
+import argparse
+import platform
+import resource
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import phdiff
+from phdiff.common import COMPRESSIONS
+from phdiff.common import available_memory
+from phdiff.create import estimate_suffix_array_memory
+from corpora import CORPORA
+from corpora import create_corpus
+
+
+# Name, create_patch() keyword arguments.
+VARIANTS = {
+    'match-blocks-16': {
+        'algorithm': 'match-blocks',
+        'match_block_size': 16
+    },
+    'match-blocks-64': {
+        'algorithm': 'match-blocks',
+        'match_block_size': 64
+    },
+    'match-blocks-256': {
+        'algorithm': 'match-blocks',
+        'match_block_size': 256
+    },
+    'match-blocks-64-sparse': {
+        'algorithm': 'match-blocks',
+        'match_block_size': 64,
+        'sparse': True
+    },
+    'suffix-array': {
+        'algorithm': 'suffix-array'
+    },
+    'zstd': {
+        'algorithm': 'zstd'
+    }
+}
+
+# Name, apply_patch() keyword arguments.
+APPLY_MODES = {
+    'memory': {},
+    'streaming': {
+        'streaming': True
+    }
+}
+
+DEFAULT_COMPRESSIONS = ['none', 'lzma', 'zstd', 'lz4']
+
+# Measurements compared by --compare.
+COMPARED = [
+    ('patch_size', ('patch_size', )),
+    ('create time', ('create', 'time')),
+    ('create RSS', ('create', 'peak_rss_increase')),
+    ('apply time', ('apply', 'memory', 'time')),
+    ('apply RSS', ('apply', 'memory', 'peak_rss_increase'))
+]
+
+UNITS = {
+    'K': 1024,
+    'M': 1024 ** 2,
+    'G': 1024 ** 3
+}
+
+
+def parse_size(value):
+    value = value.strip().upper()
+
+    if value[-1:] in UNITS:
+        return int(float(value[:-1]) * UNITS[value[-1]])
+
+    return int(value)
+
+
+def format_size(size):
+    for unit in 'GMK':
+        if size >= UNITS[unit] and size % UNITS[unit] == 0:
+            return '{}{}'.format(size // UNITS[unit], unit)
+
+    return str(size)
+
+
+def comma_list(choices):
+    def parse(value):
+        values = value.split(',')
+
+        for value in values:
+            if value not in choices:
+                raise argparse.ArgumentTypeError(
+                    'invalid choice {!r}, choose from {}'.format(
+                        value,
+                        ', '.join(choices)))
+
+        return values
+
+    return parse
+
+
+def peak_rss():
+    """Peak resident memory of this process in bytes.
+
+    """
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if sys.platform == 'darwin':
+        return maxrss
+    else:
+        return 1024 * maxrss
+
+
+def run(function, args, kwargs, queue):
+    """Call given function and put its time, peak RSS and peak RSS
+    increase, or error, in `queue`.
+
+    """
+
+    try:
+        baseline_rss = peak_rss()
+        start_time = time.perf_counter()
+        function(*args, **kwargs)
+        elapsed = time.perf_counter() - start_time
+        maxrss = peak_rss()
+        queue.put(({
+            'time': elapsed,
+            'peak_rss': maxrss,
+            'peak_rss_increase': maxrss - baseline_rss
+        }, None))
+    except Exception as e:
+        queue.put((None, str(e)))
+
+
+def measure(function, args, kwargs):
+    """Call given function in a new process and return its measurements
+    and error.
+
+    """
+
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=run,
+                              args=(function, args, kwargs, queue))
+    process.start()
+    measurements, error = queue.get()
+    process.join()
+
+    return measurements, error
+
+
+def throughput(size, elapsed):
+    if not elapsed:
+        return None
+
+    return size / elapsed / 1000000
+
+
+def skip_reason(variant, compression, from_size, to_size):
+    kwargs = VARIANTS[variant]
+
+    if kwargs['algorithm'] == 'zstd' and compression != 'zstd':
+        return 'the zstd algorithm requires zstd compression'
+
+    if kwargs['algorithm'] == 'suffix-array':
+        memory = available_memory()
+
+        if (memory is not None
+            and estimate_suffix_array_memory(from_size, to_size) > memory):
+            return 'not enough memory'
+
+    return None
+
+
+def run_case(directory, corpus, size, variant, compression, zstd_level):
+    from_filename, to_filename = create_corpus(
+        os.path.join(directory, 'corpora'),
+        corpus,
+        size)
+    from_size = os.path.getsize(from_filename)
+    to_size = os.path.getsize(to_filename)
+    result = {
+        'corpus': corpus,
+        'size': size,
+        'variant': variant,
+        'compression': compression,
+        'from_size': from_size,
+        'to_size': to_size
+    }
+    reason = skip_reason(variant, compression, from_size, to_size)
+
+    if reason is not None:
+        result['skipped'] = reason
+
+        return result
+
+    kwargs = dict(VARIANTS[variant])
+    kwargs['compression'] = compression
+    kwargs['zstd_level'] = zstd_level
+    patch_filename = os.path.join(
+        directory,
+        '{}-{}-{}.patch.{}'.format(corpus, size, variant, compression))
+    measurements, error = measure(phdiff.create_patch,
+                                  (from_filename,
+                                   to_filename,
+                                   patch_filename),
+                                  kwargs)
+
+    if error is not None:
+        result['error'] = error
+
+        return result
+
+    result['patch_size'] = os.path.getsize(patch_filename)
+    measurements['throughput'] = throughput(to_size, measurements['time'])
+    result['create'] = measurements
+    result['apply'] = {}
+    patched_filename = patch_filename + '.patched'
+
+    for mode, kwargs in APPLY_MODES.items():
+        measurements, error = measure(phdiff.apply_patch,
+                                      (from_filename,
+                                       patch_filename,
+                                       patched_filename),
+                                      kwargs)
+
+        if error is None and not filecmp.cmp(patched_filename,
+                                             to_filename,
+                                             shallow=False):
+            error = 'Patched data differs from to data.'
+
+        if error is not None:
+            result['apply'][mode] = {'error': error}
+        else:
+            measurements['throughput'] = throughput(to_size,
+                                                    measurements['time'])
+            result['apply'][mode] = measurements
+
+    os.remove(patched_filename)
+    os.remove(patch_filename)
+
+    return result
+
+
+def format_float(value, fmt, divisor=1):
+    if value is None:
+        return '-'
+
+    return fmt.format(value / divisor)
+
+
+def print_header():
+    print('{:14} {:>5} {:23} {:10} {:>11} {:>8} {:>8} {:>8} {:>8} {:>8} '
+          '{:>8}'.format('Corpus',
+                         'Size',
+                         'Variant',
+                         'Compr.',
+                         'Patch size',
+                         'Create s',
+                         'MB/s',
+                         'RSS+ MB',
+                         'Apply s',
+                         'MB/s',
+                         'RSS+ MB'))
+
+
+def print_result(result):
+    prefix = '{:14} {:>5} {:23} {:10}'.format(result['corpus'],
+                                              format_size(result['size']),
+                                              result['variant'],
+                                              result['compression'])
+
+    if 'skipped' in result:
+        print('{} skipped, {}'.format(prefix, result['skipped']))
+    elif 'error' in result:
+        print('{} error: {}'.format(prefix, result['error']))
+    else:
+        create = result['create']
+        apply = result['apply']['memory']
+        print('{} {:>11} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}'.format(
+            prefix,
+            result['patch_size'],
+            format_float(create['time'], '{:.3f}'),
+            format_float(create['throughput'], '{:.1f}'),
+            format_float(create['peak_rss_increase'], '{:.1f}', 1000000),
+            format_float(apply.get('time'), '{:.3f}'),
+            format_float(apply.get('throughput'), '{:.1f}'),
+            format_float(apply.get('peak_rss_increase'), '{:.1f}', 1000000)))
+
+
+def result_key(result):
+    return (result['corpus'],
+            result['size'],
+            result['variant'],
+            result['compression'])
+
+
+def lookup(result, path):
+    for name in path:
+        if not isinstance(result, dict) or name not in result:
+            return None
+
+        result = result[name]
+
+    return result
+
+
+def compare(results, baseline, threshold):
+    """Print measurements that are more than `threshold` times worse than
+    in `baseline`, and return their number.
+
+    """
+
+    baseline = {
+        result_key(result): result for result in baseline['results']
+    }
+    regressions = 0
+
+    for result in results:
+        old = baseline.get(result_key(result))
+
+        if old is None:
+            continue
+
+        for name, path in COMPARED:
+            value = lookup(result, path)
+            old_value = lookup(old, path)
+
+            if not value or not old_value:
+                continue
+
+            ratio = value / old_value
+
+            if ratio > 1 + threshold:
+                regressions += 1
+                print('Regression: {} {} {} {}: {} {:.3g} -> {:.3g} '
+                      '({:+.0%})'.format(result['corpus'],
+                                         format_size(result['size']),
+                                         result['variant'],
+                                         result['compression'],
+                                         name,
+                                         old_value,
+                                         value,
+                                         ratio - 1))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes',
+                        default='1M,16M',
+                        help='Comma separated from image sizes, with an '
+                        'optional K, M or G suffix (default: %(default)s).')
+    parser.add_argument('--corpora',
+                        type=comma_list(list(CORPORA)),
+                        default=list(CORPORA),
+                        help='Comma separated corpora (default: all).')
+    parser.add_argument('--variants',
+                        type=comma_list(list(VARIANTS)),
+                        default=list(VARIANTS),
+                        help='Comma separated algorithm variants (default: '
+                        'all).')
+    parser.add_argument('--compressions',
+                        type=comma_list(list(COMPRESSIONS)),
+                        default=DEFAULT_COMPRESSIONS,
+                        help='Comma separated compressions (default: '
+                        '{}).'.format(','.join(DEFAULT_COMPRESSIONS)))
+    parser.add_argument('--zstd-level',
+                        type=int,
+                        default=19,
+                        help='Zstd compression level (default: %(default)s).')
+    parser.add_argument('--cache-directory',
+                        default='build/benchmarks',
+                        help='Corpora and patch directory (default: '
+                        '%(default)s).')
+    parser.add_argument('--output',
+                        help='Write the results as JSON to this file.')
+    parser.add_argument('--compare',
+                        help='Compare with results written by --output, and '
+                        'exit with status 1 if any regressed.')
+    parser.add_argument('--threshold',
+                        type=float,
+                        default=0.1,
+                        help='Relative increase reported as regression by '
+                        '--compare (default: %(default)s).')
+    args = parser.parse_args()
+
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    results = []
+    print_header()
+
+    for corpus in args.corpora:
+        for size in sizes:
+            for variant in args.variants:
+                for compression in args.compressions:
+                    result = run_case(args.cache_directory,
+                                      corpus,
+                                      size,
+                                      variant,
+                                      compression,
+                                      args.zstd_level)
+                    print_result(result)
+                    sys.stdout.flush()
+                    results.append(result)
+
+    if args.output:
+        output = {
+            'version': phdiff.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'results': results
+        }
+
+        with open(args.output, 'w') as fout:
+            json.dump(output, fout, indent=2)
+
+    if args.compare:
+        with open(args.compare) as fin:
+            baseline = json.load(fin)
+
+        if compare(results, baseline, args.threshold) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
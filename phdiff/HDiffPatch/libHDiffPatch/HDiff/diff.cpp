@@ -31,6 +31,7 @@
 #include <stdio.h>  //fprintf
 #include <algorithm> //std::max
 #include <vector>
+#include <thread>
 #include "private_diff/suffix_string.h"
 #include "private_diff/bytes_rle.h"
 #include "private_diff/compress_detect.h"
@@ -187,14 +188,49 @@ static void tryCollinear(TOldCover& lastCover,const TOldCover& matchCover,const
         lastCover.oldPos=linkOldPos;
 }
 
+//state of search_cover after a match: the next newPos to search and the last cover.
+struct TSearchCoverState{
+    TInt        newPos;
+    TOldCover   lastCover;
+    size_t      coverCount;
+    inline bool isSame(TInt _newPos,const TOldCover& _lastCover)const{
+        return (newPos==_newPos)&&(lastCover.oldPos==_lastCover.oldPos)
+             &&(lastCover.newPos==_lastCover.newPos)&&(lastCover.length==_lastCover.length);
+    }
+};
+
+//return index in states of the state same as (newPos,lastCover), or states.size().
+static size_t findSearchCoverState(const std::vector<TSearchCoverState>& states,
+                                   TInt newPos,const TOldCover& lastCover){
+    size_t left=0;
+    size_t right=states.size();
+    while (left<right){ //states are sorted by newPos
+        size_t mid=left+(right-left)/2;
+        if (states[mid].newPos<newPos)
+            left=mid+1;
+        else
+            right=mid;
+    }
+    if ((left<states.size())&&states[left].isSame(newPos,lastCover))
+        return left;
+    return states.size();
+}
+
 //寻找合适的覆盖线.
-static void search_cover(TDiffData& diff,const TSuffixString& sstring){
-    if (sstring.SASize()<=0) return;
+//  search covers starting in newData range [newPos,newPos_end), continuing from lastCover;
+//  returns the next newPos to search, and lastCover is updated.
+//  if out_states, the state after each match is saved.
+//  if syncStates, stops once the state after a match is the same as a state in syncStates,
+//    and its index is saved in *out_syncIndex.
+static TInt search_cover(TDiffData& diff,const TSuffixString& sstring,
+                         TInt newPos,TInt newPos_end,TOldCover& lastCover,
+                         std::vector<TSearchCoverState>* out_states=0,
+                         const std::vector<TSearchCoverState>* syncStates=0,
+                         size_t* out_syncIndex=0){
+    if (sstring.SASize()<=0) return newPos;
     static const int kMinMatchScore = 2; //最小搜寻覆盖收益.
     const TInt maxSearchNewPos=(diff.newData_end-diff.newData)-kMinMatchScore;
-    TInt newPos=0;
-    TOldCover lastCover(0,0,0);
-    while (newPos<=maxSearchNewPos) {
+    while ((newPos<=maxSearchNewPos)&&(newPos<newPos_end)) {
         TInt matchOldPos=0;
         TInt matchEqLength=getBestMatch(&matchOldPos,sstring,diff.newData+newPos,diff.newData_end);
         TOldCover matchCover(matchOldPos,newPos,matchEqLength);
@@ -215,6 +251,96 @@ static void search_cover(TDiffData& diff,const TSuffixString& sstring){
         }
         lastCover=diff.covers.back();
         newPos=std::max(newPos+1,lastCover.newPos+lastCover.length);//选出的cover不允许重叠,这可能不是最优策略;
+
+        if (out_states){
+            TSearchCoverState state;
+            state.newPos=newPos;
+            state.lastCover=lastCover;
+            state.coverCount=diff.covers.size();
+            out_states->push_back(state);
+        }
+        if (syncStates){
+            size_t index=findSearchCoverState(*syncStates,newPos,lastCover);
+            if (index<syncStates->size()){
+                *out_syncIndex=index;
+                return newPos;
+            }
+        }
+    }
+    return newPos;
+}
+
+//smallest newData region searched by a thread.
+static const TInt kMinSearchRegionSize=1<<16;
+
+struct TSearchCoverRegion{
+    TDiffData                       diff;
+    TInt                            newPos_begin;
+    TInt                            newPos_end;
+    TInt                            endNewPos;
+    TOldCover                       endLastCover;
+    std::vector<TSearchCoverState>  states;
+};
+
+static void search_cover_region(TSearchCoverRegion* region,const TSuffixString* sstring){
+    region->endNewPos=search_cover(region->diff,*sstring,region->newPos_begin,region->newPos_end,
+                                   region->endLastCover,&region->states);
+}
+
+//split newData into threadNum regions and search covers of each region on its own thread.
+//  each region is then continued from the end of the previous region on one thread,
+//  until the search is in a state the region's thread was in too; from there, the covers
+//  of the region's thread are used. so the result is the same as the single thread result.
+static void search_cover_mt(TDiffData& diff,const TSuffixString& sstring,int threadNum){
+    const TInt newSize=(TInt)(diff.newData_end-diff.newData);
+    if (threadNum>newSize/kMinSearchRegionSize)
+        threadNum=(int)(newSize/kMinSearchRegionSize);
+    if (threadNum<=1){
+        TOldCover lastCover(0,0,0);
+        search_cover(diff,sstring,0,newSize,lastCover);
+        return;
+    }
+
+    std::vector<TSearchCoverRegion> regions(threadNum);
+    for (int i=0;i<threadNum;++i){
+        regions[i].diff=diff;
+        regions[i].newPos_begin=newSize*i/threadNum;
+        regions[i].newPos_end=newSize*(i+1)/threadNum;
+        regions[i].endNewPos=regions[i].newPos_begin;
+        regions[i].endLastCover=TOldCover(0,0,0);
+    }
+    std::vector<std::thread> threads;
+    try {
+        for (int i=1;i<threadNum;++i)
+            threads.push_back(std::thread(search_cover_region,&regions[i],&sstring));
+        search_cover_region(&regions[0],&sstring);
+    } catch (...) {
+        for (size_t i=0;i<threads.size();++i)
+            threads[i].join();
+        throw;
+    }
+    for (size_t i=0;i<threads.size();++i)
+        threads[i].join();
+
+    diff.covers.swap(regions[0].diff.covers);
+    TInt newPos=regions[0].endNewPos;
+    TOldCover lastCover=regions[0].endLastCover;
+    for (int i=1;i<threadNum;++i){
+        TSearchCoverRegion& region=regions[i];
+        size_t syncIndex=region.states.size();
+        newPos=search_cover(diff,sstring,newPos,region.newPos_end,lastCover,
+                            0,&region.states,&syncIndex);
+        if (syncIndex<region.states.size()){
+            //the last cover is the same, but may be extended later by the region's thread.
+            const std::vector<TOldCover>& covers=region.diff.covers;
+            diff.covers.back()=covers[region.states[syncIndex].coverCount-1];
+            diff.covers.insert(diff.covers.end(),
+                               covers.begin()+region.states[syncIndex].coverCount,covers.end());
+            newPos=region.endNewPos;
+            lastCover=region.endLastCover;
+        }
+        std::vector<TSearchCoverState>().swap(region.states);
+        std::vector<TOldCover>().swap(region.diff.covers);
     }
 }
 
@@ -606,12 +732,12 @@ static void serialize_compressed_diff(const TDiffData& diff,
 static void get_diff(const TByte* newData,const TByte* newData_end,
                      const TByte* oldData,const TByte* oldData_end,
                      TDiffData&   out_diff,int kMinSingleMatchScore,
-                     const TSuffixString* sstring=0){
+                     const TSuffixString* sstring=0,int threadNum=1){
     assert(newData<=newData_end);
     assert(oldData<=oldData_end);
     TSuffixString _sstring_default(0,0);
     if (sstring==0){
-        _sstring_default.resetSuffixString(oldData,oldData_end);
+        _sstring_default.resetSuffixString(oldData,oldData_end,threadNum);
         sstring=&_sstring_default;
     }
 
@@ -621,7 +747,7 @@ static void get_diff(const TByte* newData,const TByte* newData_end,
     diff.oldData=oldData;
     diff.oldData_end=oldData_end;
 
-    search_cover(diff,*sstring);
+    search_cover_mt(diff,*sstring,threadNum);
     sstring=0;
     _sstring_default.clear();
 
@@ -662,11 +788,17 @@ void create_compressed_diff(const TByte* newData,
                             std::vector<TByte>& out_diff,
                             const hdiff_TCompress* compressPlugin,
                             int kMinSingleMatchScore,
-                            int patch_type)
+                            int patch_type,
+                            int threadNum,
+                            const void* oldSA)
 {
     TDiffData diff;
+    TSuffixString sstring;
 
-    get_diff(newData,newData_end, oldData, oldData_end, diff, kMinSingleMatchScore);
+    if (oldSA!=0)
+        sstring.resetSuffixString(oldData,oldData_end,oldSA);
+    get_diff(newData,newData_end, oldData, oldData_end, diff, kMinSingleMatchScore,
+             (oldSA!=0)?&sstring:0, threadNum);
     serialize_compressed_diff(diff, out_diff, compressPlugin, patch_type);
 }
 
@@ -53,6 +53,10 @@ bool check_diff(const unsigned char* newData,const unsigned char* newData_end,
 //create a compressed diffData between oldData and newData
 //  out_diff compressed by compressPlugin
 //  kMinSingleMatchScore: default 6, bin: 0--4  text: 4--9
+//  threadNum: search covers (and sort the suffix array if built with OpenMP)
+//    on up to threadNum threads; out_diff is the same for any threadNum.
+//  oldSA: the suffix array of oldData if already created, see
+//    TSuffixString::resetSuffixString(); it is then not created again.
 void create_compressed_diff(const unsigned char *newData,
                             const unsigned char *newData_end,
                             const unsigned char *oldData,
@@ -60,7 +64,9 @@ void create_compressed_diff(const unsigned char *newData,
                             std::vector<unsigned char>& out_diff,
                             const hdiff_TCompress *compressPlugin=0,
                             int kMinSingleMatchScore=kMinSingleMatchScore_default,
-                            int patch_type=0);
+                            int patch_type=0,
+                            int threadNum=1,
+                            const void* oldSA=0);
 
 //return patch_decompress(oldData+diff)==newData?
 bool check_compressed_diff(const unsigned char* newData,const unsigned char* newData_end,
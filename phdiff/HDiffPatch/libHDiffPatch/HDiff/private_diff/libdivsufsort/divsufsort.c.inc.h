@@ -37,7 +37,7 @@ static
 saidx_t
 sort_typeBstar(const sauchar_t *T, saidx_t *SA,
                saidx_t *bucket_A, saidx_t *bucket_B,
-               saidx_t n) {
+               saidx_t n, int threads) {
   saidx_t *PAb, *ISAb, *buf;
 #ifdef _OPENMP
   saidx_t *curbuf;
@@ -101,10 +101,10 @@ note:
 
     /* Sort the type B* substrings using sssort. */
 #ifdef _OPENMP
-    tmp = omp_get_max_threads();
+    tmp = (threads > 0) ? threads : omp_get_max_threads();
     buf = SA + m, bufsize = (n - (2 * m)) / tmp;
     c0 = ALPHABET_SIZE - 2, c1 = ALPHABET_SIZE - 1, j = m;
-#pragma omp parallel default(shared) private(curbuf, k, l, d0, d1, tmp)
+#pragma omp parallel num_threads(tmp) default(shared) private(curbuf, k, l, d0, d1, tmp)
     {
       tmp = omp_get_thread_num();
       curbuf = buf + tmp * bufsize;
@@ -130,6 +130,7 @@ note:
       }
     }
 #else
+    (void)threads;
     buf = SA + m, bufsize = n - (2 * m);
     for(c0 = ALPHABET_SIZE - 2, j = m; 0 < j; --c0) {
       for(c1 = ALPHABET_SIZE - 1; c0 < c1; j = i, --c1) {
@@ -330,6 +331,11 @@ construct_BWT(const sauchar_t *T, saidx_t *SA,
 
 saint_t
 divsufsort(const sauchar_t *T, saidx_t *SA, saidx_t n) {
+  return divsufsort_mt(T, SA, n, 1);
+}
+
+saint_t
+divsufsort_mt(const sauchar_t *T, saidx_t *SA, saidx_t n, int threads) {
   saidx_t *bucket_A, *bucket_B;
   saidx_t m;
   saint_t err = 0;
@@ -345,7 +351,7 @@ divsufsort(const sauchar_t *T, saidx_t *SA, saidx_t n) {
 
   /* Suffixsort. */
   if((bucket_A != NULL) && (bucket_B != NULL)) {
-    m = sort_typeBstar(T, SA, bucket_A, bucket_B, n);
+    m = sort_typeBstar(T, SA, bucket_A, bucket_B, n, threads);
     construct_SA(T, SA, bucket_A, bucket_B, n, m);
   } else {
     err = -2;
@@ -373,7 +379,7 @@ divbwt(const sauchar_t *T, sauchar_t *U, saidx_t *A, saidx_t n) {
 
   /* Burrows-Wheeler Transform. */
   if((B != NULL) && (bucket_A != NULL) && (bucket_B != NULL)) {
-    m = sort_typeBstar(T, B, bucket_A, bucket_B, n);
+    m = sort_typeBstar(T, B, bucket_A, bucket_B, n, 1);
     pidx = construct_BWT(T, B, bucket_A, bucket_B, n, m);
 
     /* Copy to output string. */
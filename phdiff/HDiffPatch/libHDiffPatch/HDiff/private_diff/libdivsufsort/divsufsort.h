@@ -89,6 +89,16 @@ DIVSUFSORT_API
 saint_t
 divsufsort(const sauchar_t *T, saidx_t *SA, saidx_t n);
 
+/**
+ * Same as divsufsort(), but sorts the type B* suffixes on up to
+ * `threads` threads when built with OpenMP. A non-positive `threads`
+ * uses the OpenMP default.
+ * @param threads The number of threads to use.
+ */
+DIVSUFSORT_API
+saint_t
+divsufsort_mt(const sauchar_t *T, saidx_t *SA, saidx_t n, int threads);
+
 /**
  * Constructs the burrows-wheeler transformed string of a given string.
  * @param T[0..n-1] The input string.
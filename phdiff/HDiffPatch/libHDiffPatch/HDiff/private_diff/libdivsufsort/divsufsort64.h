@@ -99,6 +99,13 @@ DIVSUFSORT_API
 saint_t
 divsufsort64(const sauchar_t *T, saidx64_t *SA, saidx64_t n);
 
+/**
+ * See divsufsort_mt().
+ */
+DIVSUFSORT_API
+saint_t
+divsufsort64_mt(const sauchar_t *T, saidx64_t *SA, saidx64_t n, int threads);
+
 /**
  * Constructs the burrows-wheeler transformed string of a given string.
  * @param T[0..n-1] The input string.
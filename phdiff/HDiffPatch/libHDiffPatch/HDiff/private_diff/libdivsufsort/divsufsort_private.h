@@ -68,6 +68,7 @@ extern "C" {
 #  define PRIdSAIDX_T PRIdSAIDX64_T
 # endif /* PRIdSAIDX_T */
 # define divsufsort divsufsort64
+# define divsufsort_mt divsufsort64_mt
 # define divbwt divbwt64
 # define divsufsort_version divsufsort64_version
 # define bw_transform bw_transform64
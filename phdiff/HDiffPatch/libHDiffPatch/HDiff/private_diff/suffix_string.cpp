@@ -104,7 +104,8 @@ namespace {
     };
 
     template<class TSAInt>
-    static void _suffixString_create(const TChar* src,const TChar* src_end,std::vector<TSAInt>& out_sstring){
+    static void _suffixString_create(const TChar* src,const TChar* src_end,std::vector<TSAInt>& out_sstring,
+                                     int threadNum){
         TSAInt size=(TSAInt)(src_end-src);
         if (size<0)
             throw std::runtime_error("suffixString_create() error.");
@@ -127,9 +128,11 @@ namespace {
     #ifdef _SA_SORTBY_DIVSUFSORT
         saint_t rt=-1;
         if (sizeof(TSAInt)==8)
-            rt=divsufsort64(src,(saidx64_t*)&out_sstring[0],(saidx64_t)size);
+            rt=divsufsort64_mt(src,(saidx64_t*)&out_sstring[0],(saidx64_t)size,threadNum);
         else if (sizeof(TSAInt)==4)
-            rt=divsufsort(src,(saidx_t*)&out_sstring[0],(saidx_t)size);
+            rt=divsufsort_mt(src,(saidx_t*)&out_sstring[0],(saidx_t)size,threadNum);
+    #else
+        (void)threadNum;
     #endif
        if (rt!=0)
             throw std::runtime_error("suffixString_create() error.");
@@ -283,19 +286,29 @@ void TSuffixString::clear(){
     m_SA_large.swap(_tmp_g);
 }
 
-void TSuffixString::resetSuffixString(const TChar* src_begin,const TChar* src_end){
+void TSuffixString::resetSuffixString(const TChar* src_begin,const TChar* src_end,int threadNum){
     assert(src_begin<=src_end);
     m_src_begin=src_begin;
     m_src_end=src_end;
     if (isUseLargeSA()){
         m_SA_limit.clear();
-        _suffixString_create(m_src_begin,m_src_end,m_SA_large);
+        _suffixString_create(m_src_begin,m_src_end,m_SA_large,threadNum);
+        build_cache(m_SA_large.empty()?0:&m_SA_large[0]);
     }else{
         assert(sizeof(TInt32)==4);
         m_SA_large.clear();
-        _suffixString_create(m_src_begin,m_src_end,m_SA_limit);
+        _suffixString_create(m_src_begin,m_src_end,m_SA_limit,threadNum);
+        build_cache(m_SA_limit.empty()?0:&m_SA_limit[0]);
     }
-    build_cache();
+}
+
+void TSuffixString::resetSuffixString(const TChar* src_begin,const TChar* src_end,const void* SA){
+    assert(src_begin<=src_end);
+    m_src_begin=src_begin;
+    m_src_end=src_end;
+    m_SA_limit.clear();
+    m_SA_large.clear();
+    build_cache(SA);
 }
 
 TInt TSuffixString::lower_bound(const TChar* str,const TChar* str_end)const{
@@ -330,7 +343,7 @@ void TSuffixString::clear_cache(){
     m_lower_bound=(t_lower_bound_func)_lower_bound_TInt32;//safe
 }
 
-void TSuffixString::build_cache(){
+void TSuffixString::build_cache(const void* SA_begin){
     clear_cache();
     
     const size_t kUsedCacheMinSASize =2*(1<<20); //当字符串较大时再启用大缓存表.
@@ -341,9 +354,9 @@ void TSuffixString::build_cache(){
     
     if (isUseLargeSA()){
         m_lower_bound=(t_lower_bound_func)_lower_bound_TInt;
-        if (m_SA_large.empty()) return;
-        m_cached_SA_begin=&m_SA_large[0];
-        m_cached_SA_end=&m_SA_large[0]+m_SA_large.size();
+        if (SASize()==0) return;
+        m_cached_SA_begin=SA_begin;
+        m_cached_SA_end=(const TInt*)SA_begin+SASize();
         _build_range256((TInt*)m_cached_SA_begin,(TInt*)m_cached_SA_end,
                         m_src_begin,m_src_end,(const TInt**)&m_cached1char_range[0]);
         if (m_cached2char_range){
@@ -352,9 +365,9 @@ void TSuffixString::build_cache(){
         }
     }else{
         m_lower_bound=(t_lower_bound_func)_lower_bound_TInt32;
-        if (m_SA_limit.empty()) return;
-        m_cached_SA_begin=&m_SA_limit[0];
-        m_cached_SA_end=&m_SA_limit[0]+m_SA_limit.size();
+        if (SASize()==0) return;
+        m_cached_SA_begin=SA_begin;
+        m_cached_SA_end=(const TInt32*)SA_begin+SASize();
         _build_range256((TInt32*)m_cached_SA_begin,(TInt32*)m_cached_SA_end,
                         m_src_begin,m_src_end,(const TInt32**)&m_cached1char_range[0]);
         if (m_cached2char_range){
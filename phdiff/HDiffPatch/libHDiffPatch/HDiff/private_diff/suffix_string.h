@@ -53,7 +53,11 @@ public:
     
     //throw std::runtime_error when create SA error
     TSuffixString(const TChar* src_begin,const TChar* src_end);
-    void resetSuffixString(const TChar* src_begin,const TChar* src_end);
+    //threadNum: sort with up to threadNum threads if libdivsufsort built with OpenMP
+    void resetSuffixString(const TChar* src_begin,const TChar* src_end,int threadNum=1);
+    //use an existing suffix array of the source instead of creating it; SA is not copied
+    //  and must stay valid until clear(); it has TInt elements if SASize()>2G-1, else TInt32
+    void resetSuffixString(const TChar* src_begin,const TChar* src_end,const void* SA);
 
     inline const TChar* src_begin()const{ return m_src_begin; }
     inline const TChar* src_end()const{ return m_src_end; }
@@ -62,9 +66,9 @@ public:
 
     inline TInt SA(TInt i)const{//return m_SA[i];//排好序的后缀字符串数组.
         if (isUseLargeSA())
-            return m_SA_large[i];
+            return ((const TInt*)m_cached_SA_begin)[i];
         else
-            return (TInt)m_SA_limit[i];
+            return (TInt)((const TInt32*)m_cached_SA_begin)[i];
     }
     TInt lower_bound(const TChar* str,const TChar* str_end)const;//return index in SA
 private:
@@ -86,7 +90,7 @@ private:
                                        const TChar* src_begin,const TChar* src_end,
                                        const void* SA_begin,size_t min_eq);
     t_lower_bound_func  m_lower_bound;
-    void                build_cache();
+    void                build_cache(const void* SA_begin);
     void                clear_cache();
 };
 
@@ -1,9 +1,55 @@
+import sys
+import argparse
 from .create import create_patch
+from .create import create_patches
+from .create import create_patches_to
 from .apply import apply_patch
+from .apply import apply_patches
+from .apply import apply_patch_range
+from .apply import apply_patch_resumable
+from .apply import apply_patch_in_place
+from .apply import PatchApplier
+from .apply import PatchApplierPool
+from .index import FromIndex
+from .index import create_from_index
+from .recompress import recompress_patch
+from .recompress import recompress_patches
+from .cache import PatchCache
+from . import aio
 from .info import patch_info
 from .info import patch_info_filename
 from .errors import Error
 from .version import __version__
 from .common import COMPRESSIONS as _COMPRESSIONS
+from .subparsers import create_patches_to as _create_patches_to
+from .subparsers import recompress_patch as _recompress_patch
+
+
+def _main():
+    parser = argparse.ArgumentParser(
+        description='Binary delta encoding utility.')
+
+    parser.add_argument('-d', '--debug', action='store_true')
+    parser.add_argument('--version',
+                        action='version',
+                        version=__version__,
+                        help='Print version information and exit.')
+
+    subparsers = parser.add_subparsers(title='subcommands',
+                                       dest='subcommand')
+    subparsers.required = True
+
+    _create_patches_to.add_subparser(subparsers)
+    _recompress_patch.add_subparser(subparsers)
+
+    args = parser.parse_args()
+
+    if args.debug:
+        args.func(args)
+    else:
+        try:
+            args.func(args)
+        except BaseException as e:
+            sys.exit('error: ' + str(e))
 
 
@@ -0,0 +1,5 @@
+from . import _main
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,376 @@
+"""Asyncio API.
+
+Patches are created and applied on a thread pool, as the native diff
+and patch algorithms release the GIL, so that the event loop is never
+blocked. Patches are streamed to asyncio.StreamWriter like writers
+and from asyncio.StreamReader like readers in chunks, through a
+temporary file.
+
+A cancelled job stops at the next chunk of data passed between the
+native code and Python. When creating patches that is the next chunk
+of patch data written, which for the suffix array algorithm is only
+once the diff is complete. Either way no output file is written.
+
+The jobs runner used by default is closed when the interpreter exits.
+
+"""
+
+import os
+import atexit
+import asyncio
+import inspect
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .common import check_cancelled
+from .create import create_patch as _create_patch
+from .apply import apply_patch as _apply_patch
+from .apply import PatchApplierPool
+from .apply import STREAMING_CACHE_SIZE
+
+
+# Size of the patch chunks passed to writers and read from readers.
+CHUNK_SIZE = 64 * 1024
+
+_JOBS = None
+_JOBS_LOCK = threading.Lock()
+
+
+def default_jobs():
+    """Returns the jobs runner used if none is given, running at most one
+    job per CPU at a time.
+
+    """
+
+    global _JOBS
+
+    with _JOBS_LOCK:
+        if _JOBS is None:
+            _JOBS = PatchJobs()
+            atexit.register(close_default_jobs)
+
+        return _JOBS
+
+
+def close_default_jobs():
+    """Close the jobs runner returned by default_jobs(), if created. A new
+    one is created if used again.
+
+    """
+
+    global _JOBS
+
+    with _JOBS_LOCK:
+        jobs = _JOBS
+        _JOBS = None
+
+    if jobs is not None:
+        atexit.unregister(close_default_jobs)
+        jobs.close()
+
+
+def is_writer(patch):
+    return hasattr(patch, 'drain')
+
+
+def is_reader(patch):
+    return hasattr(patch, 'read') and inspect.iscoroutinefunction(patch.read)
+
+
+def temporary_filename(filename):
+    """Returns the name of a new temporary file in the same directory as
+    `filename`, so that it can be renamed to it.
+
+    """
+
+    fd, tmpfile = tempfile.mkstemp(suffix='.tmp',
+                                   dir=os.path.dirname(filename) or '.')
+    os.close(fd)
+
+    return tmpfile
+
+
+def remove(filename):
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+
+
+class CancellableApplier(object):
+    """A patch applier that raises an error at the next read or write of
+    data once `cancelled` is set.
+
+    """
+
+    def __init__(self, applier, cancelled):
+        self._applier = applier
+        self._cancelled = cancelled
+
+    def _checked(self, function):
+        def checked(*args):
+            check_cancelled(self._cancelled)
+
+            return function(*args)
+
+        return checked
+
+    def apply_patch(self, *args):
+        check_cancelled(self._cancelled)
+
+        return self._applier.apply_patch(*args)
+
+    def apply_patch_stream(self,
+                           from_readinto,
+                           from_size,
+                           patch_readinto,
+                           patch_size,
+                           to_write):
+        return self._applier.apply_patch_stream(
+            self._checked(from_readinto),
+            from_size,
+            self._checked(patch_readinto),
+            patch_size,
+            self._checked(to_write))
+
+
+def create_patch_job(fromfile,
+                     tofile,
+                     patchfile,
+                     compression,
+                     kwargs,
+                     cancelled):
+    tmpfile = temporary_filename(patchfile)
+
+    try:
+        _create_patch(fromfile,
+                      tofile,
+                      tmpfile,
+                      compression,
+                      cancelled=cancelled,
+                      **kwargs)
+        check_cancelled(cancelled)
+        os.replace(tmpfile, patchfile)
+    except BaseException:
+        remove(tmpfile)
+
+        raise
+
+    return os.path.getsize(patchfile)
+
+
+class PatchJobs(object):
+    """Create and apply patches on a thread pool of `max_jobs` threads,
+    one per CPU by default. More jobs wait for a thread, and can be
+    cancelled before they start. Patches are applied with appliers
+    from a pool, each keeping a work cache of at most `cache_size`
+    bytes between jobs.
+
+    """
+
+    def __init__(self, max_jobs=None, cache_size=STREAMING_CACHE_SIZE):
+        if max_jobs is None:
+            max_jobs = os.cpu_count() or 1
+
+        self.max_jobs = max_jobs
+        self._executor = ThreadPoolExecutor(max_workers=max_jobs,
+                                            thread_name_prefix='phdiff-aio')
+        self._appliers = PatchApplierPool(max_jobs, cache_size)
+
+    async def _run(self, function, *args):
+        """Call `function(*args, cancelled)` on the thread pool, setting
+        the event `cancelled` if the calling task is cancelled.
+
+        """
+
+        loop = asyncio.get_running_loop()
+        cancelled = threading.Event()
+
+        try:
+            return await loop.run_in_executor(self._executor,
+                                              function,
+                                              *args,
+                                              cancelled)
+        except asyncio.CancelledError:
+            cancelled.set()
+
+            raise
+
+    def _apply_patch_job(self,
+                         fromfile,
+                         patchfile,
+                         tofile,
+                         streaming,
+                         cancelled):
+        tmpfile = temporary_filename(tofile)
+
+        try:
+            with self._appliers.checkout() as applier:
+                _apply_patch(fromfile,
+                             patchfile,
+                             tmpfile,
+                             streaming=streaming,
+                             applier=CancellableApplier(applier, cancelled))
+
+            check_cancelled(cancelled)
+            os.replace(tmpfile, tofile)
+        except BaseException:
+            remove(tmpfile)
+
+            raise
+
+        return os.path.getsize(tofile)
+
+    async def create_patch(self,
+                           fromfile,
+                           tofile,
+                           patch,
+                           compression,
+                           **kwargs):
+        """Same as phdiff.create_patch(), but `patch` is a filename or a
+        writer, which the patch is written to in chunks once created.
+        Returns the patch size.
+
+        """
+
+        if not is_writer(patch):
+            return await self._run(create_patch_job,
+                                   fromfile,
+                                   tofile,
+                                   patch,
+                                   compression,
+                                   kwargs)
+
+        fd, patchfile = tempfile.mkstemp(suffix='.patch')
+        os.close(fd)
+
+        try:
+            patch_size = await self._run(create_patch_job,
+                                         fromfile,
+                                         tofile,
+                                         patchfile,
+                                         compression,
+                                         kwargs)
+            await write_file(patchfile, patch)
+        finally:
+            remove(patchfile)
+
+        return patch_size
+
+    async def apply_patch(self,
+                          fromfile,
+                          patch,
+                          tofile,
+                          streaming=True):
+        """Same as phdiff.apply_patch(), but `patch` is a filename or a
+        reader, which the patch is read from in chunks until end of
+        stream. The files are read and written in chunks unless
+        `streaming` is ``False``. Returns the to size.
+
+        """
+
+        if not is_reader(patch):
+            return await self._run(self._apply_patch_job,
+                                   fromfile,
+                                   patch,
+                                   tofile,
+                                   streaming)
+
+        fd, patchfile = tempfile.mkstemp(suffix='.patch')
+        os.close(fd)
+
+        try:
+            await read_file(patch, patchfile)
+
+            return await self._run(self._apply_patch_job,
+                                   fromfile,
+                                   patchfile,
+                                   tofile,
+                                   streaming)
+        finally:
+            remove(patchfile)
+
+    def close(self):
+        """Wait for running jobs, stop the threads and free the work caches
+        of the appliers.
+
+        """
+
+        self._executor.shutdown()
+        self._appliers.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+async def write_file(filename, writer):
+    """Write given file to `writer` in chunks, waiting for it to drain
+    after each chunk.
+
+    """
+
+    loop = asyncio.get_running_loop()
+
+    with open(filename, 'rb') as fin:
+        while True:
+            chunk = await loop.run_in_executor(None, fin.read, CHUNK_SIZE)
+
+            if not chunk:
+                break
+
+            writer.write(chunk)
+            await writer.drain()
+
+
+async def read_file(reader, filename):
+    """Read from `reader` in chunks until end of stream and write to given
+    file.
+
+    """
+
+    loop = asyncio.get_running_loop()
+
+    with open(filename, 'wb') as fout:
+        while True:
+            chunk = await reader.read(CHUNK_SIZE)
+
+            if not chunk:
+                break
+
+            await loop.run_in_executor(None, fout.write, chunk)
+
+
+async def create_patch(fromfile,
+                       tofile,
+                       patch,
+                       compression,
+                       jobs=None,
+                       **kwargs):
+    """Create a patch on `jobs`, a PatchJobs, or default_jobs() if
+    ``None``. See PatchJobs.create_patch().
+
+    """
+
+    if jobs is None:
+        jobs = default_jobs()
+
+    return await jobs.create_patch(fromfile,
+                                   tofile,
+                                   patch,
+                                   compression,
+                                   **kwargs)
+
+
+async def apply_patch(fromfile, patch, tofile, jobs=None, streaming=True):
+    """Apply a patch on `jobs`, a PatchJobs, or default_jobs() if
+    ``None``. See PatchJobs.apply_patch().
+
+    """
+
+    if jobs is None:
+        jobs = default_jobs()
+
+    return await jobs.apply_patch(fromfile, patch, tofile, streaming)
@@ -1,3 +1,11 @@
+import os
+import io
+import mmap
+import struct
+import hashlib
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from lzma import LZMADecompressor
 from bz2 import BZ2Decompressor
 from .errors import Error
@@ -6,6 +14,7 @@ from .compression.none import NoneDecompressor
 from .compression.heatshrink import HeatshrinkDecompressor
 from .compression.zstd import ZstdDecompressor
 from .compression.lz4 import Lz4Decompressor
+from .compression.blocks import BlockDecompressor
 from .common import COMPRESSION_NONE
 from .common import COMPRESSION_LZMA
 from .common import COMPRESSION_CRLE
@@ -13,18 +22,66 @@ from .common import COMPRESSION_BZ2
 from .common import COMPRESSION_HEATSHRINK
 from .common import COMPRESSION_ZSTD
 from .common import COMPRESSION_LZ4
+from .common import COMPRESSION_PLZMA
+from .common import COMPRESSION_PBZ2
+from .common import PATCH_TYPE_HDIFFPATCH
+from .common import PATCH_TYPE_SEGMENTED
+from .common import PATCH_TYPE_IN_PLACE
+from .common import PATCH_TYPE_ZSTD
+from .common import PATCH_TYPE_EXTENDED
+from .common import PATCH_TYPE_TRIMMED
+from .common import PATCH_TYPE_SPARSE
+from .common import in_place_from_offset
+from .common import SEGMENT_INDEX_SIZE_LENGTH
 from .common import format_bad_compression_string
 from .common import format_bad_compression_number
 from .common import file_size
 from .common import file_read
+from .common import mmap_read_only
+from .common import file_data
+from .common import div_ceil
 from .common import unpack_size
+from .sparse import unpack_extents
+from .sparse import SparseReader
+from .sparse import SparseWriter
 from .common import unpack_header
-from . import phdiffpatch
+from .common import run_jobs
+from .phdiffpatch import PatchApplier
+
+
+STREAMING_CACHE_SIZE = 8 * 1024 * 1024
+
+# Default work cache size when applying patches in memory.
+APPLY_CACHE_SIZE = 64 * 1024 * 1024
+
+READ_BLOCK_SIZE = 32768
+
+# Size of the to data chunks written when applying zstd patches.
+ZSTD_WRITE_SIZE = 1024 * 1024
+
+# Size of the chunks of the common prefix and suffix of trimmed patches
+# copied from the from data.
+COPY_SIZE = 1024 * 1024
+
+CHECKPOINT_MAGIC = b'PHDIFFCP'
+
+# Magic, SHA-256 digest of the patch header and segment index, and the
+# number of applied segments.
+CHECKPOINT_FORMAT = '<8s32sQ'
 
 
 class PatchReader(object):
+    """Decompresses the patch data, reading `block_size` bytes at a time
+    from `fpatch`. `from_data` is the dictionary of zstd patch-from
+    data.
+
+    """
 
-    def __init__(self, fpatch, compression):
+    def __init__(self,
+                 fpatch,
+                 compression,
+                 block_size=READ_BLOCK_SIZE,
+                 from_data=None):
         if compression == 'lzma':
             self.decompressor = LZMADecompressor()
         elif compression == 'bz2':
@@ -36,13 +93,24 @@ class PatchReader(object):
         elif compression == 'heatshrink':
             self.decompressor = HeatshrinkDecompressor(patch_data_length(fpatch))
         elif compression == 'zstd':
-            self.decompressor = ZstdDecompressor(patch_data_length(fpatch))
+            self.decompressor = ZstdDecompressor(patch_data_length(fpatch),
+                                                 from_data)
         elif compression == 'lz4':
             self.decompressor = Lz4Decompressor()
+        elif compression == 'plzma':
+            self.decompressor = BlockDecompressor('lzma')
+        elif compression == 'pbz2':
+            self.decompressor = BlockDecompressor('bz2')
         else:
             raise Error(format_bad_compression_string(compression))
 
+        if block_size <= 0:
+            raise Error(
+                'Expected a positive block size, but got {}.'.format(
+                    block_size))
+
         self._fpatch = fpatch
+        self._block_size = block_size
 
     def read(self, size):
         return self.decompress(size)
@@ -52,14 +120,25 @@ class PatchReader(object):
 
         """
 
-        buf = b''
+        buf = bytearray(size)
+        self.readinto(buf)
+
+        return bytes(buf)
+
+    def readinto(self, buf):
+        """Decompress until `buf` is full. Returns the size of `buf`.
+
+        """
 
-        while len(buf) < size:
+        view = memoryview(buf).cast('B')
+        offset = 0
+
+        while offset < len(view):
             if self.decompressor.eof:
                 raise Error('Early end of patch data.')
 
             if self.decompressor.needs_input:
-                data = self._fpatch.read(4096)
+                data = self._fpatch.read(self._block_size)
 
                 if not data:
                     raise Error('Out of patch data.')
@@ -67,11 +146,22 @@ class PatchReader(object):
                 data = b''
 
             try:
-                buf += self.decompressor.decompress(data, size - len(buf))
+                offset += self._decompress_into(data, view[offset:])
             except Exception:
                 raise Error('Patch decompression failed.')
 
-        return buf
+        return offset
+
+    def _decompress_into(self, data, view):
+        if hasattr(self.decompressor, 'decompress_into'):
+            return self.decompressor.decompress_into(data, view)
+
+        # The decompressors of the standard library and lz4 can only
+        # return new bytes objects.
+        decompressed = self.decompressor.decompress(data, len(view))
+        view[:len(decompressed)] = decompressed
+
+        return len(decompressed)
 
     @property
     def eof(self):
@@ -80,6 +170,117 @@ class PatchReader(object):
 def patch_data_length(fpatch):
     return file_size(fpatch) - fpatch.tell()
 
+
+class PatchFileView(object):
+    """A view of a patch file with its own file position, so that several
+    readers can share the same underlying file object.
+
+    """
+
+    def __init__(self, fpatch, offset):
+        self._fpatch = fpatch
+        self._offset = offset
+
+    def read(self, size=-1):
+        self._fpatch.seek(self._offset, os.SEEK_SET)
+        data = self._fpatch.read(size)
+        self._offset += len(data)
+
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._offset = self._fpatch.seek(offset, whence)
+
+        return self._offset
+
+    def tell(self):
+        return self._offset
+
+
+class PatchStream(object):
+    """Random access to the decompressed patch data without holding it in
+    memory.
+
+    HDiffPatch reads each section of the patch sequentially, but
+    interleaves reads of different sections. One decompressing cursor
+    is kept per section, and a cursor is only ever moved forward by
+    decompressing and discarding data. A read before all cursors
+    opens a new cursor at the beginning of the patch data.
+
+    """
+
+    MAXIMUM_NUMBER_OF_CURSORS = 8
+    SKIP_CHUNK_SIZE = 65536
+
+    def __init__(self, fpatch, compression, patch_size):
+        self._fpatch = fpatch
+        self._compression = compression
+        self._offset = fpatch.tell()
+        self._size = patch_size
+        self._cursors = []
+
+    def _open_cursor(self):
+        cursor = [0, PatchReader(PatchFileView(self._fpatch, self._offset),
+                                 self._compression)]
+
+        if len(self._cursors) == self.MAXIMUM_NUMBER_OF_CURSORS:
+            self._cursors.pop(0)
+
+        self._cursors.append(cursor)
+
+        return cursor
+
+    def _find_cursor(self, position):
+        best = None
+
+        for cursor in self._cursors:
+            if cursor[0] <= position:
+                if best is None or cursor[0] > best[0]:
+                    best = cursor
+
+        if best is None:
+            best = self._open_cursor()
+        else:
+            # Move to the back, the least recently used cursor is
+            # dropped first.
+            self._cursors.remove(best)
+            self._cursors.append(best)
+
+        return best
+
+    def readinto(self, position, buf):
+        """Fill `buf` with decompressed patch data starting at `position`.
+
+        """
+
+        size = len(buf)
+
+        if position + size > self._size:
+            raise Error('Read beyond end of patch data.')
+
+        if self._compression == 'none':
+            self._fpatch.seek(self._offset + position, os.SEEK_SET)
+
+            if self._fpatch.readinto(buf) != size:
+                raise Error('Out of patch data.')
+
+            return size
+
+        cursor = self._find_cursor(position)
+
+        if cursor[0] < position:
+            skip_buf = bytearray(min(position - cursor[0],
+                                     self.SKIP_CHUNK_SIZE))
+
+            while cursor[0] < position:
+                skip_size = min(position - cursor[0], len(skip_buf))
+                cursor[0] += cursor[1].readinto(
+                    memoryview(skip_buf)[:skip_size])
+
+        cursor[0] += cursor[1].readinto(buf)
+
+        return size
+
 def convert_compression(compression):
     if compression == COMPRESSION_NONE:
         compression = 'none'
@@ -95,38 +296,931 @@ def convert_compression(compression):
         compression = 'zstd'
     elif compression == COMPRESSION_LZ4:
         compression = 'lz4'
+    elif compression == COMPRESSION_PLZMA:
+        compression = 'plzma'
+    elif compression == COMPRESSION_PBZ2:
+        compression = 'pbz2'
     else:
         raise Error(format_bad_compression_number(compression))
 
     return compression
 
-def read_header_hdiffpatch(fpatch):
+def read_header(fpatch):
     header = fpatch.read(1)
 
     if len(header) != 1:
         raise Error('Failed to read the patch header.')
 
-    patch_type, compression  = unpack_header(header)
+    patch_type, compression = unpack_header(header)
+
+    if patch_type == PATCH_TYPE_EXTENDED:
+        patch_type = unpack_size(fpatch)
+
+    return patch_type, convert_compression(compression)
+
+def read_patch_type(fpatch):
+    position = fpatch.tell()
+    patch_type, _ = read_header(fpatch)
+    fpatch.seek(position, os.SEEK_SET)
+
+    if patch_type not in [PATCH_TYPE_HDIFFPATCH,
+                          PATCH_TYPE_SEGMENTED,
+                          PATCH_TYPE_IN_PLACE,
+                          PATCH_TYPE_ZSTD,
+                          PATCH_TYPE_TRIMMED,
+                          PATCH_TYPE_SPARSE]:
+        raise Error('Bad patch type {}.'.format(patch_type))
 
-    compression = convert_compression(compression)
+    return patch_type
+
+def read_header_hdiffpatch(fpatch):
+    _, compression = read_header(fpatch)
     to_size = unpack_size(fpatch)
     patch_size = unpack_size(fpatch)
 
     return compression, to_size, patch_size
 
-def apply_patch_hdiffpatch(ffrom, fpatch, fto):
+class Segment(object):
+    """A segment of a segmented patch. The `to_size` bytes at
+    `to_offset` in the to data are created from the `compressed_size`
+    bytes at `patch_offset` in the patch file, which decompress to
+    `patch_size` bytes.
+
+    """
+
+    def __init__(self,
+                 to_offset,
+                 to_size,
+                 patch_offset,
+                 compressed_size,
+                 patch_size):
+        self.to_offset = to_offset
+        self.to_size = to_size
+        self.patch_offset = patch_offset
+        self.compressed_size = compressed_size
+        self.patch_size = patch_size
+
+def read_segment_index(fpatch, to_size, segment_size):
+    if segment_size <= 0:
+        raise Error('Bad segment size {}.'.format(segment_size))
+
+    number_of_segments = div_ceil(to_size, segment_size)
+    index_size = 2 * SEGMENT_INDEX_SIZE_LENGTH * number_of_segments
+    findex = io.BytesIO(fpatch.read(index_size))
+
+    if len(findex.getbuffer()) != index_size:
+        raise Error('Failed to read the segment index.')
+
+    patch_offset = fpatch.tell()
+    segments = []
+
+    for to_offset in range(0, to_size, segment_size):
+        compressed_size = unpack_size(findex)
+        segments.append(Segment(to_offset,
+                                min(segment_size, to_size - to_offset),
+                                patch_offset,
+                                compressed_size,
+                                unpack_size(findex)))
+        patch_offset += compressed_size
+
+    return segments
+
+def read_header_segmented(fpatch):
+    """Returns the compression, to size, segment size and a list of all
+    segments of given segmented patch.
+
+    """
+
+    _, compression = read_header(fpatch)
+    to_size = unpack_size(fpatch)
+    segment_size = unpack_size(fpatch)
+    segments = read_segment_index(fpatch, to_size, segment_size)
+
+    return compression, to_size, segment_size, segments
+
+def read_header_in_place(fpatch):
+    """Returns the compression, memory size, segment size, shift size,
+    from size, to size and a list of all segments of given in-place
+    patch.
+
+    """
+
+    _, compression = read_header(fpatch)
+    memory_size = unpack_size(fpatch)
+    segment_size = unpack_size(fpatch)
+    shift_size = unpack_size(fpatch)
+    from_size = unpack_size(fpatch)
+    to_size = unpack_size(fpatch)
+    segments = read_segment_index(fpatch, to_size, segment_size)
+
+    return (compression,
+            memory_size,
+            segment_size,
+            shift_size,
+            from_size,
+            to_size,
+            segments)
+
+def apply_patch_hdiffpatch(ffrom, fpatch, fto, applier):
 
     compression, to_size, patch_size = read_header_hdiffpatch(fpatch)
     if to_size == 0:
         return to_size
 
     patch_reader = PatchReader(fpatch, compression)
-    to_data = phdiffpatch.apply_patch(file_read(ffrom),
-                                     patch_reader.read(patch_size))
+    patch_data = bytearray(patch_size)
+    patch_reader.readinto(patch_data)
+    to_data = applier.apply_patch(file_read(ffrom), patch_data)
+    return fto.write(to_data)
+
+def apply_patch_hdiffpatch_mmap(ffrom, fpatch, fto, applier):
+    """Same as apply_patch_hdiffpatch(), but the from and to files are
+    memory mapped instead of read into and written from memory. `fto`
+    must be opened for both reading and writing.
+
+    """
+
+    compression, to_size, patch_size = read_header_hdiffpatch(fpatch)
+    if to_size == 0:
+        return to_size
+
+    patch_reader = PatchReader(fpatch, compression)
+    patch_data = bytearray(patch_size)
+    patch_reader.readinto(patch_data)
+    fto.truncate(to_size)
+
+    with mmap.mmap(fto.fileno(), to_size, access=mmap.ACCESS_WRITE) as to_mmap:
+        if file_size(ffrom) == 0:
+            applier.apply_patch(b'', patch_data, to_mmap)
+        else:
+            with mmap_read_only(ffrom) as from_mmap:
+                applier.apply_patch(from_mmap, patch_data, to_mmap)
+
+        to_mmap.flush()
+
+    return to_size
+
+def read_header_zstd(fpatch):
+    read_header(fpatch)
+    to_size = unpack_size(fpatch)
+    from_size = unpack_size(fpatch)
+
+    return to_size, from_size
+
+def apply_patch_zstd(ffrom, fpatch, fto):
+    """Decompress the to data of a zstd patch-from patch with the from
+    data as dictionary, and write it to `fto` in chunks.
+
+    """
+
+    to_size, from_size = read_header_zstd(fpatch)
+
+    if file_size(ffrom) != from_size:
+        raise Error(
+            'Expected from size {}, but got {}.'.format(from_size,
+                                                        file_size(ffrom)))
+
+    if to_size == 0:
+        return to_size
+
+    with file_data(ffrom) as from_data:
+        patch_reader = PatchReader(fpatch, 'zstd', from_data=from_data)
+        buf = bytearray(min(to_size, ZSTD_WRITE_SIZE))
+        left = to_size
+
+        while left > 0:
+            size = patch_reader.readinto(memoryview(buf)[:min(left,
+                                                              len(buf))])
+            fto.write(memoryview(buf)[:size])
+            left -= size
+
+    return to_size
+
+def apply_patch_whole(ffrom, fpatch, fto, applier):
+    """Apply a patch that is not segmented.
+
+    """
+
+    patch_type = read_patch_type(fpatch)
+
+    if patch_type == PATCH_TYPE_ZSTD:
+        return apply_patch_zstd(ffrom, fpatch, fto)
+    elif patch_type == PATCH_TYPE_IN_PLACE:
+        raise Error(
+            'An in-place patch must be applied with apply_patch_in_place().')
+    elif patch_type == PATCH_TYPE_TRIMMED:
+        return apply_patch_trimmed(ffrom, fpatch, fto, applier)
+    elif patch_type == PATCH_TYPE_SPARSE:
+        return apply_patch_sparse(ffrom, fpatch, fto, applier)
+    else:
+        return apply_patch_hdiffpatch(ffrom, fpatch, fto, applier)
+
+def file_readinto(f, position, buf):
+    f.seek(position, os.SEEK_SET)
+
+    if f.readinto(buf) != len(buf):
+        raise Error('Out of from data.')
+
+    return len(buf)
+
+def apply_patch_hdiffpatch_stream(ffrom, fpatch, fto, applier):
+    """Same as apply_patch_hdiffpatch(), but never reads the from, patch
+    or to data into memory. Only the work cache of `applier` is used
+    by the patch algorithm.
+
+    """
+
+    compression, to_size, patch_size = read_header_hdiffpatch(fpatch)
+    if to_size == 0:
+        return to_size
+
+    patch_stream = PatchStream(fpatch, compression, patch_size)
+
+    return applier.apply_patch_stream(
+        lambda position, buf: file_readinto(ffrom, position, buf),
+        file_size(ffrom),
+        patch_stream.readinto,
+        patch_size,
+        fto.write)
+
+def read_header_trimmed(fpatch):
+    _, compression = read_header(fpatch)
+    to_size = unpack_size(fpatch)
+    prefix_size = unpack_size(fpatch)
+    suffix_size = unpack_size(fpatch)
+    patch_size = unpack_size(fpatch)
+
+    return compression, to_size, prefix_size, suffix_size, patch_size
+
+def copy_from_data(ffrom, offset, size, fto):
+    """Copy `size` bytes at `offset` in the from data to `fto`, one
+    chunk at a time.
+
+    """
+
+    ffrom.seek(offset, os.SEEK_SET)
+    view = memoryview(bytearray(min(size, COPY_SIZE)))
+
+    while size > 0:
+        chunk = view[:min(size, len(view))]
+
+        if ffrom.readinto(chunk) != len(chunk):
+            raise Error('Out of from data.')
+
+        fto.write(chunk)
+        size -= len(chunk)
+
+def apply_patch_trimmed(ffrom, fpatch, fto, applier, streaming=False):
+    """Copy the common prefix from the from data, apply the patch to the
+    from data between the common prefix and suffix, and copy the
+    common suffix. The from data is read in chunks if `streaming` is
+    ``True``, and memory mapped otherwise.
+
+    """
+
+    (compression,
+     to_size,
+     prefix_size,
+     suffix_size,
+     patch_size) = read_header_trimmed(fpatch)
+    from_size = file_size(ffrom)
+
+    if prefix_size + suffix_size > to_size:
+        raise Error(
+            'Corrupt patch: expected to size at least {}, but got '
+            '{}.'.format(prefix_size + suffix_size, to_size))
+
+    if prefix_size + suffix_size > from_size:
+        raise Error(
+            'Expected from size at least {}, but got {}.'.format(
+                prefix_size + suffix_size,
+                from_size))
+
+    from_middle_size = from_size - prefix_size - suffix_size
+    copy_from_data(ffrom, 0, prefix_size, fto)
+
+    if to_size > prefix_size + suffix_size:
+        if streaming:
+            patch_stream = PatchStream(fpatch, compression, patch_size)
+            applier.apply_patch_stream(
+                lambda position, buf: file_readinto(ffrom,
+                                                    prefix_size + position,
+                                                    buf),
+                from_middle_size,
+                patch_stream.readinto,
+                patch_size,
+                fto.write)
+        else:
+            patch_reader = PatchReader(fpatch, compression)
+            patch_data = bytearray(patch_size)
+            patch_reader.readinto(patch_data)
+
+            with file_data(ffrom) as from_data:
+                with memoryview(from_data) as from_view:
+                    fto.write(applier.apply_patch(
+                        from_view[prefix_size:prefix_size + from_middle_size],
+                        patch_data))
+
+    copy_from_data(ffrom, from_size - suffix_size, suffix_size, fto)
+
+    return to_size
+
+def read_header_sparse(fpatch):
+    _, compression = read_header(fpatch)
+    to_size = unpack_size(fpatch)
+    from_extents = unpack_extents(fpatch)
+    to_extents = unpack_extents(fpatch)
+    patch_size = unpack_size(fpatch)
+
+    return compression, to_size, from_extents, to_extents, patch_size
+
+def apply_patch_sparse(ffrom, fpatch, fto, applier):
+    """Apply the patch to the data extents of the from data, and write
+    the to data extents to `fto`, seeking over the gaps between them.
+    Always streams, so that no zero filled data is read or written.
+
+    """
+
+    (compression,
+     to_size,
+     from_extents,
+     to_extents,
+     patch_size) = read_header_sparse(fpatch)
+    from_reader = SparseReader(ffrom, from_extents)
+    to_writer = SparseWriter(fto, to_extents, to_size)
+
+    if to_extents:
+        patch_stream = PatchStream(fpatch, compression, patch_size)
+        applier.apply_patch_stream(from_reader.readinto,
+                                   from_reader.size,
+                                   patch_stream.readinto,
+                                   patch_size,
+                                   to_writer.write)
+
+    to_writer.finish()
+
+    return to_size
+
+def apply_segments(from_data,
+                   fpatch,
+                   compression,
+                   segments,
+                   to_data,
+                   to_offset,
+                   applier,
+                   workers):
+    """Apply given consecutive segments of a segmented patch, writing
+    each to `to_data`, which starts at `to_offset` in the to data.
+
+    The segments are applied on `workers` threads, each with an
+    applier from a new pool, if more than one.
+
+    """
+
+    lock = threading.Lock()
+
+    def apply_segment(applier, segment):
+        with lock:
+            fpatch.seek(segment.patch_offset, os.SEEK_SET)
+            compressed = fpatch.read(segment.compressed_size)
+
+        if len(compressed) != segment.compressed_size:
+            raise Error('Out of patch data.')
+
+        patch_data = bytearray(segment.patch_size)
+        PatchReader(io.BytesIO(compressed), compression).readinto(patch_data)
+        offset = segment.to_offset - to_offset
+
+        with to_view[offset:offset + segment.to_size] as segment_view:
+            applier.apply_patch(from_data, patch_data, segment_view)
+
+    with memoryview(to_data) as to_view:
+        if workers == 1 or len(segments) <= 1:
+            for segment in segments:
+                apply_segment(applier, segment)
+        else:
+            with PatchApplierPool(workers) as pool:
+                def apply_segment_pooled(segment):
+                    with pool.checkout() as applier:
+                        apply_segment(applier, segment)
+
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    list(executor.map(apply_segment_pooled, segments))
+
+def apply_patch_segmented(ffrom, fpatch, fto, applier, workers):
+    compression, to_size, _, segments = read_header_segmented(fpatch)
+    to_data = bytearray(to_size)
+
+    with file_data(ffrom) as from_data:
+        apply_segments(from_data,
+                       fpatch,
+                       compression,
+                       segments,
+                       to_data,
+                       0,
+                       applier,
+                       workers)
+
     return fto.write(to_data)
 
-def apply_patch(fromfile, patchfile, tofile):
+def apply_patch_segmented_mmap(ffrom, fpatch, fto, applier, workers):
+    compression, to_size, _, segments = read_header_segmented(fpatch)
+
+    if to_size == 0:
+        return to_size
+
+    fto.truncate(to_size)
+
+    with mmap.mmap(fto.fileno(), to_size, access=mmap.ACCESS_WRITE) as to_mmap:
+        with file_data(ffrom) as from_data:
+            apply_segments(from_data,
+                           fpatch,
+                           compression,
+                           segments,
+                           to_mmap,
+                           0,
+                           applier,
+                           workers)
+
+        to_mmap.flush()
+
+    return to_size
+
+def apply_patch_segmented_stream(ffrom, fpatch, fto, applier):
+    """Apply one segment at a time. Only the compressed data of the
+    current segment is read into memory.
+
+    """
+
+    compression, to_size, _, segments = read_header_segmented(fpatch)
+    from_size = file_size(ffrom)
+
+    for segment in segments:
+        fpatch.seek(segment.patch_offset, os.SEEK_SET)
+        patch_stream = PatchStream(
+            io.BytesIO(fpatch.read(segment.compressed_size)),
+            compression,
+            segment.patch_size)
+        applier.apply_patch_stream(
+            lambda position, buf: file_readinto(ffrom, position, buf),
+            from_size,
+            patch_stream.readinto,
+            segment.patch_size,
+            fto.write)
+
+    return to_size
+
+def apply_patch(fromfile,
+                patchfile,
+                tofile,
+                streaming=False,
+                cache_size=STREAMING_CACHE_SIZE,
+                use_mmap=False,
+                applier=None,
+                workers=1):
+    """Apply given patch `patchfile` to `fromfile` and write the result to
+    `tofile`. If `streaming` is ``True`` the files are read and
+    written in chunks, using at most `cache_size` bytes of work
+    memory, instead of loading them into memory. If `use_mmap` is
+    ``True`` `fromfile` and `tofile` are memory mapped instead.
+
+    The patch is applied by `applier`, a PatchApplier, reusing its
+    work cache instead of `cache_size`. A new applier is created and
+    closed if ``None``.
+
+    The segments of a segmented patch are applied on `workers`
+    threads, unless streaming.
+
+    """
+
+    if streaming and use_mmap:
+        raise Error('Streaming and memory mapping cannot be combined.')
+
+    if applier is None:
+        if not streaming:
+            cache_size = APPLY_CACHE_SIZE
+
+        with PatchApplier(cache_size) as applier:
+            return apply_patch(fromfile,
+                               patchfile,
+                               tofile,
+                               streaming=streaming,
+                               use_mmap=use_mmap,
+                               applier=applier,
+                               workers=workers)
+
     with open(fromfile, 'rb') as ffrom:
-            with open(patchfile, 'rb') as fpatch:
+        with open(patchfile, 'rb') as fpatch:
+            patch_type = read_patch_type(fpatch)
+
+            if patch_type == PATCH_TYPE_IN_PLACE:
+                raise Error(
+                    'An in-place patch must be applied with '
+                    'apply_patch_in_place().')
+
+            segmented = (patch_type == PATCH_TYPE_SEGMENTED)
+
+            if patch_type == PATCH_TYPE_ZSTD:
+                # Always decompressed in chunks.
+                with open(tofile, 'wb') as fto:
+                    apply_patch_zstd(ffrom, fpatch, fto)
+            elif patch_type == PATCH_TYPE_TRIMMED:
+                # Always written sequentially.
+                with open(tofile, 'wb') as fto:
+                    apply_patch_trimmed(ffrom,
+                                        fpatch,
+                                        fto,
+                                        applier,
+                                        streaming)
+            elif patch_type == PATCH_TYPE_SPARSE:
+                # Always streamed, with holes instead of zeros.
+                with open(tofile, 'wb') as fto:
+                    apply_patch_sparse(ffrom, fpatch, fto, applier)
+            elif use_mmap:
+                with open(tofile, 'w+b') as fto:
+                    if segmented:
+                        apply_patch_segmented_mmap(ffrom,
+                                                   fpatch,
+                                                   fto,
+                                                   applier,
+                                                   workers)
+                    else:
+                        apply_patch_hdiffpatch_mmap(ffrom,
+                                                    fpatch,
+                                                    fto,
+                                                    applier)
+            else:
                 with open(tofile, 'wb') as fto:
-                    apply_patch_hdiffpatch(ffrom, fpatch, fto)
+                    if streaming:
+                        if segmented:
+                            apply_patch_segmented_stream(ffrom,
+                                                         fpatch,
+                                                         fto,
+                                                         applier)
+                        else:
+                            apply_patch_hdiffpatch_stream(ffrom,
+                                                          fpatch,
+                                                          fto,
+                                                          applier)
+                    elif segmented:
+                        apply_patch_segmented(ffrom,
+                                              fpatch,
+                                              fto,
+                                              applier,
+                                              workers)
+                    else:
+                        apply_patch_hdiffpatch(ffrom,
+                                               fpatch,
+                                               fto,
+                                               applier)
+
+def apply_patch_range(fromfile,
+                      patchfile,
+                      offset,
+                      size,
+                      applier=None,
+                      workers=1):
+    """Returns the `size` bytes at `offset` in the to data of given patch
+    `patchfile` applied to `fromfile`. Only the segments of a
+    segmented patch that overlap the range are applied, on `workers`
+    threads, while other patches are applied in full.
+
+    """
+
+    if applier is None:
+        with PatchApplier(APPLY_CACHE_SIZE) as applier:
+            return apply_patch_range(fromfile,
+                                     patchfile,
+                                     offset,
+                                     size,
+                                     applier,
+                                     workers)
+
+    with open(fromfile, 'rb') as ffrom:
+        with open(patchfile, 'rb') as fpatch:
+            segmented = (read_patch_type(fpatch) == PATCH_TYPE_SEGMENTED)
+
+            if not segmented:
+                fto = io.BytesIO()
+                apply_patch_whole(ffrom, fpatch, fto, applier)
+                to_size = fto.tell()
+            else:
+                compression, to_size, segment_size, segments = \
+                    read_header_segmented(fpatch)
+
+            if offset < 0 or size < 0 or offset + size > to_size:
+                raise Error(
+                    'Expected a range within the {} bytes to data, but got '
+                    '{} bytes at offset {}.'.format(to_size, size, offset))
+
+            if size == 0:
+                return b''
+
+            if not segmented:
+                return fto.getvalue()[offset:offset + size]
+
+            segments = segments[offset // segment_size:
+                                (offset + size - 1) // segment_size + 1]
+            to_offset = segments[0].to_offset
+            to_data = bytearray(segments[-1].to_offset
+                                + segments[-1].to_size
+                                - to_offset)
+
+            with file_data(ffrom) as from_data:
+                apply_segments(from_data,
+                               fpatch,
+                               compression,
+                               segments,
+                               to_data,
+                               to_offset,
+                               applier,
+                               workers)
+
+            offset -= to_offset
+
+            return bytes(to_data[offset:offset + size])
+
+
+def shift_from_data(fmem, from_size, shift_size, buf):
+    """Move the from data `shift_size` bytes towards the end of `fmem`,
+    one buffer at a time, starting with the last.
+
+    """
+
+    view = memoryview(buf)
+    end = from_size
+
+    while end > 0:
+        begin = max(end - len(buf), 0)
+        size = end - begin
+        file_readinto(fmem, begin, view[:size])
+        fmem.seek(begin + shift_size, os.SEEK_SET)
+        fmem.write(view[:size])
+        end = begin
+
+def apply_patch_in_place(memfile,
+                         patchfile,
+                         cache_size=STREAMING_CACHE_SIZE,
+                         applier=None):
+    """Apply given in-place patch `patchfile` to the from data in
+    `memfile`, overwriting it with the to data.
+
+    The from data is first shifted towards the end of the memory
+    through a buffer of one segment, and then the to data is written
+    one segment at a time. Apart from the buffer and the compressed
+    data of the current segment, at most `cache_size` bytes of work
+    memory, or the work cache of `applier`, are used.
+
+    """
+
+    if applier is None:
+        with PatchApplier(cache_size) as applier:
+            return apply_patch_in_place(memfile,
+                                        patchfile,
+                                        applier=applier)
+
+    with open(patchfile, 'rb') as fpatch:
+        if read_patch_type(fpatch) != PATCH_TYPE_IN_PLACE:
+            raise Error('Expected an in-place patch.')
+
+        (compression,
+         memory_size,
+         segment_size,
+         shift_size,
+         from_size,
+         to_size,
+         segments) = read_header_in_place(fpatch)
+
+        with open(memfile, 'r+b') as fmem:
+            if file_size(fmem) != from_size:
+                raise Error(
+                    'Expected from size {}, but got {}.'.format(
+                        from_size,
+                        file_size(fmem)))
+
+            if shift_size > 0:
+                shift_from_data(fmem,
+                                from_size,
+                                shift_size,
+                                bytearray(segment_size))
+
+            for i, segment in enumerate(segments):
+                from_offset = shift_size + in_place_from_offset(i,
+                                                                segment_size,
+                                                                shift_size,
+                                                                from_size)
+                to_offset = segment.to_offset
+
+                def write(data):
+                    nonlocal to_offset
+
+                    fmem.seek(to_offset, os.SEEK_SET)
+                    to_offset += fmem.write(data)
+
+                fpatch.seek(segment.patch_offset, os.SEEK_SET)
+                patch_stream = PatchStream(
+                    io.BytesIO(fpatch.read(segment.compressed_size)),
+                    compression,
+                    segment.patch_size)
+                applier.apply_patch_stream(
+                    lambda position, buf: file_readinto(fmem,
+                                                        from_offset + position,
+                                                        buf),
+                    shift_size + from_size - from_offset,
+                    patch_stream.readinto,
+                    segment.patch_size,
+                    write)
+
+            fmem.truncate(to_size)
+
+def read_checkpoint(checkpointfile, patch_digest):
+    """Returns the number of segments applied according to given
+    checkpoint, or zero if missing or not of the patch.
+
+    """
+
+    try:
+        with open(checkpointfile, 'rb') as fin:
+            data = fin.read()
+    except FileNotFoundError:
+        return 0
+
+    if len(data) != struct.calcsize(CHECKPOINT_FORMAT):
+        return 0
+
+    magic, digest, number_of_segments = struct.unpack(CHECKPOINT_FORMAT,
+                                                      data)
+
+    if magic != CHECKPOINT_MAGIC or digest != patch_digest:
+        return 0
+
+    return number_of_segments
+
+def write_checkpoint(checkpointfile, patch_digest, number_of_segments):
+    """Atomically replace given checkpoint.
+
+    """
+
+    tmpfile = checkpointfile + '.tmp'
+
+    with open(tmpfile, 'wb') as fout:
+        fout.write(struct.pack(CHECKPOINT_FORMAT,
+                               CHECKPOINT_MAGIC,
+                               patch_digest,
+                               number_of_segments))
+        fout.flush()
+        os.fsync(fout.fileno())
+
+    os.replace(tmpfile, checkpointfile)
+
+def apply_patch_resumable(fromfile,
+                          patchfile,
+                          tofile,
+                          checkpointfile=None,
+                          applier=None):
+    """Same as apply_patch(), but the patch is applied one segment at a
+    time, and the number of applied segments is saved in
+    `checkpointfile`, ``tofile + '.checkpoint'`` by default, once the
+    segment is synced to `tofile`. If interrupted, calling this
+    function again continues after the last saved segment. The
+    checkpoint is removed once the patch is applied.
+
+    The patch must be a segmented patch, created by create_patch()
+    with a `segment_size`, as the progress of other patches cannot
+    be saved. The segment size is the most work redone when resumed.
+    `fromfile` must not be modified until the patch is applied.
+
+    """
+
+    if checkpointfile is None:
+        checkpointfile = tofile + '.checkpoint'
+
+    if applier is None:
+        with PatchApplier(APPLY_CACHE_SIZE) as applier:
+            return apply_patch_resumable(fromfile,
+                                         patchfile,
+                                         tofile,
+                                         checkpointfile,
+                                         applier)
+
+    with open(fromfile, 'rb') as ffrom:
+        with open(patchfile, 'rb') as fpatch:
+            if read_patch_type(fpatch) != PATCH_TYPE_SEGMENTED:
+                raise Error(
+                    'Only segmented patches, created with a segment size, '
+                    'can be applied resumably.')
+
+            compression, to_size, _, segments = read_header_segmented(fpatch)
+            header_size = fpatch.tell()
+            fpatch.seek(0, os.SEEK_SET)
+            patch_digest = hashlib.sha256(fpatch.read(header_size)).digest()
+            number_of_segments = read_checkpoint(checkpointfile, patch_digest)
+
+            if (number_of_segments > len(segments)
+                or not os.path.exists(tofile)):
+                number_of_segments = 0
+
+            if number_of_segments == 0:
+                mode = 'wb'
+            else:
+                mode = 'r+b'
+
+            with open(tofile, mode) as fto:
+                with file_data(ffrom) as from_data:
+                    for segment in segments[number_of_segments:]:
+                        to_data = bytearray(segment.to_size)
+                        apply_segments(from_data,
+                                       fpatch,
+                                       compression,
+                                       [segment],
+                                       to_data,
+                                       segment.to_offset,
+                                       applier,
+                                       1)
+                        fto.seek(segment.to_offset, os.SEEK_SET)
+                        fto.write(to_data)
+                        fto.flush()
+                        os.fsync(fto.fileno())
+                        number_of_segments += 1
+                        write_checkpoint(checkpointfile,
+                                         patch_digest,
+                                         number_of_segments)
+
+                fto.truncate(to_size)
+
+    if os.path.exists(checkpointfile):
+        os.remove(checkpointfile)
+
+
+class PatchApplierPool(object):
+    """A thread safe pool of at most `size` patch appliers, or any number
+    if ``None``, each keeping a work cache of at most `cache_size`
+    bytes between patches.
+
+    """
+
+    def __init__(self, size=None, cache_size=APPLY_CACHE_SIZE):
+        self._size = size
+        self._cache_size = cache_size
+        self._appliers = []
+        self._number_of_appliers = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def checkout(self):
+        """Check out an applier for use by the calling thread only. Waits
+        for an applier to be returned if all are in use.
+
+        """
+
+        with self._condition:
+            while (not self._appliers
+                   and self._size is not None
+                   and self._number_of_appliers >= self._size):
+                self._condition.wait()
+
+            if self._appliers:
+                applier = self._appliers.pop()
+            else:
+                applier = PatchApplier(self._cache_size)
+                self._number_of_appliers += 1
+
+        try:
+            yield applier
+        finally:
+            with self._condition:
+                self._appliers.append(applier)
+                self._condition.notify()
+
+    def close(self):
+        """Free the work cache of all appliers not in use.
+
+        """
+
+        with self._condition:
+            for applier in self._appliers:
+                applier.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def apply_patches(jobs, workers=None, **kwargs):
+    """Apply one patch per ``(fromfile, patchfile, tofile)`` tuple in
+    `jobs`, using a thread pool of `workers` threads. `kwargs` are
+    passed to apply_patch(). Returns the execution time in seconds of
+    each patch.
+
+    The work cache of each thread is reused for all its patches.
+
+    """
+
+    with PatchApplierPool(workers) as pool:
+        def apply_patch_pooled(*job, **kwargs):
+            with pool.checkout() as applier:
+                apply_patch(*job, applier=applier, **kwargs)
+
+        return run_jobs(apply_patch_pooled, jobs, workers, **kwargs)
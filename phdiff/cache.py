@@ -0,0 +1,389 @@
+"""A content addressed on-disk cache of patches, for servers creating
+patches on demand.
+
+Patches are keyed by the SHA-256 digests of the from and to data and
+the create_patch() parameters that change the patch, including those
+left at their default values. Each patch is
+stored in its own file, written to a temporary file and renamed once
+complete, with the file and the directory synced to disk, so that
+only complete patches are found after a crash. The least recently
+used patches are removed when the total size of the patches exceeds
+the maximum size.
+
+"""
+
+import os
+import json
+import inspect
+import logging
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from concurrent.futures import wait
+from .errors import Error
+from .common import file_data
+from .common import check_cancelled
+from .create import create_patch
+
+
+LOGGER = logging.getLogger(__name__)
+
+PATCH_SUFFIX = '.patch'
+
+TEMPORARY_SUFFIX = '.tmp'
+
+# Seconds between checks of the cancellation of a thread waiting for
+# another thread to create its patch.
+CANCELLED_POLL_INTERVAL = 0.05
+
+# create_patch() parameters that only change how the patch is created,
+# and not the patch, and are therefore not part of the key.
+UNKEYED_PARAMETERS = [
+    'use_mmap',
+    'threads',
+    'zstd_threads',
+    'from_index',
+    'cancelled'
+]
+
+# Default create_patch() keyword arguments, so that a parameter given
+# its default value has the same key as when not given.
+CREATE_PATCH_DEFAULTS = {
+    name: parameter.default
+    for name, parameter in inspect.signature(
+            create_patch).parameters.items()
+    if parameter.default is not inspect.Parameter.empty
+}
+
+
+def file_digest(filename):
+    with open(filename, 'rb') as fin:
+        with file_data(fin) as data:
+            return hashlib.sha256(data).hexdigest()
+
+
+def fsync_directory(directory):
+    """Make renames in given directory durable.
+
+    """
+
+    fd = os.open(directory, os.O_RDONLY)
+
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def close_files(files):
+    for fpatch in files:
+        fpatch.close()
+
+
+class PendingPatch(object):
+    """A patch being created. The future's result is one opened patch
+    file per waiter, or ``None`` if the creator was cancelled.
+
+    """
+
+    def __init__(self):
+        self.future = Future()
+        self.waiters = 0
+
+
+class PatchCache(object):
+    """Patches created by create_patch() stored in `directory`, using at
+    most `maximum_size` bytes. `kwargs` are default create_patch()
+    keyword arguments.
+
+    Concurrent requests for the same patch from threads of one process
+    create it once. If the creating request is cancelled, a waiting
+    request creates the patch instead. Other processes must not share
+    the directory.
+
+    """
+
+    def __init__(self, directory, maximum_size, **kwargs):
+        if maximum_size < 0:
+            raise Error(
+                'Expected a non-negative maximum size, but got {}.'.format(
+                    maximum_size))
+
+        self.directory = directory
+        self.maximum_size = maximum_size
+        self.hits = 0
+        self.misses = 0
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        # Key to patch size, least recently used first.
+        self._entries = OrderedDict()
+        self._size = 0
+        # Key to PendingPatch of patches being created.
+        self._pending = {}
+        # Filename to stat identity and digest.
+        self._digests = {}
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """Add patches left by an earlier instance, ordered by last use,
+        and remove incomplete ones.
+
+        """
+
+        entries = []
+
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+
+            if name.endswith(TEMPORARY_SUFFIX):
+                os.remove(path)
+            elif name.endswith(PATCH_SUFFIX):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime_ns,
+                                name[:-len(PATCH_SUFFIX)],
+                                stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._size += size
+
+        self._evict()
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + PATCH_SUFFIX)
+
+    def _digest(self, filename):
+        """Returns the digest of given file, calculated again only if its
+        size, modification time or inode has changed.
+
+        """
+
+        stat = os.stat(filename)
+        identity = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+        with self._lock:
+            cached = self._digests.get(filename)
+
+        if cached is not None and cached[0] == identity:
+            return cached[1]
+
+        digest = file_digest(filename)
+
+        with self._lock:
+            self._digests[filename] = (identity, digest)
+
+        return digest
+
+    def key(self, fromfile, tofile, compression, **kwargs):
+        """Returns the cache key of the patch from `fromfile` to `tofile`.
+
+        """
+
+        parameters = dict(CREATE_PATCH_DEFAULTS)
+        parameters.update(self._kwargs)
+        parameters.update(kwargs)
+
+        for name in UNKEYED_PARAMETERS:
+            parameters.pop(name, None)
+
+        parameters['compression'] = compression
+        parameters['from'] = self._digest(fromfile)
+        parameters['to'] = self._digest(tofile)
+        encoded = json.dumps(parameters, sort_keys=True).encode('utf-8')
+
+        return hashlib.sha256(encoded).hexdigest()
+
+    def _evict(self):
+        while self._size > self.maximum_size and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            LOGGER.debug('Evicting patch %s of %d bytes.', key, size)
+
+            try:
+                os.remove(self._filename(key))
+            except FileNotFoundError:
+                pass
+
+    def _open_entry(self, key):
+        """Open the patch with given key and mark it as most recently used,
+        or return ``None`` if it is not cached. Must be called with the
+        lock held.
+
+        """
+
+        if key not in self._entries:
+            return None
+
+        filename = self._filename(key)
+
+        try:
+            fpatch = open(filename, 'rb')
+        except FileNotFoundError:
+            self._size -= self._entries.pop(key)
+
+            return None
+
+        self._entries.move_to_end(key)
+        os.utime(filename)
+
+        return fpatch
+
+    def _create(self, key, fromfile, tofile, compression, kwargs, pending):
+        """Create the patch with given key, and return it opened for the
+        caller. The patch is also opened for each waiter, before it is
+        evicted if larger than the cache.
+
+        """
+
+        parameters = dict(self._kwargs)
+        parameters.update(kwargs)
+        fd, tmpfile = tempfile.mkstemp(suffix=TEMPORARY_SUFFIX,
+                                       dir=self.directory)
+        os.close(fd)
+
+        try:
+            create_patch(fromfile, tofile, tmpfile, compression, **parameters)
+
+            with open(tmpfile, 'rb') as fpatch:
+                os.fsync(fpatch.fileno())
+
+            filename = self._filename(key)
+            os.replace(tmpfile, filename)
+            fsync_directory(self.directory)
+        except BaseException:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+
+            raise
+
+        files = []
+
+        with self._lock:
+            self._entries[key] = os.path.getsize(filename)
+            self._size += self._entries[key]
+            del self._pending[key]
+
+            try:
+                for _ in range(pending.waiters + 1):
+                    files.append(open(filename, 'rb'))
+            except BaseException:
+                close_files(files)
+
+                raise
+            finally:
+                self._evict()
+
+            pending.future.set_result(files[1:])
+
+        return files[0]
+
+    def _wait(self, pending, cancelled):
+        """Returns the files opened for the waiters of given patch once
+        created by another thread, or ``None`` if its creator was
+        cancelled.
+
+        """
+
+        if cancelled is not None:
+            while not pending.future.done():
+                wait([pending.future], CANCELLED_POLL_INTERVAL)
+
+                with self._lock:
+                    if not pending.future.done():
+                        try:
+                            check_cancelled(cancelled)
+                        except Error:
+                            pending.waiters -= 1
+
+                            raise
+
+        return pending.future.result()
+
+    def open(self, fromfile, tofile, compression, **kwargs):
+        """Returns the patch from `fromfile` to `tofile` opened for binary
+        reading, created by create_patch() with given arguments if not
+        cached. The returned file remains readable even if the patch is
+        evicted.
+
+        """
+
+        key = self.key(fromfile, tofile, compression, **kwargs)
+        cancelled = kwargs.get('cancelled', self._kwargs.get('cancelled'))
+
+        while True:
+            with self._lock:
+                fpatch = self._open_entry(key)
+
+                if fpatch is not None:
+                    self.hits += 1
+
+                    return fpatch
+
+                pending = self._pending.get(key)
+
+                if pending is None:
+                    self.misses += 1
+                    pending = PendingPatch()
+                    self._pending[key] = pending
+
+                    break
+
+                self.hits += 1
+                pending.waiters += 1
+
+            files = self._wait(pending, cancelled)
+
+            if files is not None:
+                return files.pop()
+
+        try:
+            return self._create(key,
+                                fromfile,
+                                tofile,
+                                compression,
+                                kwargs,
+                                pending)
+        except BaseException as e:
+            with self._lock:
+                self._pending.pop(key, None)
+
+                if not pending.future.done():
+                    # Waiters create the patch themselves if this request
+                    # was cancelled.
+                    if cancelled is not None and cancelled.is_set():
+                        pending.future.set_result(None)
+                    else:
+                        pending.future.set_exception(e)
+
+            raise
+
+    @property
+    def size(self):
+        """The total size in bytes of all cached patches.
+
+        """
+
+        with self._lock:
+            return self._size
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def clear(self):
+        """Remove all cached patches.
+
+        """
+
+        with self._lock:
+            for key in self._entries:
+                try:
+                    os.remove(self._filename(key))
+                except FileNotFoundError:
+                    pass
+
+            self._entries.clear()
+            self._size = 0
@@ -1,4 +1,8 @@
 import os
+import time
+import mmap
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import bitstruct
 from .errors import Error
 from .phdiffpatch import pack_size
@@ -10,6 +14,8 @@ COMPRESSION_BZ2         = 3
 COMPRESSION_HEATSHRINK  = 4
 COMPRESSION_ZSTD        = 5
 COMPRESSION_LZ4         = 6
+COMPRESSION_PLZMA       = 7
+COMPRESSION_PBZ2        = 8
 
 COMPRESSIONS = {
     'none': COMPRESSION_NONE,
@@ -18,9 +24,30 @@ COMPRESSIONS = {
     'bz2': COMPRESSION_BZ2,
     'heatshrink': COMPRESSION_HEATSHRINK,
     'zstd': COMPRESSION_ZSTD,
-    'lz4': COMPRESSION_LZ4
+    'lz4': COMPRESSION_LZ4,
+    'plzma': COMPRESSION_PLZMA,
+    'pbz2': COMPRESSION_PBZ2
 }
 
+PATCH_TYPE_HDIFFPATCH   = 2
+PATCH_TYPE_SEGMENTED    = 3
+PATCH_TYPE_IN_PLACE     = 4
+PATCH_TYPE_ZSTD         = 5
+
+# The last value of the 3 bits patch type field in the header is an
+# escape, followed by the actual patch type as a size. Patch types from
+# this value and up are written this way.
+PATCH_TYPE_EXTENDED     = 7
+PATCH_TYPE_TRIMMED      = 8
+PATCH_TYPE_SPARSE       = 9
+
+# Length of each size in the segment index of a segmented patch. Fixed,
+# so that the index entry of any segment can be found directly.
+SEGMENT_INDEX_SIZE_LENGTH = 10
+
+# Suffix arrays of from data up to this size use 32 bit entries.
+SUFFIX_ARRAY_32_BIT_MAXIMUM_SIZE = 2 ** 31 - 1
+
 DATA_FORMAT_ARM_CORTEX_M4 = 0
 DATA_FORMAT_AARCH64       = 1
 DATA_FORMAT_XTENSA_LX106  = 2
@@ -57,6 +84,26 @@ def div_ceil(a, b):
     return (a + b - 1) // b
 
 
+def available_memory():
+    """Returns the amount of memory in bytes available for new
+    allocations without swapping, or ``None`` if unknown.
+
+    """
+
+    try:
+        with open('/proc/meminfo', 'r') as fin:
+            for line in fin:
+                if line.startswith('MemAvailable:'):
+                    return 1024 * int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
 def file_size(f):
     position = f.tell()
     f.seek(0, os.SEEK_END)
@@ -70,6 +117,32 @@ def file_read(f):
     f.seek(0, os.SEEK_SET)
     return f.read()
 
+
+def mmap_read_only(fin):
+    return mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+@contextmanager
+def file_data(f):
+    """Yield the contents of file object `f`, memory mapped read-only
+    unless empty.
+
+    """
+
+    if file_size(f) == 0:
+        yield b''
+    else:
+        with mmap_read_only(f) as data:
+            yield data
+
+def in_place_from_offset(segment, segment_size, shift_size, from_size):
+    """Returns the offset of the first byte of the from data that is not
+    overwritten once given segment of an in-place patch is written.
+
+    """
+
+    return min(max((segment + 1) * segment_size - shift_size, 0), from_size)
+
 def unpack_size_with_length(fin):
     try:
         byte = fin.read(1)[0]
@@ -97,6 +170,66 @@ def unpack_size_with_length(fin):
 def unpack_size(fin):
     return unpack_size_with_length(fin)[0]
 
+def pack_size_fixed(value, length):
+    """Same as pack_size(), but padded to `length` bytes, so it can be
+    overwritten in place once the actual value is known. Only
+    non-negative values are supported.
+
+    """
+
+    packed = bytearray(length)
+    packed[0] = (0x80 | (value & 0x3f))
+    value >>= 6
+
+    for i in range(1, length):
+        packed[i] = (0x80 | (value & 0x7f))
+        value >>= 7
+
+    if value > 0:
+        raise Error('Size too big.')
+
+    packed[-1] &= 0x7f
+
+    return packed
+
+def run_jobs(function, jobs, workers, **kwargs):
+    """Call `function(*job, **kwargs)` for each job in `jobs` on a thread
+    pool of `workers` threads. Returns the execution time in seconds
+    of each job, in the same order as `jobs`.
+
+    """
+
+    def run(job):
+        start_time = time.time()
+        function(*job, **kwargs)
+
+        return time.time() - start_time
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run, jobs))
+
+def check_cancelled(cancelled):
+    if cancelled.is_set():
+        raise Error('Cancelled.')
+
+class CancellableWriter(object):
+    """A file object writing to `fout`, that raises an error at the next
+    write once `cancelled` is set.
+
+    """
+
+    def __init__(self, fout, cancelled):
+        self._fout = fout
+        self._cancelled = cancelled
+
+    def write(self, data):
+        check_cancelled(self._cancelled)
+
+        return self._fout.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._fout, name)
+
 class DataSegment(object):
 
     def __init__(self,
@@ -0,0 +1,231 @@
+"""Block parallel lzma and bz2.
+
+The data is split into blocks of BLOCK_SIZE bytes that are compressed
+independently on a thread pool, as both lzma and bz2 release the GIL.
+Each compressed block is preceded by an 8 bytes header with its
+decompressed and compressed sizes, and the last block by a header
+with both sizes zero.
+
+The decompressor decompresses up to MAXIMUM_PENDING_BLOCKS blocks
+ahead of the reader.
+
+"""
+
+import os
+import bz2
+import lzma
+import struct
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from ..errors import Error
+
+
+BLOCK_SIZE = 1024 * 1024
+
+BLOCK_HEADER_FORMAT = '<II'
+
+BLOCK_HEADER_SIZE = struct.calcsize(BLOCK_HEADER_FORMAT)
+
+MAXIMUM_PENDING_BLOCKS = 2 * (os.cpu_count() or 1)
+
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def executor():
+    """Returns the thread pool shared by all block compressors and
+    decompressors.
+
+    """
+
+    global _EXECUTOR
+
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ThreadPoolExecutor(
+                thread_name_prefix='phdiff-blocks')
+
+        return _EXECUTOR
+
+
+def lzma_compress(data):
+    return lzma.compress(data, format=lzma.FORMAT_ALONE)
+
+
+def lzma_decompress(data):
+    return lzma.decompress(data, format=lzma.FORMAT_ALONE)
+
+
+CODECS = {
+    'lzma': (lzma_compress, lzma_decompress),
+    'bz2': (bz2.compress, bz2.decompress)
+}
+
+
+def compress_block(compress, data):
+    compressed = compress(data)
+
+    return struct.pack(BLOCK_HEADER_FORMAT,
+                       len(data),
+                       len(compressed)) + compressed
+
+
+def decompress_block(decompress, data, size):
+    decompressed = decompress(data)
+
+    if len(decompressed) != size:
+        raise Error('Expected block size {}, but got {}.'.format(
+            size,
+            len(decompressed)))
+
+    return decompressed
+
+
+class BlockCompressor(object):
+
+    def __init__(self, codec):
+        self._compress = CODECS[codec][0]
+        self._data = bytearray()
+        self._pending = deque()
+
+    def _submit(self, data):
+        self._pending.append(executor().submit(compress_block,
+                                               self._compress,
+                                               data))
+
+    def _completed(self, wait_for_all):
+        compressed = []
+
+        while self._pending:
+            if (not wait_for_all
+                and len(self._pending) < MAXIMUM_PENDING_BLOCKS
+                and not self._pending[0].done()):
+                break
+
+            compressed.append(self._pending.popleft().result())
+
+        return b''.join(compressed)
+
+    def compress(self, data):
+        self._data += data
+
+        while len(self._data) >= BLOCK_SIZE:
+            self._submit(bytes(self._data[:BLOCK_SIZE]))
+            del self._data[:BLOCK_SIZE]
+
+        return self._completed(False)
+
+    def flush(self):
+        if self._data:
+            self._submit(bytes(self._data))
+            self._data = bytearray()
+
+        compressed = self._completed(True)
+
+        return compressed + struct.pack(BLOCK_HEADER_FORMAT, 0, 0)
+
+
+class BlockDecompressor(object):
+
+    def __init__(self, codec):
+        self._decompress = CODECS[codec][1]
+        self._data = bytearray()
+        self._pending = deque()
+        self._output = b''
+        self._output_offset = 0
+        self._finished = False
+
+    def _next_block(self):
+        """Returns the sizes and compressed data of the next block, or
+        ``None`` if not all of it is buffered yet.
+
+        """
+
+        if len(self._data) < BLOCK_HEADER_SIZE:
+            return None
+
+        size, compressed_size = struct.unpack_from(BLOCK_HEADER_FORMAT,
+                                                   self._data)
+        end = BLOCK_HEADER_SIZE + compressed_size
+
+        if len(self._data) < end:
+            return None
+
+        compressed = bytes(self._data[BLOCK_HEADER_SIZE:end])
+        del self._data[:end]
+
+        return size, compressed
+
+    def _submit_blocks(self):
+        while (not self._finished
+               and len(self._pending) < MAXIMUM_PENDING_BLOCKS):
+            block = self._next_block()
+
+            if block is None:
+                break
+
+            size, compressed = block
+
+            if size == 0:
+                self._finished = True
+            else:
+                self._pending.append(executor().submit(decompress_block,
+                                                       self._decompress,
+                                                       compressed,
+                                                       size))
+
+    def _add_input(self, data):
+        if self.eof:
+            raise Error('Already at end of stream.')
+
+        self._data += data
+        self._submit_blocks()
+
+    def _output_left(self):
+        return len(self._output) - self._output_offset
+
+    def decompress(self, data, size):
+        buf = bytearray(size)
+        size = self.decompress_into(data, buf)
+
+        return bytes(buf[:size])
+
+    def decompress_into(self, data, buf):
+        """Decompress into `buf` and return the number of bytes written to
+        it. Waits for the next block if all decompressed data is
+        consumed.
+
+        """
+
+        self._add_input(data)
+        view = memoryview(buf).cast('B')
+        offset = 0
+
+        while offset < len(view):
+            if self._output_left() == 0:
+                if not self._pending:
+                    break
+
+                self._output = self._pending.popleft().result()
+                self._output_offset = 0
+                self._submit_blocks()
+
+            size = min(len(view) - offset, self._output_left())
+            view[offset:offset + size] = memoryview(self._output)[
+                self._output_offset:self._output_offset + size]
+            self._output_offset += size
+            offset += size
+
+        return offset
+
+    @property
+    def needs_input(self):
+        return (not self._finished
+                and len(self._pending) < MAXIMUM_PENDING_BLOCKS)
+
+    @property
+    def eof(self):
+        return (self._finished
+                and not self._pending
+                and self._output_left() == 0)
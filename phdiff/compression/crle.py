@@ -6,6 +6,7 @@ general.
 
 """
 
+import re
 import struct
 from ..errors import Error
 
@@ -15,12 +16,21 @@ MINIMUM_REPEATED_SIZE = 6
 SCATTERED = 0
 REPEATED = 1
 
+# Matches runs of at least MINIMUM_REPEATED_SIZE equal bytes.
+REPEATED_RE = re.compile(b'(.)\\1{%d,}' % (MINIMUM_REPEATED_SIZE - 1),
+                         re.DOTALL)
+
+# Scattered data is normally kept until a repeated segment or the end of
+# the data is found. Longer scattered data is written in multiple
+# segments to bound memory usage.
+MAXIMUM_SCATTERED_SIZE = 1024 * 1024
+
 
 class CrleCompressor(object):
 
     def __init__(self):
-        self._data = b''
-        self._flushing = False
+        self._data = bytearray()
+        self._search_offset = 0
         self._number_of_compressed_bytes = 0
 
     def compress(self, data):
@@ -30,7 +40,7 @@ class CrleCompressor(object):
 
         self._data += data
 
-        return self.compress_segment()
+        return self.compress_segments(False)
 
     def flush(self):
         """Compress and return remaining data.
@@ -41,111 +51,71 @@ class CrleCompressor(object):
             compressed = struct.pack('B', SCATTERED)
             compressed += pack_size(0)
         else:
-            self._flushing = True
-            compressed = []
-
-            while True:
-                chunk = self.compress_segment()
-
-                if not chunk:
-                    break
-
-                compressed.append(chunk)
-
-            compressed = b''.join(compressed)
+            compressed = self.compress_segments(True)
 
         return compressed
 
-    def find_repeated_segment(self):
-        """Find the first repeated segment in the data and return its offset
-        and length. Return ``(None, None)`` if no repeated segment was
-        found.
+    def compress_segments(self, flushing):
+        """Compress all segments known to be complete in a single pass over
+        the data not searched before, and return them.
 
         """
 
-        for offset in range(len(self._data)):
-            byte = self._data[offset]
-            length = 0
-
-            while ((offset + length < len(self._data))
-                   and (byte == self._data[offset + length])):
-                length += 1
-
-            if length >= MINIMUM_REPEATED_SIZE:
-                return offset, length
+        data = self._data
+        compressed = bytearray()
+        offset = 0
 
-        return None, None
+        for mo in REPEATED_RE.finditer(data, self._search_offset):
+            start, end = mo.span()
 
-    def get_segment(self):
-        """Get a segment of scattered or repeated data. Returns the segment
-        kind and data. Returns ``(None, None)`` if no segment was
-        found.
+            if end == len(data) and not flushing:
+                # The repeated segment may continue in the next data.
+                self._search_offset = start
+                break
 
-        """
-
-        offset, length = self.find_repeated_segment()
+            if start > offset:
+                pack_segment(compressed, SCATTERED, data[offset:start])
 
-        if offset is None:
-            if self._flushing:
-                kind = SCATTERED
-                data = self._data
-                self._data = b''
-            else:
-                kind = None
-                data = None
-        elif offset > 0:
-            data = self._data[:offset]
-            self._data = self._data[offset:]
-            kind = SCATTERED
-        elif offset + length < len(self._data) or self._flushing:
-            data = self._data[:length]
-            self._data = self._data[length:]
-            kind = REPEATED
+            pack_segment(compressed,
+                         REPEATED,
+                         data[start:start + 1],
+                         end - start)
+            offset = end
         else:
-            kind = None
-            data = None
+            if flushing:
+                if offset < len(data):
+                    pack_segment(compressed, SCATTERED, data[offset:])
 
-        return kind, data
+                offset = len(data)
 
-    def compress_segment(self):
-        """Compress one segment and return it.
+            # A repeated segment may start in the last few bytes.
+            self._search_offset = max(offset,
+                                      len(data) - MINIMUM_REPEATED_SIZE + 1)
 
-        """
-
-        if len(self._data) == 0:
-            return b''
-
-        kind, data = self.get_segment()
-
-        if kind is None:
-            return b''
-
-        compressed = struct.pack('B', kind)
-        compressed += pack_size(len(data))
-
-        if kind == SCATTERED:
-            compressed += data
-        else:
-            compressed += data[:1]
+        if self._search_offset - offset > MAXIMUM_SCATTERED_SIZE:
+            pack_segment(compressed,
+                         SCATTERED,
+                         data[offset:self._search_offset])
+            offset = self._search_offset
 
+        del data[:offset]
+        self._search_offset -= offset
         self._number_of_compressed_bytes += len(compressed)
 
-        return compressed
+        return bytes(compressed)
 
 
 class CrleDecompressor(object):
 
     def __init__(self, number_of_bytes):
         self._number_of_indata_bytes_left = number_of_bytes
-        self._indata = b''
+        self._indata = bytearray()
+        self._indata_offset = 0
         self._outdata = b''
+        self._outdata_offset = 0
         self._number_of_scattered_bytes_left = 0
 
-    def decompress(self, data, size):
-        """Decompress up to size bytes.
-
-        """
-
+    def _add_input(self, data):
         if self.eof:
             raise Error('Already at end of stream.')
 
@@ -154,45 +124,80 @@ class CrleDecompressor(object):
 
         self._indata += data
         self._number_of_indata_bytes_left -= len(data)
-        self._outdata += self.decompress_segments()
-        data = self._outdata[:size]
-        self._outdata = self._outdata[size:]
+        outdata = self.decompress_segments()
+        del self._indata[:self._indata_offset]
+        self._indata_offset = 0
+
+        if outdata:
+            if self._outdata_offset < len(self._outdata):
+                self._outdata = self._outdata[self._outdata_offset:] + outdata
+            else:
+                self._outdata = outdata
+
+            self._outdata_offset = 0
+
+    def decompress(self, data, size):
+        """Decompress up to size bytes.
+
+        """
+
+        self._add_input(data)
+        end = self._outdata_offset + size
+        data = self._outdata[self._outdata_offset:end]
+        self._outdata_offset += len(data)
 
         return data
 
+    def decompress_into(self, data, buf):
+        """Decompress into `buf` and return the number of bytes written to
+        it.
+
+        """
+
+        self._add_input(data)
+        size = min(len(buf), len(self._outdata) - self._outdata_offset)
+        end = self._outdata_offset + size
+        buf[:size] = memoryview(self._outdata)[self._outdata_offset:end]
+        self._outdata_offset = end
+
+        return size
+
     @property
     def needs_input(self):
-        return len(self._outdata) == 0 and not self.eof
+        return self._outdata_offset == len(self._outdata) and not self.eof
 
     @property
     def eof(self):
         return (self._number_of_indata_bytes_left == 0
-                and len(self._outdata) == 0
-                and len(self._indata) == 0)
+                and self._outdata_offset == len(self._outdata)
+                and self._indata_offset == len(self._indata))
 
     def decompress_segments(self):
-        segments = []
+        segments = bytearray()
 
         try:
             while True:
-                segments.append(self.decompress_segment())
+                self.decompress_segment(segments)
         except IndexError:
             pass
 
-        return b''.join(segments)
+        return bytes(segments)
 
-    def decompress_segment(self):
-        """Try to decompress a segment. Raises IndexError if not enough data
-        is available..
+    def decompress_segment(self, segments):
+        """Try to decompress a segment and append it to `segments`. Raises
+        IndexError if not enough data is available.
 
         """
 
+        indata = self._indata
+        position = self._indata_offset
+
         if self._number_of_scattered_bytes_left == 0:
-            kind = self._indata[0]
+            kind = indata[position]
 
             if kind == SCATTERED:
-                length, offset = unpack_size(self._indata, 1)
-                remaining = (offset + length - len(self._indata))
+                length, offset = unpack_size(indata, position + 1)
+                remaining = (offset + length - len(indata))
 
                 if remaining > 0:
                     self._number_of_scattered_bytes_left = remaining
@@ -200,27 +205,41 @@ class CrleDecompressor(object):
 
                 repetitions = 1
             elif kind == REPEATED:
-                repetitions, offset = unpack_size(self._indata, 1)
+                repetitions, offset = unpack_size(indata, position + 1)
                 length = 1
             else:
                 raise Error(
                     'Expected kind scattered(0) or repeated(1), but got {}.'.format(
                         kind))
-        elif len(self._indata) > 0:
-            length = min(len(self._indata), self._number_of_scattered_bytes_left)
-            offset = 0
+        elif len(indata) > position:
+            length = min(len(indata) - position,
+                         self._number_of_scattered_bytes_left)
+            offset = position
             repetitions = 1
             self._number_of_scattered_bytes_left -= length
         else:
             raise IndexError
 
-        if len(self._indata) < offset + length:
+        if len(indata) < offset + length:
             raise IndexError
 
-        data = repetitions * self._indata[offset:offset + length]
-        self._indata = self._indata[offset + length:]
+        if repetitions == 1:
+            segments += indata[offset:offset + length]
+        else:
+            segments += repetitions * indata[offset:offset + length]
 
-        return data
+        self._indata_offset = offset + length
+
+
+def pack_segment(compressed, kind, data, repetitions=None):
+    compressed.append(kind)
+
+    if kind == SCATTERED:
+        compressed += pack_size(len(data))
+        compressed += data
+    else:
+        compressed += pack_size(repetitions)
+        compressed += data
 
 
 def pack_size(value):
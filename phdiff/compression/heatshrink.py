@@ -44,14 +44,15 @@ class HeatshrinkDecompressor(object):
     def __init__(self, number_of_bytes):
         self._number_of_bytes_left = number_of_bytes
         self._data = b''
+        self._offset = 0
         self._encoder = None
         self.window_sz2 = None
         self.lookahead_sz2 = None
 
-    def decompress(self, data, size):
+    def _add_input(self, data):
         if self._encoder is None:
             if not data:
-                return b''
+                return
 
             self.window_sz2, self.lookahead_sz2 = unpack_header(data[:1])
             self._encoder = Encoder(Reader(window_sz2=self.window_sz2,
@@ -59,23 +60,49 @@ class HeatshrinkDecompressor(object):
             data = data[1:]
             self._number_of_bytes_left -= 1
 
+        decompressed = b''
+
         if self._number_of_bytes_left > 0:
-            self._data += self._encoder.fill(data)
+            decompressed = self._encoder.fill(data)
             self._number_of_bytes_left -= len(data)
 
         if self._number_of_bytes_left == 0:
-            self._data += self._encoder.finish()
+            decompressed += self._encoder.finish()
             self._number_of_bytes_left = -1
 
-        decompressed = self._data[:size]
-        self._data = self._data[size:]
+        if decompressed:
+            if self._offset < len(self._data):
+                self._data = self._data[self._offset:] + decompressed
+            else:
+                self._data = decompressed
+
+            self._offset = 0
+
+    def decompress(self, data, size):
+        self._add_input(data)
+        decompressed = self._data[self._offset:self._offset + size]
+        self._offset += len(decompressed)
 
         return decompressed
 
+    def decompress_into(self, data, buf):
+        """Decompress into `buf` and return the number of bytes written to
+        it.
+
+        """
+
+        self._add_input(data)
+        size = min(len(buf), len(self._data) - self._offset)
+        buf[:size] = memoryview(self._data)[self._offset:self._offset + size]
+        self._offset += size
+
+        return size
+
     @property
     def needs_input(self):
-        return self._data == b'' and not self.eof
+        return self._offset == len(self._data) and not self.eof
 
     @property
     def eof(self):
-        return self._number_of_bytes_left == -1 and self._data == b''
+        return (self._number_of_bytes_left == -1
+                and self._offset == len(self._data))
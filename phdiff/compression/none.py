@@ -19,21 +19,44 @@ class NoneDecompressor(object):
     def __init__(self, number_of_bytes):
         self._number_of_bytes_left = number_of_bytes
         self._data = b''
+        self._offset = 0
 
-    def decompress(self, data, size):
+    def _add_input(self, data):
         if self.eof:
             raise Error('Already at end of stream.')
 
-        self._data += data
-        decompressed = self._data[:size]
-        self._data = self._data[size:]
+        if self._offset < len(self._data):
+            self._data = self._data[self._offset:] + data
+        else:
+            self._data = data
+
+        self._offset = 0
+
+    def decompress(self, data, size):
+        self._add_input(data)
+        decompressed = self._data[self._offset:self._offset + size]
+        self._offset += len(decompressed)
         self._number_of_bytes_left -= len(decompressed)
 
         return decompressed
 
+    def decompress_into(self, data, buf):
+        """Copy data into `buf` and return the number of bytes written to
+        it.
+
+        """
+
+        self._add_input(data)
+        size = min(len(buf), len(self._data) - self._offset)
+        buf[:size] = memoryview(self._data)[self._offset:self._offset + size]
+        self._offset += size
+        self._number_of_bytes_left -= size
+
+        return size
+
     @property
     def needs_input(self):
-        return self._data == b'' and not self.eof
+        return self._offset == len(self._data) and not self.eof
 
     @property
     def eof(self):
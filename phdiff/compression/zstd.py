@@ -1,55 +1,341 @@
 """Zstandard wrapper.
 
+The compressed data starts with a one byte header with the window log
+used by the compressor, followed by a zstd frame. As the header byte
+is never the first byte of the zstd frame magic, data without the
+header created by older versions can still be decompressed.
+
 """
 
-import os
-from io import BytesIO
 import zstandard
 from ..errors import Error
 
 
+# Largest window zstd decompresses without being told, see
+# ZSTD_WINDOWLOG_LIMIT_DEFAULT.
+DEFAULT_WINDOW_LOG = 27
+
+FRAME_MAGIC_FIRST_BYTE = 0x28
+
+# See ZSTD_WINDOWLOG_MIN and ZSTD_WINDOWLOG_MAX_64.
+MINIMUM_WINDOW_LOG = 10
+MAXIMUM_WINDOW_LOG = 31
+
+# Largest hash and chain logs selected for patch-from compression, so
+# that the tables use at most 256 MiB each.
+MAXIMUM_PATCH_FROM_HASH_LOG = 26
+
+# Largest total size of the from and to data of patch-from patches, so
+# that all from data stays in the largest window until the end of the
+# to data.
+MAXIMUM_PATCH_FROM_SIZE = 1 << MAXIMUM_WINDOW_LOG
+
+# Default level of patch-from compression. Fast, as the enlarged hash
+# and chain tables find most matches in the from data anyway.
+PATCH_FROM_LEVEL = 3
+
+
+def pack_header(window_log):
+    return bytes([window_log])
+
+
 class ZstdCompressor(object):
 
-    def __init__(self):
-        self._data = []
+    def __init__(self,
+                 level=22,
+                 threads=0,
+                 window_log=None,
+                 long_distance_matching=False):
+        kwargs = {}
+
+        if window_log is not None:
+            kwargs['window_log'] = window_log
+
+        if long_distance_matching:
+            kwargs['enable_ldm'] = True
+
+        if threads > 0:
+            kwargs['threads'] = threads
+
+        try:
+            params = zstandard.ZstdCompressionParameters.from_level(level,
+                                                                   **kwargs)
+        except zstandard.ZstdError as e:
+            raise Error('Bad zstd parameters: {}.'.format(e))
+
+        self._header = pack_header(params.window_log)
+        self._compressor = zstandard.ZstdCompressor(
+            compression_params=params).compressobj()
 
     def compress(self, data):
-        self._data.append(data)
+        compressed = self._compressor.compress(data)
 
-        return b''
+        if self._header is not None:
+            compressed = (self._header + compressed)
+            self._header = None
+
+        return compressed
 
     def flush(self):
-        return zstandard.ZstdCompressor(level=22).compress(b''.join(self._data))
+        compressed = self._compressor.flush()
+
+        if self._header is not None:
+            compressed = (self._header + compressed)
+            self._header = None
+
+        return compressed
+
+
+def create_dictionary(from_data):
+    """Returns a raw content dictionary of given from data. The zstandard
+    bindings cannot reference a prefix in place, so the dictionary is
+    a copy of all from data.
+
+    """
+
+    return zstandard.ZstdCompressionDict(
+        from_data,
+        dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+
+
+def check_patch_from_sizes(from_size, to_size):
+    if from_size + to_size > MAXIMUM_PATCH_FROM_SIZE:
+        raise Error(
+            'Expected from and to sizes of at most {} bytes in total for '
+            'a zstd patch-from patch, but got {}.'.format(
+                MAXIMUM_PATCH_FROM_SIZE,
+                from_size + to_size))
+
+
+def patch_from_window_log(from_size, to_size):
+    """Returns the smallest window log that keeps all from data in the
+    window until the end of the to data.
+
+    """
+
+    check_patch_from_sizes(from_size, to_size)
+
+    return max((from_size + to_size - 1).bit_length(), MINIMUM_WINDOW_LOG)
+
+
+class ZstdPatchFromCompressor(ZstdCompressor):
+    """Compresses the to data with all from data as a raw content
+    dictionary, so that the to data is encoded as matches in the from
+    data without a separate diff.
+
+    The hash and chain tables are enlarged to about one entry per four
+    bytes of from data, and the strategy is at least greedy, as
+    matches far back in a large dictionary are otherwise rarely found
+    at fast levels.
+
+    The dictionary is a copy of the from data, see create_dictionary(),
+    and the from and to data must fit in the largest window, see
+    check_patch_from_sizes().
+
+    """
+
+    def __init__(self,
+                 from_data,
+                 to_size,
+                 level=PATCH_FROM_LEVEL,
+                 threads=0):
+        window_log = patch_from_window_log(len(from_data), to_size)
+        kwargs = {
+            'window_log': window_log,
+            'enable_ldm': True
+        }
+
+        if threads > 0:
+            kwargs['threads'] = threads
+
+        try:
+            params = zstandard.ZstdCompressionParameters.from_level(
+                level,
+                **kwargs)
+            table_log = min(max(len(from_data).bit_length() - 2,
+                                params.hash_log,
+                                params.chain_log),
+                            MAXIMUM_PATCH_FROM_HASH_LOG)
+            params = zstandard.ZstdCompressionParameters.from_level(
+                level,
+                hash_log=max(params.hash_log, table_log),
+                chain_log=max(params.chain_log, table_log),
+                strategy=max(params.strategy, zstandard.STRATEGY_GREEDY),
+                **kwargs)
+        except zstandard.ZstdError as e:
+            raise Error('Bad zstd parameters: {}.'.format(e))
+
+        self._header = pack_header(window_log)
+        self._compressor = zstandard.ZstdCompressor(
+            dict_data=create_dictionary(from_data),
+            compression_params=params).compressobj(size=to_size)
+
+
+class NeedsInput(Exception):
+    pass
+
+
+class DecompressorInput(object):
+    """Compressed data read by the zstandard stream reader. Raises
+    NeedsInput if empty before all compressed data has been added.
+
+    """
+
+    def __init__(self):
+        self._data = b''
+        self._offset = 0
+        self.finished = False
+
+    def add(self, data):
+        self._data = self._data[self._offset:] + data
+        self._offset = 0
+
+    @property
+    def empty(self):
+        return self._offset == len(self._data)
+
+    def read(self, size):
+        if self.empty:
+            if not self.finished:
+                raise NeedsInput()
+
+            return b''
+
+        data = self._data[self._offset:self._offset + size]
+        self._offset += len(data)
+
+        return data
 
 
 class ZstdDecompressor(object):
+    """Only data not yet consumed is buffered, so memory usage does not
+    grow with the size of the decompressed data. `from_data` is the
+    dictionary of patch-from data, which is copied once decompression
+    starts.
+
+    """
+
+    READ_SIZE = 65536
 
-    def __init__(self, number_of_bytes):
+    def __init__(self, number_of_bytes, from_data=None):
         self._number_of_bytes_left = number_of_bytes
-        self._output_offset = 0
-        self._fout = BytesIO()
-        decompressor = zstandard.ZstdDecompressor()
-        self._decompressor = decompressor.stream_writer(self._fout)
+        self._from_data = from_data
+        self._input = DecompressorInput()
+        self._reader = None
+        self._peeked = b''
+        self._needs_input = (number_of_bytes > 0)
+        self._eof = (number_of_bytes == 0)
+        self.window_log = None
 
-    def decompress(self, data, size):
+    def _add_input(self, data):
         if self.eof:
             raise Error('Already at end of stream.')
 
+        if not data:
+            return
+
         self._number_of_bytes_left -= len(data)
-        self._decompressor.write(data)
+        self._input.finished = (self._number_of_bytes_left <= 0)
+        self._needs_input = False
 
-        self._fout.seek(self._output_offset, os.SEEK_SET)
-        data = self._fout.read(size)
-        self._output_offset += len(data)
-        self._fout.seek(0, os.SEEK_END)
+        if self._reader is None:
+            if data[0] == FRAME_MAGIC_FIRST_BYTE:
+                self.window_log = DEFAULT_WINDOW_LOG
+            else:
+                self.window_log = data[0]
+                data = data[1:]
 
-        return data
+            if self._from_data is None:
+                dict_data = None
+            else:
+                dict_data = create_dictionary(self._from_data)
+                self._from_data = None
+
+            decompressor = zstandard.ZstdDecompressor(
+                dict_data=dict_data,
+                max_window_size=(1 << self.window_log))
+            self._reader = decompressor.stream_reader(
+                self._input,
+                read_size=self.READ_SIZE)
+
+        self._input.add(data)
+
+    def _readinto(self, view):
+        if self._needs_input or self._eof:
+            return 0
+
+        try:
+            size = self._reader.readinto1(view)
+        except NeedsInput:
+            self._needs_input = True
+
+            return 0
+
+        if size == 0:
+            self._eof = True
+
+        return size
+
+    def _fill(self, view):
+        offset = 0
+
+        if self._peeked and len(view) > 0:
+            view[0:1] = self._peeked
+            self._peeked = b''
+            offset = 1
+
+        while offset < len(view):
+            size = self._readinto(view[offset:])
+
+            if size == 0:
+                break
+
+            offset += size
+
+        return offset
+
+    def decompress(self, data, size):
+        self._add_input(data)
+        buf = bytearray(min(size, self.READ_SIZE))
+        chunks = []
+
+        while size > 0:
+            view = memoryview(buf)[:min(size, len(buf))]
+            chunk_size = self._fill(view)
+
+            if chunk_size == 0:
+                break
+
+            chunks.append(bytes(view[:chunk_size]))
+            size -= chunk_size
+
+        return b''.join(chunks)
+
+    def decompress_into(self, data, buf):
+        """Decompress into `buf` and return the number of bytes written to
+        it.
+
+        """
+
+        self._add_input(data)
+
+        return self._fill(memoryview(buf).cast('B'))
 
     @property
     def needs_input(self):
-        return (self._output_offset == self._fout.tell()) and not self.eof
+        return self._needs_input
 
     @property
     def eof(self):
-        return (self._number_of_bytes_left == 0
-                and self._output_offset == self._fout.tell())
+        # End of stream is only known once the reader returns no data,
+        # so read ahead one byte when all compressed data is consumed.
+        if (not self._eof
+            and not self._peeked
+            and self._input.finished
+            and self._input.empty):
+            buf = bytearray(1)
+
+            if self._readinto(buf) == 1:
+                self._peeked = bytes(buf)
+
+        return self._eof and not self._peeked
@@ -1,8 +1,12 @@
+import io
+import os
 import time
 import logging
-import mmap
 import lzma
 from bz2 import BZ2Compressor
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import bitstruct
 from humanfriendly import format_timespan
 from .errors import Error
@@ -10,26 +14,79 @@ from .compression.crle import CrleCompressor
 from .compression.none import NoneCompressor
 from .compression.heatshrink import HeatshrinkCompressor
 from .compression.zstd import ZstdCompressor
+from .compression.zstd import ZstdPatchFromCompressor
+from .compression.zstd import check_patch_from_sizes
+from .compression.zstd import PATCH_FROM_LEVEL
 from .compression.lz4 import Lz4Compressor
+from .compression.blocks import BlockCompressor
 from .common import format_bad_compression_string
+from .common import format_or
+from .common import available_memory
 from .common import compression_string_to_number
 from .common import div_ceil
 from .common import file_size
 from .common import file_read
 from .common import pack_size
+from .common import pack_size_fixed
+from .common import run_jobs
+from .common import CancellableWriter
+from .common import mmap_read_only
+from .common import file_data
+from .common import SUFFIX_ARRAY_32_BIT_MAXIMUM_SIZE
+from .common import PATCH_TYPE_HDIFFPATCH
+from .common import PATCH_TYPE_SEGMENTED
+from .common import PATCH_TYPE_IN_PLACE
+from .common import PATCH_TYPE_ZSTD
+from .common import PATCH_TYPE_EXTENDED
+from .common import PATCH_TYPE_TRIMMED
+from .common import PATCH_TYPE_SPARSE
+from .common import COMPRESSION_ZSTD
+from .common import in_place_from_offset
+from .common import SEGMENT_INDEX_SIZE_LENGTH
+from .index import FromIndex
+from .apply import PatchReader
+from .index import suffix_array_entry_size
+from .sparse import data_extents
+from .sparse import extents_size
+from .sparse import pack_extents
+from .sparse import read_extents
 from . import phdiffpatch
 
 
 LOGGER = logging.getLogger(__name__)
 
+ALGORITHMS = ['suffix-array', 'match-blocks', 'zstd', 'auto']
+
+# Length of the patch size placeholder written before the patch data is
+# created. Enough for any 64 bits size.
+PATCH_SIZE_PLACEHOLDER_LENGTH = 10
+
+# Size of the to data chunks given to the zstd patch-from compressor.
+ZSTD_CHUNK_SIZE = 1024 * 1024
+
+# Number of segments per thread created ahead of the segment written.
+SEGMENTS_PER_THREAD = 2
+
+# Minimum total size of the common prefix and suffix of the from and
+# to data for them to be trimmed before diffing.
+TRIM_MINIMUM_SIZE = 4096
+
 
 def pack_header(patch_type, compression):
-    return bitstruct.pack('p1u3u4', patch_type, compression)
+    if patch_type < PATCH_TYPE_EXTENDED:
+        return bitstruct.pack('p1u3u4', patch_type, compression)
+
+    return (bitstruct.pack('p1u3u4', PATCH_TYPE_EXTENDED, compression)
+            + pack_size(patch_type))
 
 
 def create_compressor(compression,
                       heatshrink_window_sz2,
-                      heatshrink_lookahead_sz2):
+                      heatshrink_lookahead_sz2,
+                      zstd_level=22,
+                      zstd_threads=0,
+                      zstd_window_log=None,
+                      zstd_long_distance_matching=False):
     if compression == 'lzma':
         compressor = lzma.LZMACompressor(format=lzma.FORMAT_ALONE)
     elif compression == 'bz2':
@@ -42,17 +99,51 @@ def create_compressor(compression,
         compressor = HeatshrinkCompressor(heatshrink_window_sz2,
                                           heatshrink_lookahead_sz2)
     elif compression == 'zstd':
-        compressor = ZstdCompressor()
+        compressor = ZstdCompressor(zstd_level,
+                                    zstd_threads,
+                                    zstd_window_log,
+                                    zstd_long_distance_matching)
     elif compression == 'lz4':
         compressor = Lz4Compressor()
+    elif compression == 'plzma':
+        compressor = BlockCompressor('lzma')
+    elif compression == 'pbz2':
+        compressor = BlockCompressor('bz2')
     else:
         raise Error(format_bad_compression_string(compression))
 
     return compressor
 
 
-def mmap_read_only(fin):
-    return mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+def estimate_suffix_array_memory(from_size, to_size):
+    """Returns the approximate peak memory usage in bytes of the suffix
+    array algorithm.
+
+    """
+
+    if from_size <= SUFFIX_ARRAY_32_BIT_MAXIMUM_SIZE:
+        entry_size = 4
+    else:
+        entry_size = 8
+
+    return from_size * (1 + entry_size) + 2 * to_size
+
+
+def select_algorithm(from_size, to_size, memory_size):
+    """Select the suffix array algorithm, which creates smaller patches,
+    if it is estimated to use at most half of `memory_size`, and the
+    bounded memory match blocks algorithm otherwise. The suffix array
+    algorithm is selected if `memory_size` is ``None``.
+
+    """
+
+    if memory_size is None:
+        return 'suffix-array'
+
+    if 2 * estimate_suffix_array_memory(from_size, to_size) <= memory_size:
+        return 'suffix-array'
+    else:
+        return 'match-blocks'
 
 
 def calc_shift(memory_size, segment_size, minimum_shift_size, from_size):
@@ -68,25 +159,339 @@ def calc_shift(memory_size, segment_size, minimum_shift_size, from_size):
     return shift_size
 
 
+# Compressions and parameters tried by automatic compression selection.
+AUTO_CANDIDATES = [
+    ('none', {}),
+    ('crle', {}),
+    ('lz4', {}),
+    ('lzma', {}),
+    ('plzma', {}),
+    ('bz2', {}),
+    ('pbz2', {})
+]
+
+AUTO_CANDIDATES += [
+    ('heatshrink', {
+        'heatshrink_window_sz2': window_sz2,
+        'heatshrink_lookahead_sz2': lookahead_sz2
+    })
+    for window_sz2 in [8, 10, 12]
+    for lookahead_sz2 in [4, 7]
+]
+
+AUTO_CANDIDATES += [
+    ('zstd', {'zstd_level': level}) for level in [3, 9, 19, 22]
+]
+
+
+class CompressionCandidate(object):
+    """Patch data of `patch_size` bytes compressed to `size` bytes with
+    `compression` and `parameters`. `compressed` is the compressed
+    data if kept, and `compression_time` and `decompression_time` are
+    the seconds it took to compress and decompress if measured, and
+    ``None`` otherwise.
+
+    """
+
+    def __init__(self,
+                 compression,
+                 parameters,
+                 size,
+                 patch_size,
+                 compressed=None,
+                 compression_time=None,
+                 decompression_time=None):
+        self.compression = compression
+        self.parameters = parameters
+        self.size = size
+        self.patch_size = patch_size
+        self.compressed = compressed
+        self.compression_time = compression_time
+        self.decompression_time = decompression_time
+
+    @property
+    def decompression_speed(self):
+        """Decompressed bytes per second, or ``None`` if not measured.
+
+        """
+
+        if self.decompression_time is None:
+            return None
+
+        if self.decompression_time == 0:
+            return float('inf')
+
+        return self.patch_size / self.decompression_time
+
+    def is_within_limits(self,
+                         minimum_decompression_speed,
+                         maximum_compression_time):
+        if (maximum_compression_time is not None
+            and self.compression_time > maximum_compression_time):
+            return False
+
+        if (minimum_decompression_speed is not None
+            and self.decompression_speed < minimum_decompression_speed):
+            return False
+
+        return True
+
+
+def compress_candidate(patch, compression, parameters, **zstd_kwargs):
+    heatshrink_window_sz2 = parameters.get('heatshrink_window_sz2', 8)
+    heatshrink_lookahead_sz2 = parameters.get('heatshrink_lookahead_sz2', 7)
+    zstd_kwargs = dict(zstd_kwargs)
+
+    if 'zstd_level' in parameters:
+        zstd_kwargs['zstd_level'] = parameters['zstd_level']
+
+    compressor = create_compressor(compression,
+                                   heatshrink_window_sz2,
+                                   heatshrink_lookahead_sz2,
+                                   **zstd_kwargs)
+
+    return compressor.compress(patch) + compressor.flush()
+
+
+def measure_compressed_size(patch, compression, parameters, **zstd_kwargs):
+    """Returns a candidate with the compressed size only.
+
+    """
+
+    compressed = compress_candidate(patch,
+                                    compression,
+                                    parameters,
+                                    **zstd_kwargs)
+
+    return CompressionCandidate(compression,
+                                parameters,
+                                len(compressed),
+                                len(patch))
+
+
+def evaluate_compression(patch, compression, parameters, **zstd_kwargs):
+    """Returns a candidate with the compressed data and the compression
+    and decompression times.
+
+    """
+
+    start_time = time.time()
+    compressed = compress_candidate(patch,
+                                    compression,
+                                    parameters,
+                                    **zstd_kwargs)
+    compression_time = time.time() - start_time
+
+    start_time = time.time()
+    patch_reader = PatchReader(io.BytesIO(compressed), compression)
+    patch_reader.readinto(bytearray(len(patch)))
+    decompression_time = time.time() - start_time
+
+    return CompressionCandidate(compression,
+                                parameters,
+                                len(compressed),
+                                len(patch),
+                                compressed,
+                                compression_time,
+                                decompression_time)
+
+
+def format_optional(value, fmt, divisor=1):
+    if value is None:
+        return '-'
+
+    return fmt.format(value / divisor)
+
+
+def format_candidates(candidates, selected=None):
+    lines = [
+        '{:12} {:30} {:>10} {:>10} {:>18}'.format('Compression',
+                                                  'Parameters',
+                                                  'Size',
+                                                  'Time [s]',
+                                                  'Decompress [MB/s]')
+    ]
+
+    for candidate in candidates:
+        # Without the compression prefix, as in window_sz2=8.
+        parameters = ', '.join(['{}={}'.format(name.split('_', 1)[1], value)
+                                for name, value
+                                in sorted(candidate.parameters.items())])
+        line = '{:12} {:30} {:>10} {:>10} {:>18}'.format(
+            candidate.compression,
+            parameters or '-',
+            candidate.size,
+            format_optional(candidate.compression_time, '{:.3f}'),
+            format_optional(candidate.decompression_speed,
+                            '{:.1f}',
+                            1000000))
+
+        if candidate is selected:
+            line += ' *'
+
+        lines.append(line)
+
+    return '\n'.join(lines)
+
+
+def select_compression(patch,
+                       minimum_decompression_speed=None,
+                       maximum_compression_time=None,
+                       workers=None,
+                       **zstd_kwargs):
+    """Compress given patch data with all AUTO_CANDIDATES, and return the
+    smallest candidate that compresses in at most
+    `maximum_compression_time` seconds and decompresses at least
+    `minimum_decompression_speed` bytes per second, and all
+    candidates. Either limit is ignored if ``None``.
+
+    The compressed sizes are found on `workers` threads, one per CPU by
+    default. The candidates are then timed one at a time, smallest
+    first, until one is within the limits, so that the times do not
+    depend on the number of workers. Only the compressed data of the
+    selected candidate is kept.
+
+    """
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        candidates = list(executor.map(
+            lambda candidate: measure_compressed_size(patch,
+                                                      *candidate,
+                                                      **zstd_kwargs),
+            AUTO_CANDIDATES))
+
+    selected = None
+    order = sorted(range(len(candidates)),
+                   key=lambda index: candidates[index].size)
+
+    for index in order:
+        candidate = evaluate_compression(patch,
+                                         candidates[index].compression,
+                                         candidates[index].parameters,
+                                         **zstd_kwargs)
+        candidates[index] = candidate
+
+        if candidate.is_within_limits(minimum_decompression_speed,
+                                      maximum_compression_time):
+            selected = candidate
+
+            break
+
+        candidate.compressed = None
+
+    LOGGER.info('Compression candidates:\n%s',
+                format_candidates(candidates, selected))
+
+    if selected is None:
+        raise Error('No compression is within the time and speed limits.')
+
+    return selected, candidates
+
+
+def write_patch_hdiffpatch(fpatch,
+                           to_size,
+                           patch,
+                           compression,
+                           heatshrink_window_sz2,
+                           heatshrink_lookahead_sz2,
+                           selection,
+                           patch_type=PATCH_TYPE_HDIFFPATCH,
+                           header=b'',
+                           **zstd_kwargs):
+    """Compress given patch data and write it to `fpatch`. If
+    `compression` is ``'auto'`` it is selected by select_compression()
+    called with the keyword arguments in `selection`. `header` is
+    written after the to size of trimmed and sparse patches.
+
+    """
+
+    start_time = time.time()
+
+    if compression == 'auto':
+        candidate, _ = select_compression(patch,
+                                          **selection,
+                                          **zstd_kwargs)
+        compression = candidate.compression
+        compressed = candidate.compressed
+        LOGGER.info('Selected %s compression with parameters %s.',
+                    compression,
+                    candidate.parameters)
+    else:
+        compressor = create_compressor(compression,
+                                       heatshrink_window_sz2,
+                                       heatshrink_lookahead_sz2,
+                                       **zstd_kwargs)
+        compressed = compressor.compress(patch) + compressor.flush()
+
+    fpatch.write(pack_header(patch_type,
+                             compression_string_to_number(compression)))
+    fpatch.write(pack_size(to_size))
+    fpatch.write(header)
+    fpatch.write(pack_size(len(patch)))
+    fpatch.write(compressed)
+
+    LOGGER.info('Compression completed in %s.',
+                format_timespan(time.time() - start_time))
+
+
 def create_patch_hdiffpatch_generic(ffrom,
                                     fto,
                                     match_score,
                                     match_block_size,
-                                    use_mmap):
+                                    use_mmap,
+                                    threads=1,
+                                    write=None,
+                                    from_index=None):
     if use_mmap:
         with mmap_read_only(ffrom) as from_mmap:
             with mmap_read_only(fto) as to_mmap:
-                return phdiffpatch.create_patch(from_mmap,
-                                               to_mmap,
-                                               match_score,
-                                               match_block_size,
-                                               2)
+                return create_patch_hdiffpatch_data(from_mmap,
+                                                    to_mmap,
+                                                    match_score,
+                                                    match_block_size,
+                                                    threads,
+                                                    write,
+                                                    from_index)
     else:
-        return phdiffpatch.create_patch(file_read(ffrom),
-                                       file_read(fto),
+        return create_patch_hdiffpatch_data(file_read(ffrom),
+                                            file_read(fto),
+                                            match_score,
+                                            match_block_size,
+                                            threads,
+                                            write,
+                                            from_index)
+
+
+def create_patch_hdiffpatch_data(from_data,
+                                 to_data,
+                                 match_score,
+                                 match_block_size,
+                                 threads,
+                                 write,
+                                 from_index):
+    if from_index is None:
+        return phdiffpatch.create_patch(from_data,
+                                       to_data,
                                        match_score,
                                        match_block_size,
-                                       2)
+                                       2,
+                                       threads,
+                                       write)
+
+    from_index.check(from_data)
+
+    with from_index.suffix_array as suffix_array:
+        return phdiffpatch.create_patch(from_data,
+                                       to_data,
+                                       match_score,
+                                       match_block_size,
+                                       2,
+                                       threads,
+                                       write,
+                                       suffix_array)
 
 
 def create_patch_hdiffpatch(ffrom,
@@ -96,31 +501,31 @@ def create_patch_hdiffpatch(ffrom,
                             match_score=6,
                             use_mmap=True,
                             heatshrink_window_sz2=8,
-                            heatshrink_lookahead_sz2=7):
+                            heatshrink_lookahead_sz2=7,
+                            threads=1,
+                            from_index=None,
+                            selection=None,
+                            **zstd_kwargs):
     start_time = time.time()
     patch = create_patch_hdiffpatch_generic(ffrom,
                                             fto,
                                             match_score,
                                             0,
-                                            2,
-                                            use_mmap)
+                                            use_mmap,
+                                            threads,
+                                            from_index=from_index)
 
-    LOGGER.info('Hdiffpatch algorithm completed in %s.',
+    LOGGER.info('Suffix array algorithm completed in %s.',
                 format_timespan(time.time() - start_time))
 
-    start_time = time.time()
-    compressor = create_compressor(compression,
-                                   heatshrink_window_sz2,
-                                   heatshrink_lookahead_sz2)
-
-    fpatch.write(pack_header(2, compression_string_to_number(compression)))
-    fpatch.write(pack_size(file_size(fto)))
-    fpatch.write(pack_size(len(patch)))
-    fpatch.write(compressor.compress(patch))
-    fpatch.write(compressor.flush())
-
-    LOGGER.info('Compression completed in %s.',
-                format_timespan(time.time() - start_time))
+    write_patch_hdiffpatch(fpatch,
+                           file_size(fto),
+                           patch,
+                           compression,
+                           heatshrink_window_sz2,
+                           heatshrink_lookahead_sz2,
+                           selection,
+                           **zstd_kwargs)
 
 
 def create_patch_match_blocks(ffrom,
@@ -130,7 +535,116 @@ def create_patch_match_blocks(ffrom,
                 match_block_size,
                 use_mmap,
                 heatshrink_window_sz2,
-                heatshrink_lookahead_sz2):
+                heatshrink_lookahead_sz2,
+                selection=None,
+                **zstd_kwargs):
+    """The patch data is compressed and written to `fpatch` in chunks
+    while it is created if `fpatch` is seekable, as the patch size in
+    the header is then written last. The patch data is created in
+    memory if the compression is selected automatically.
+
+    """
+
+    if not fpatch.seekable() or compression == 'auto':
+        create_patch_match_blocks_in_memory(ffrom,
+                                            fto,
+                                            fpatch,
+                                            compression,
+                                            match_block_size,
+                                            use_mmap,
+                                            heatshrink_window_sz2,
+                                            heatshrink_lookahead_sz2,
+                                            selection,
+                                            **zstd_kwargs)
+
+        return
+
+    if use_mmap:
+        with mmap_read_only(ffrom) as from_mmap:
+            with mmap_read_only(fto) as to_mmap:
+                create_patch_match_blocks_data(from_mmap,
+                                               to_mmap,
+                                               fpatch,
+                                               compression,
+                                               match_block_size,
+                                               heatshrink_window_sz2,
+                                               heatshrink_lookahead_sz2,
+                                               **zstd_kwargs)
+    else:
+        create_patch_match_blocks_data(file_read(ffrom),
+                                       file_read(fto),
+                                       fpatch,
+                                       compression,
+                                       match_block_size,
+                                       heatshrink_window_sz2,
+                                       heatshrink_lookahead_sz2,
+                                       **zstd_kwargs)
+
+
+def create_patch_match_blocks_data(from_data,
+                                   to_data,
+                                   fpatch,
+                                   compression,
+                                   match_block_size,
+                                   heatshrink_window_sz2,
+                                   heatshrink_lookahead_sz2,
+                                   patch_type=PATCH_TYPE_HDIFFPATCH,
+                                   to_size=None,
+                                   header=b'',
+                                   **zstd_kwargs):
+    """Diff given data with the match blocks algorithm, compressing and
+    writing the patch data to `fpatch` in chunks. `to_size` defaults
+    to the size of `to_data`, and `header` is written after it, as in
+    write_patch_hdiffpatch().
+
+    """
+
+    start_time = time.time()
+    compressor = create_compressor(compression,
+                                   heatshrink_window_sz2,
+                                   heatshrink_lookahead_sz2,
+                                   **zstd_kwargs)
+
+    if to_size is None:
+        to_size = len(to_data)
+
+    fpatch.write(pack_header(patch_type,
+                             compression_string_to_number(compression)))
+    fpatch.write(pack_size(to_size))
+    fpatch.write(header)
+    patch_size_position = fpatch.tell()
+    fpatch.write(pack_size_fixed(0, PATCH_SIZE_PLACEHOLDER_LENGTH))
+
+    def write(data):
+        fpatch.write(compressor.compress(data))
+
+    patch_size = phdiffpatch.create_patch(from_data,
+                                          to_data,
+                                          0,
+                                          match_block_size,
+                                          2,
+                                          1,
+                                          write)
+    fpatch.write(compressor.flush())
+    end_position = fpatch.tell()
+    fpatch.seek(patch_size_position)
+    fpatch.write(pack_size_fixed(patch_size, PATCH_SIZE_PLACEHOLDER_LENGTH))
+    fpatch.seek(end_position)
+
+    LOGGER.info('Match blocks algorithm and compression completed in %s.',
+                format_timespan(time.time() - start_time))
+
+
+def create_patch_match_blocks_in_memory(ffrom,
+                                        fto,
+                                        fpatch,
+                                        compression,
+                                        match_block_size,
+                                        use_mmap,
+                                        heatshrink_window_sz2,
+                                        heatshrink_lookahead_sz2,
+                                        selection=None,
+                                        **zstd_kwargs):
     start_time = time.time()
     patch = create_patch_hdiffpatch_generic(ffrom,
                                             fto,
@@ -141,37 +655,916 @@ def create_patch_match_blocks(ffrom,
     LOGGER.info('Match blocks algorithm completed in %s.',
                 format_timespan(time.time() - start_time))
 
+    write_patch_hdiffpatch(fpatch,
+                           file_size(fto),
+                           patch,
+                           compression,
+                           heatshrink_window_sz2,
+                           heatshrink_lookahead_sz2,
+                           selection,
+                           **zstd_kwargs)
+
+
+def common_sizes(ffrom, fto):
+    """Returns the sizes of the common prefix and suffix of the from and
+    to data if at least TRIM_MINIMUM_SIZE bytes in total, and ``None``
+    otherwise. The prefix and suffix do not overlap.
+
+    """
+
+    with file_data(ffrom) as from_data:
+        with file_data(fto) as to_data:
+            prefix_size, suffix_size = phdiffpatch.common_sizes(from_data,
+                                                                to_data)
+
+    if prefix_size + suffix_size < TRIM_MINIMUM_SIZE:
+        return None
+
+    return prefix_size, suffix_size
+
+
+def create_patch_trimmed(ffrom,
+                         fto,
+                         fpatch,
+                         compression,
+                         prefix_size,
+                         suffix_size,
+                         algorithm,
+                         match_score,
+                         match_block_size,
+                         heatshrink_window_sz2,
+                         heatshrink_lookahead_sz2,
+                         threads,
+                         selection,
+                         **zstd_kwargs):
+    """Diff the from and to data without their common prefix and suffix,
+    which are instead copied from the from data when the patch is
+    applied. As in create_patch_match_blocks(), the match blocks
+    patch data is compressed and written in chunks while it is
+    created if `fpatch` is seekable and the compression is not
+    selected automatically.
+
+    """
+
+    start_time = time.time()
+    to_size = file_size(fto)
+    header = pack_size(prefix_size) + pack_size(suffix_size)
+    streaming = (algorithm == 'match-blocks'
+                 and fpatch.seekable()
+                 and compression != 'auto')
+
+    if algorithm == 'suffix-array':
+        match_block_size = 0
+    else:
+        match_score = 0
+
+    with file_data(ffrom) as from_data, file_data(fto) as to_data:
+        with memoryview(from_data) as from_view:
+            with memoryview(to_data) as to_view:
+                from_middle = from_view[prefix_size:len(from_view)
+                                        - suffix_size]
+                to_middle = to_view[prefix_size:len(to_view) - suffix_size]
+
+                try:
+                    if streaming:
+                        create_patch_match_blocks_data(
+                            from_middle,
+                            to_middle,
+                            fpatch,
+                            compression,
+                            match_block_size,
+                            heatshrink_window_sz2,
+                            heatshrink_lookahead_sz2,
+                            PATCH_TYPE_TRIMMED,
+                            to_size,
+                            header,
+                            **zstd_kwargs)
+                    else:
+                        patch = phdiffpatch.create_patch(from_middle,
+                                                         to_middle,
+                                                         match_score,
+                                                         match_block_size,
+                                                         2,
+                                                         threads,
+                                                         None)
+                finally:
+                    from_middle.release()
+                    to_middle.release()
+
+    LOGGER.info('Trimmed %d bytes prefix and %d bytes suffix, and diffed '
+                'the rest in %s.',
+                prefix_size,
+                suffix_size,
+                format_timespan(time.time() - start_time))
+
+    if streaming:
+        return
+
+    write_patch_hdiffpatch(fpatch,
+                           to_size,
+                           patch,
+                           compression,
+                           heatshrink_window_sz2,
+                           heatshrink_lookahead_sz2,
+                           selection,
+                           PATCH_TYPE_TRIMMED,
+                           header,
+                           **zstd_kwargs)
+
+
+def create_patch_sparse(ffrom,
+                        fto,
+                        fpatch,
+                        compression,
+                        from_extents,
+                        to_extents,
+                        algorithm,
+                        match_score,
+                        match_block_size,
+                        heatshrink_window_sz2,
+                        heatshrink_lookahead_sz2,
+                        threads,
+                        selection,
+                        **zstd_kwargs):
+    """Diff the concatenated data extents of the from and to data. The
+    zero filled gaps between the extents are never read.
+
+    """
+
     start_time = time.time()
+
+    if algorithm == 'suffix-array':
+        match_block_size = 0
+    else:
+        match_score = 0
+        threads = 1
+
+    patch = phdiffpatch.create_patch(read_extents(ffrom, from_extents),
+                                    read_extents(fto, to_extents),
+                                    match_score,
+                                    match_block_size,
+                                    2,
+                                    threads,
+                                    None)
+
+    LOGGER.info('Diffed %d bytes of from data and %d bytes of to data '
+                'in %s.',
+                extents_size(from_extents),
+                extents_size(to_extents),
+                format_timespan(time.time() - start_time))
+
+    write_patch_hdiffpatch(fpatch,
+                           file_size(fto),
+                           patch,
+                           compression,
+                           heatshrink_window_sz2,
+                           heatshrink_lookahead_sz2,
+                           selection,
+                           PATCH_TYPE_SPARSE,
+                           pack_extents(from_extents)
+                           + pack_extents(to_extents),
+                           **zstd_kwargs)
+
+
+def compress_segment(patch,
+                     compression,
+                     heatshrink_window_sz2,
+                     heatshrink_lookahead_sz2,
+                     **zstd_kwargs):
     compressor = create_compressor(compression,
                                    heatshrink_window_sz2,
-                                   heatshrink_lookahead_sz2)
+                                   heatshrink_lookahead_sz2,
+                                   **zstd_kwargs)
 
-    fpatch.write(pack_header(2, compression_string_to_number(compression)))
-    fpatch.write(pack_size(file_size(fto)))
-    fpatch.write(pack_size(len(patch)))
+    return len(patch), compressor.compress(patch) + compressor.flush()
 
-    fpatch.write(compressor.compress(patch))
-    fpatch.write(compressor.flush())
 
-    LOGGER.info('Compression completed in %s.',
+def write_segments(fpatch, number_of_segments, create_segment, threads):
+    """Write the segment index and the segment patches created by
+    `create_segment(segment)` on up to `threads` threads. The index
+    is written last, so `fpatch` must be seekable.
+
+    At most SEGMENTS_PER_THREAD segments per thread are created ahead
+    of the segment written, so that created segments do not pile up
+    in memory while waiting for an earlier segment.
+
+    """
+
+    index_position = fpatch.tell()
+    fpatch.write(bytes(2 * SEGMENT_INDEX_SIZE_LENGTH * number_of_segments))
+    index = []
+    window = SEGMENTS_PER_THREAD * threads
+    futures = deque()
+    segment = 0
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        try:
+            while futures or segment < number_of_segments:
+                while segment < number_of_segments and len(futures) < window:
+                    futures.append(executor.submit(create_segment, segment))
+                    segment += 1
+
+                patch_size, compressed = futures.popleft().result()
+                fpatch.write(compressed)
+                index.append(pack_size_fixed(len(compressed),
+                                             SEGMENT_INDEX_SIZE_LENGTH))
+                index.append(pack_size_fixed(patch_size,
+                                             SEGMENT_INDEX_SIZE_LENGTH))
+        except BaseException:
+            for future in futures:
+                future.cancel()
+
+            raise
+
+    end_position = fpatch.tell()
+    fpatch.seek(index_position)
+    fpatch.write(b''.join(index))
+    fpatch.seek(end_position)
+
+
+def create_patch_segmented(ffrom,
+                           fto,
+                           fpatch,
+                           compression,
+                           segment_size,
+                           algorithm,
+                           match_score,
+                           match_block_size,
+                           heatshrink_window_sz2,
+                           heatshrink_lookahead_sz2,
+                           threads,
+                           from_index,
+                           **zstd_kwargs):
+    """Create a segmented patch. The to data is split into segments of
+    `segment_size` bytes, each diffed against all from data and
+    compressed on its own, on up to `threads` threads.
+
+    The header is followed by an index with the compressed and
+    decompressed patch size of each segment, and then the compressed
+    segment patches.
+
+    """
+
+    start_time = time.time()
+    compression_number = compression_string_to_number(compression)
+
+    with file_data(ffrom) as from_data:
+        with file_data(fto) as to_data:
+            number_of_segments = div_ceil(len(to_data), segment_size)
+
+            fpatch.write(pack_header(PATCH_TYPE_SEGMENTED,
+                                     compression_number))
+            fpatch.write(pack_size(len(to_data)))
+            fpatch.write(pack_size(segment_size))
+
+            if algorithm == 'suffix-array':
+                if from_index is None:
+                    suffix_array = bytearray(
+                        len(from_data) * suffix_array_entry_size(
+                            len(from_data)))
+                    phdiffpatch.create_suffix_array(from_data,
+                                                    suffix_array,
+                                                    threads)
+                else:
+                    from_index.check(from_data)
+                    suffix_array = from_index.suffix_array
+
+                match_block_size = 0
+            else:
+                suffix_array = None
+                match_score = 0
+
+            def create_segment(segment):
+                offset = segment * segment_size
+
+                with memoryview(to_data)[offset:offset + segment_size] as data:
+                    if suffix_array is None:
+                        patch = phdiffpatch.create_patch(from_data,
+                                                         data,
+                                                         match_score,
+                                                         match_block_size,
+                                                         2)
+                    else:
+                        patch = phdiffpatch.create_patch(from_data,
+                                                         data,
+                                                         match_score,
+                                                         match_block_size,
+                                                         2,
+                                                         1,
+                                                         None,
+                                                         suffix_array)
+
+                return compress_segment(patch,
+                                        compression,
+                                        heatshrink_window_sz2,
+                                        heatshrink_lookahead_sz2,
+                                        **zstd_kwargs)
+
+            try:
+                write_segments(fpatch,
+                               number_of_segments,
+                               create_segment,
+                               threads)
+            finally:
+                if isinstance(suffix_array, memoryview):
+                    suffix_array.release()
+
+    LOGGER.info('Created %d segments in %s.',
+                number_of_segments,
                 format_timespan(time.time() - start_time))
 
+
+def create_patch_in_place(ffrom,
+                          fto,
+                          fpatch,
+                          compression,
+                          memory_size,
+                          segment_size,
+                          minimum_shift_size,
+                          algorithm,
+                          match_score,
+                          match_block_size,
+                          heatshrink_window_sz2,
+                          heatshrink_lookahead_sz2,
+                          threads,
+                          **zstd_kwargs):
+    """Create an in-place patch, applied by overwriting the from data in
+    a memory of `memory_size` bytes.
+
+    The from data is first shifted `shift_size` bytes towards the end
+    of the memory, and then the to data is written from the
+    beginning of the memory, one segment at a time. Each segment is
+    diffed against the from data that is not yet overwritten once
+    the segment is written.
+
+    The header has the memory, segment, shift, from and to sizes,
+    followed by the same segment index and patches as a segmented
+    patch.
+
+    """
+
+    start_time = time.time()
+    compression_number = compression_string_to_number(compression)
+
+    if memory_size % segment_size != 0:
+        raise Error(
+            'Expected memory size {} to be a multiple of segment size '
+            '{}.'.format(memory_size, segment_size))
+
+    if minimum_shift_size is None:
+        minimum_shift_size = 2 * segment_size
+
+    with file_data(ffrom) as from_data:
+        with file_data(fto) as to_data:
+            from_size = len(from_data)
+            to_size = len(to_data)
+            shift_size = calc_shift(memory_size,
+                                    segment_size,
+                                    minimum_shift_size,
+                                    from_size)
+
+            if from_size + shift_size > memory_size:
+                raise Error(
+                    'Expected from size plus shift size {} to fit in '
+                    'memory size {}.'.format(from_size + shift_size,
+                                             memory_size))
+
+            if to_size > memory_size:
+                raise Error(
+                    'Expected to size {} to fit in memory size {}.'.format(
+                        to_size,
+                        memory_size))
+
+            number_of_segments = div_ceil(to_size, segment_size)
+
+            fpatch.write(pack_header(PATCH_TYPE_IN_PLACE,
+                                     compression_number))
+
+            for size in [memory_size,
+                         segment_size,
+                         shift_size,
+                         from_size,
+                         to_size]:
+                fpatch.write(pack_size(size))
+
+            if algorithm == 'suffix-array':
+                match_block_size = 0
+            else:
+                match_score = 0
+
+            def create_segment(segment):
+                offset = segment * segment_size
+                from_offset = in_place_from_offset(segment,
+                                                   segment_size,
+                                                   shift_size,
+                                                   from_size)
+
+                with memoryview(from_data)[from_offset:] as from_view:
+                    with memoryview(to_data)[offset:offset
+                                             + segment_size] as data:
+                        patch = phdiffpatch.create_patch(from_view,
+                                                         data,
+                                                         match_score,
+                                                         match_block_size,
+                                                         2)
+
+                return compress_segment(patch,
+                                        compression,
+                                        heatshrink_window_sz2,
+                                        heatshrink_lookahead_sz2,
+                                        **zstd_kwargs)
+
+            write_segments(fpatch,
+                           number_of_segments,
+                           create_segment,
+                           threads)
+
+    LOGGER.info('Created %d in-place segments with shift size %d in %s.',
+                number_of_segments,
+                shift_size,
+                format_timespan(time.time() - start_time))
+
+
+def create_patch_zstd(ffrom, fto, fpatch, level, threads):
+    """Create a zstd patch-from patch, a zstd frame of the to data
+    compressed with the from data as dictionary. The header has the
+    to and from sizes.
+
+    """
+
+    start_time = time.time()
+
+    with file_data(ffrom) as from_data:
+        with file_data(fto) as to_data:
+            compressor = ZstdPatchFromCompressor(from_data,
+                                                 len(to_data),
+                                                 level,
+                                                 threads)
+            fpatch.write(pack_header(PATCH_TYPE_ZSTD, COMPRESSION_ZSTD))
+            fpatch.write(pack_size(len(to_data)))
+            fpatch.write(pack_size(len(from_data)))
+
+            with memoryview(to_data) as to_view:
+                for offset in range(0, len(to_view), ZSTD_CHUNK_SIZE):
+                    fpatch.write(compressor.compress(
+                        to_view[offset:offset + ZSTD_CHUNK_SIZE]))
+
+            fpatch.write(compressor.flush())
+
+    LOGGER.info('Zstd algorithm completed in %s.',
+                format_timespan(time.time() - start_time))
+
+
 def create_patch(fromfile,
                  tofile,
                  patchfile,
                  compression,
-                 match_block_size,
+                 match_block_size=64,
                  use_mmap=False,
                  heatshrink_window_sz2=8,
-                 heatshrink_lookahead_sz2=7):
-        with open(fromfile, 'rb') as ffrom:
-            with open(tofile, 'rb') as fto:
-                with open(patchfile, 'wb') as fpatch:
+                 heatshrink_lookahead_sz2=7,
+                 threads=1,
+                 algorithm=None,
+                 match_score=6,
+                 zstd_level=None,
+                 zstd_threads=0,
+                 zstd_window_log=None,
+                 zstd_long_distance_matching=False,
+                 from_index=None,
+                 segment_size=None,
+                 memory_size=None,
+                 minimum_shift_size=None,
+                 minimum_decompression_speed=None,
+                 maximum_compression_time=None,
+                 trim=False,
+                 sparse=False,
+                 cancelled=None):
+    """Create a patch from `fromfile` to `tofile` and write it to
+    `patchfile`.
+
+    `algorithm` is ``'suffix-array'``, ``'match-blocks'``, ``'zstd'``
+    or ``'auto'``. The suffix array algorithm creates the smallest
+    patches, and `match_score` tunes how eager it is to use short
+    matches (binary 0-4, text 4-9). The match blocks algorithm uses
+    bounded memory and less time, controlled by `match_block_size`.
+    The zstd algorithm compresses the to data with the from data as
+    dictionary in a single pass, which is fast at its default
+    `zstd_level` of 3, and requires zstd `compression`. The dictionary is a copy of the
+    from data, both when the patch is created and applied, and the
+    from and to data must be at most 2 GiB in total, the largest zstd
+    window.
+    ``'auto'`` selects the suffix array algorithm if it is estimated
+    to fit in available memory. If `algorithm` is ``None`` a
+    `match_block_size` of zero selects the suffix array algorithm.
+
+    The suffix array algorithm searches for matches on up to `threads`
+    threads, and the patch is identical for any number of threads.
+    The suffix array is only sorted on multiple threads if the
+    extension is built with OpenMP, by setting the environment
+    variable PHDIFF_OPENMP=1 when installing, and is otherwise
+    sorted on one thread.
+
+    `from_index` is a FromIndex, or its filename, of `fromfile`
+    created by create_from_index(). The suffix array algorithm then
+    uses its suffix array instead of creating it, which is the most
+    time consuming part of the algorithm.
+
+    The zstd compression level is `zstd_level`, 22 by default except
+    for the zstd algorithm, and it compresses on `zstd_threads` worker
+    threads if non-zero. `zstd_window_log` overrides the window size of
+    the level, and the decompressor needs ``2 ** zstd_window_log`` bytes
+    of memory.
+    `zstd_long_distance_matching` finds matches far back in large
+    windows.
+
+    A segmented patch is created if `segment_size` is not ``None``.
+    The to data is then split into segments of `segment_size` bytes,
+    which are diffed and compressed independently on up to `threads`
+    threads. A segmented patch is slightly larger, but its segments
+    can be applied in parallel, and a range of the to data can be
+    applied on its own with apply_patch_range().
+
+    An in-place patch is created if `memory_size` is not ``None``. It
+    is applied with apply_patch_in_place(), which overwrites the from
+    data with the to data within `memory_size` bytes, buffering at
+    most one segment of `segment_size` bytes at a time. The from data
+    is shifted at least `minimum_shift_size` bytes, two segments by
+    default, before the first segment is written. A larger shift
+    leaves more from data to diff each segment against.
+
+    If `compression` is ``'auto'`` the patch data is compressed with
+    all compressions and a range of their parameters on one thread
+    per CPU. The smallest result that was compressed in at most
+    `maximum_compression_time` seconds, and decompressed at least
+    `minimum_decompression_speed` bytes per second, is written. The
+    times are measured one candidate at a time, see
+    select_compression(). The candidates are logged.
+
+    If `trim` is ``True`` and the from and to data have a common
+    prefix and suffix of at least TRIM_MINIMUM_SIZE bytes in total,
+    only the data between them is diffed, and the prefix and suffix
+    are copied from the from data when the patch is applied. The
+    middle of the to data is then only matched against the middle of
+    the from data. Segmented, in-place and zstd patches, and patches
+    created with a from index, are never trimmed. Trimmed patches are
+    a patch type that earlier versions cannot apply, so trimming is
+    off by default.
+
+    A sparse patch is created if `sparse` is ``True``, for mostly zero
+    filled data such as disk images. Only the data extents of the from
+    and to files, separated by holes and zero runs of at least
+    sparse.MINIMUM_ZERO_SIZE bytes, are read and diffed, and the to
+    data is written with holes instead of zeros when the patch is
+    applied.
+
+    If `cancelled`, a threading.Event, is set while the patch is created,
+    an error is raised at the next chunk of patch data written, and the
+    patch file is left incomplete. The suffix array algorithm and
+    automatic compression selection only write the patch data once it
+    is complete.
+
+    """
+
+    if zstd_level is None:
+        if algorithm == 'zstd':
+            zstd_level = PATCH_FROM_LEVEL
+        else:
+            zstd_level = 22
+
+    zstd_kwargs = {
+        'zstd_level': zstd_level,
+        'zstd_threads': zstd_threads,
+        'zstd_window_log': zstd_window_log,
+        'zstd_long_distance_matching': zstd_long_distance_matching
+    }
+
+    if algorithm is not None and algorithm not in ALGORITHMS:
+        raise Error(
+            "Expected algorithm {}, but got {}.".format(format_or(ALGORITHMS),
+                                                       algorithm))
+
+    if from_index is not None:
+        if algorithm in [None, 'auto']:
+            algorithm = 'suffix-array'
+        elif algorithm != 'suffix-array':
+            raise Error(
+                'A from index can only be used by the suffix-array algorithm.')
+
+    if algorithm is None:
+        if match_block_size == 0:
+            algorithm = 'suffix-array'
+        else:
+            algorithm = 'match-blocks'
+
+    if algorithm == 'zstd':
+        if compression != 'zstd':
+            raise Error('The zstd algorithm requires zstd compression.')
+
+        if segment_size is not None or memory_size is not None:
+            raise Error(
+                'The zstd algorithm cannot create segmented or in-place '
+                'patches.')
+
+    if compression == 'auto':
+        if (algorithm == 'zstd'
+            or segment_size is not None
+            or memory_size is not None):
+            raise Error(
+                'Automatic compression selection cannot be used by zstd, '
+                'segmented or in-place patches.')
+
+    selection = {
+        'minimum_decompression_speed': minimum_decompression_speed,
+        'maximum_compression_time': maximum_compression_time
+    }
+
+    if algorithm == 'match-blocks' and match_block_size <= 0:
+        raise Error(
+            'Expected a positive match block size, but got {}.'.format(
+                match_block_size))
+
+    if segment_size is not None and segment_size <= 0:
+        raise Error(
+            'Expected a positive segment size, but got {}.'.format(
+                segment_size))
+
+    if sparse:
+        if (algorithm == 'zstd'
+            or segment_size is not None
+            or from_index is not None):
+            raise Error(
+                'Sparse patches cannot be zstd, segmented or in-place '
+                'patches, or use a from index.')
+
+    if memory_size is not None:
+        if segment_size is None:
+            raise Error('An in-place patch requires a segment size.')
+
+        if from_index is not None:
+            raise Error('A from index cannot be used by in-place patches.')
+
+    if isinstance(from_index, str):
+        with FromIndex(from_index) as from_index:
+            create_patch(fromfile,
+                         tofile,
+                         patchfile,
+                         compression,
+                         match_block_size,
+                         use_mmap,
+                         heatshrink_window_sz2,
+                         heatshrink_lookahead_sz2,
+                         threads,
+                         algorithm,
+                         match_score,
+                         from_index=from_index,
+                         segment_size=segment_size,
+                         minimum_decompression_speed=minimum_decompression_speed,
+                         maximum_compression_time=maximum_compression_time,
+                         trim=trim,
+                         cancelled=cancelled,
+                         **zstd_kwargs)
+
+        return
+
+    with open(fromfile, 'rb') as ffrom:
+        with open(tofile, 'rb') as fto:
+            trimmed = None
+            from_size = file_size(ffrom)
+            to_size = file_size(fto)
+
+            if sparse:
+                from_extents = data_extents(ffrom)
+                to_extents = data_extents(fto)
+                from_size = extents_size(from_extents)
+                to_size = extents_size(to_extents)
+            elif (trim
+                  and algorithm != 'zstd'
+                  and segment_size is None
+                  and from_index is None):
+                trimmed = common_sizes(ffrom, fto)
+
+                if trimmed is not None:
+                    from_size -= sum(trimmed)
+                    to_size -= sum(trimmed)
+
+            if algorithm == 'zstd':
+                check_patch_from_sizes(from_size, to_size)
+
+            if algorithm == 'auto':
+                # Only trimmed or sparse data is diffed.
+                algorithm = select_algorithm(from_size,
+                                             to_size,
+                                             available_memory())
+                LOGGER.info('Selected the %s algorithm.', algorithm)
+
+            with open(patchfile, 'wb') as fpatch:
+                if cancelled is not None:
+                    fpatch = CancellableWriter(fpatch, cancelled)
+
+                if algorithm == 'zstd':
+                    create_patch_zstd(ffrom,
+                                      fto,
+                                      fpatch,
+                                      zstd_level,
+                                      zstd_threads)
+                elif memory_size is not None:
+                    create_patch_in_place(ffrom,
+                                          fto,
+                                          fpatch,
+                                          compression,
+                                          memory_size,
+                                          segment_size,
+                                          minimum_shift_size,
+                                          algorithm,
+                                          match_score,
+                                          match_block_size,
+                                          heatshrink_window_sz2,
+                                          heatshrink_lookahead_sz2,
+                                          threads,
+                                          **zstd_kwargs)
+                elif segment_size is not None:
+                    create_patch_segmented(ffrom,
+                                           fto,
+                                           fpatch,
+                                           compression,
+                                           segment_size,
+                                           algorithm,
+                                           match_score,
+                                           match_block_size,
+                                           heatshrink_window_sz2,
+                                           heatshrink_lookahead_sz2,
+                                           threads,
+                                           from_index,
+                                           **zstd_kwargs)
+                elif sparse:
+                    create_patch_sparse(ffrom,
+                                        fto,
+                                        fpatch,
+                                        compression,
+                                        from_extents,
+                                        to_extents,
+                                        algorithm,
+                                        match_score,
+                                        match_block_size,
+                                        heatshrink_window_sz2,
+                                        heatshrink_lookahead_sz2,
+                                        threads,
+                                        selection,
+                                        **zstd_kwargs)
+                elif trimmed is not None:
+                    create_patch_trimmed(ffrom,
+                                         fto,
+                                         fpatch,
+                                         compression,
+                                         trimmed[0],
+                                         trimmed[1],
+                                         algorithm,
+                                         match_score,
+                                         match_block_size,
+                                         heatshrink_window_sz2,
+                                         heatshrink_lookahead_sz2,
+                                         threads,
+                                         selection,
+                                         **zstd_kwargs)
+                elif algorithm == 'suffix-array':
+                    create_patch_hdiffpatch(ffrom,
+                                            fto,
+                                            fpatch,
+                                            compression,
+                                            match_score=match_score,
+                                            use_mmap=use_mmap,
+                                            heatshrink_window_sz2=heatshrink_window_sz2,
+                                            heatshrink_lookahead_sz2=heatshrink_lookahead_sz2,
+                                            threads=threads,
+                                            from_index=from_index,
+                                            selection=selection,
+                                            **zstd_kwargs)
+                else:
                     create_patch_match_blocks(ffrom,
-                                 fto,
-                                 fpatch,
-                                 compression,
-                                 match_block_size,
-                                 use_mmap,
-                                 heatshrink_window_sz2,
-                                 heatshrink_lookahead_sz2)
+                                              fto,
+                                              fpatch,
+                                              compression,
+                                              match_block_size,
+                                              use_mmap,
+                                              heatshrink_window_sz2,
+                                              heatshrink_lookahead_sz2,
+                                              selection,
+                                              **zstd_kwargs)
+
+
+def create_patches(pairs, workers=None, **kwargs):
+    """Create one patch per ``(fromfile, tofile, patchfile)`` tuple in
+    `pairs`, using a thread pool of `workers` threads. `kwargs` are
+    passed to create_patch(). Returns the execution time in seconds
+    of each patch.
+
+    """
+
+    return run_jobs(create_patch, pairs, workers, **kwargs)
+
+
+class FleetPatch(object):
+    """A patch created by create_patches_to().
+
+    """
+
+    def __init__(self, fromfile, patchfile, patch_size, elapsed):
+        self.fromfile = fromfile
+        self.patchfile = patchfile
+        self.patch_size = patch_size
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        return 'FleetPatch(fromfile={!r}, patchfile={!r}, ' \
+               'patch_size={}, elapsed={:.3f})'.format(self.fromfile,
+                                                       self.patchfile,
+                                                       self.patch_size,
+                                                       self.elapsed)
+
+
+@contextmanager
+def open_data(filename):
+    with open(filename, 'rb') as fin:
+        with file_data(fin) as data:
+            yield data
+
+
+def fleet_patch_filename(outdir, fromfile):
+    return os.path.join(outdir, os.path.basename(fromfile) + '.patch')
+
+
+def create_patches_to(tofile,
+                      fromfiles,
+                      outdir,
+                      compression,
+                      workers=None,
+                      match_block_size=64,
+                      heatshrink_window_sz2=8,
+                      heatshrink_lookahead_sz2=7,
+                      zstd_level=22,
+                      zstd_threads=0,
+                      zstd_window_log=None,
+                      zstd_long_distance_matching=False):
+    """Create one patch from each file in `fromfiles` to `tofile` with
+    the match blocks algorithm, on a thread pool of `workers` threads.
+    The patch from ``<dir>/<name>`` is written to
+    ``<outdir>/<name>.patch``.
+
+    `tofile` is memory mapped once and the mapping is shared by all
+    threads, which create patches in parallel as the algorithm runs
+    without holding the GIL. Returns a FleetPatch per from file, in
+    the same order as `fromfiles`.
+
+    """
+
+    zstd_kwargs = {
+        'zstd_level': zstd_level,
+        'zstd_threads': zstd_threads,
+        'zstd_window_log': zstd_window_log,
+        'zstd_long_distance_matching': zstd_long_distance_matching
+    }
+
+    if match_block_size <= 0:
+        raise Error(
+            'Expected a positive match block size, but got {}.'.format(
+                match_block_size))
+
+    compression_string_to_number(compression)
+    patchfiles = [
+        fleet_patch_filename(outdir, fromfile) for fromfile in fromfiles
+    ]
+
+    if len(set(patchfiles)) != len(patchfiles):
+        raise Error('Expected from files with unique names.')
+
+    os.makedirs(outdir, exist_ok=True)
+
+    def create(fromfile, patchfile):
+        start_time = time.time()
+
+        with open_data(fromfile) as from_data:
+            with open(patchfile, 'wb') as fpatch:
+                create_patch_match_blocks_data(from_data,
+                                               to_data,
+                                               fpatch,
+                                               compression,
+                                               match_block_size,
+                                               heatshrink_window_sz2,
+                                               heatshrink_lookahead_sz2,
+                                               **zstd_kwargs)
+                patch_size = fpatch.tell()
+
+        fleet_patch = FleetPatch(fromfile,
+                                 patchfile,
+                                 patch_size,
+                                 time.time() - start_time)
+        LOGGER.info('Created %s of %d bytes in %s.',
+                    patchfile,
+                    patch_size,
+                    format_timespan(fleet_patch.elapsed))
+
+        return fleet_patch
+
+    with open_data(tofile) as to_data:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(create, fromfiles, patchfiles))
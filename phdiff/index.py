@@ -0,0 +1,171 @@
+"""A from index is the suffix array of a from image saved to a file, so
+that the suffix array algorithm does not create it again for each
+patch from the same image.
+
+The file starts with a 64 bytes header followed by the suffix array,
+with 32 bits entries if the from image is at most 2 GiB - 1 bytes and
+64 bits entries otherwise.
+
+"""
+
+import sys
+import mmap
+import struct
+import hashlib
+from .errors import Error
+from .common import file_size
+from .common import mmap_read_only
+from .common import SUFFIX_ARRAY_32_BIT_MAXIMUM_SIZE
+from . import phdiffpatch
+
+
+MAGIC = b'PHDIFFIX'
+
+VERSION = 1
+
+HEADER_SIZE = 64
+
+# Magic, version, entry size, byte order (0 little and 1 big endian),
+# from size and from SHA-256 digest.
+HEADER_FORMAT = '<8sIBBQ32s'
+
+BYTE_ORDERS = ['little', 'big']
+
+
+def suffix_array_entry_size(from_size):
+    if from_size <= SUFFIX_ARRAY_32_BIT_MAXIMUM_SIZE:
+        return 4
+    else:
+        return 8
+
+
+def pack_header(entry_size, from_size, from_digest):
+    header = struct.pack(HEADER_FORMAT,
+                         MAGIC,
+                         VERSION,
+                         entry_size,
+                         BYTE_ORDERS.index(sys.byteorder),
+                         from_size,
+                         from_digest)
+
+    return header.ljust(HEADER_SIZE, b'\x00')
+
+
+def unpack_header(data):
+    if len(data) < HEADER_SIZE:
+        raise Error('Failed to read the from index header.')
+
+    (magic,
+     version,
+     entry_size,
+     byte_order,
+     from_size,
+     from_digest) = struct.unpack_from(HEADER_FORMAT, data)
+
+    if magic != MAGIC:
+        raise Error('Not a from index.')
+
+    if version != VERSION:
+        raise Error(
+            'Expected from index version {}, but got {}.'.format(VERSION,
+                                                                 version))
+
+    if BYTE_ORDERS[byte_order] != sys.byteorder:
+        raise Error('From index byte order mismatch.')
+
+    if entry_size != suffix_array_entry_size(from_size):
+        raise Error('Bad from index entry size {}.'.format(entry_size))
+
+    return from_size, from_digest
+
+
+def digest(data):
+    return hashlib.sha256(data).digest()
+
+
+class FromIndex(object):
+    """A from index file `filename`, memory mapped read-only. Create it
+    with create_from_index().
+
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as fin:
+            self._mmap = mmap_read_only(fin)
+
+        try:
+            self.from_size, self.from_digest = unpack_header(self._mmap)
+            size = self.from_size * suffix_array_entry_size(self.from_size)
+
+            if len(self._mmap) != HEADER_SIZE + size:
+                raise Error('Truncated from index.')
+        except Exception:
+            self._mmap.close()
+            raise
+
+        self.filename = filename
+
+    @property
+    def suffix_array(self):
+        """A memoryview of the suffix array, which must be released before
+        the index is closed.
+
+        """
+
+        return memoryview(self._mmap)[HEADER_SIZE:]
+
+    def check(self, from_data):
+        """Raise an error if this is not the index of `from_data`.
+
+        """
+
+        if (len(from_data) != self.from_size
+            or digest(from_data) != self.from_digest):
+            raise Error(
+                "From index '{}' does not match the from data.".format(
+                    self.filename))
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def create_from_index(fromfile, indexfile, threads=1):
+    """Create the suffix array of `fromfile` on up to `threads` threads
+    and save it in `indexfile`. Returns the index as a FromIndex.
+
+    """
+
+    with open(fromfile, 'rb') as ffrom:
+        from_size = file_size(ffrom)
+
+        if from_size == 0:
+            write_from_index(b'', indexfile, threads)
+        else:
+            with mmap_read_only(ffrom) as from_data:
+                write_from_index(from_data, indexfile, threads)
+
+    return FromIndex(indexfile)
+
+
+def write_from_index(from_data, indexfile, threads):
+    entry_size = suffix_array_entry_size(len(from_data))
+
+    with open(indexfile, 'w+b') as findex:
+        findex.write(pack_header(entry_size,
+                                 len(from_data),
+                                 digest(from_data)))
+        findex.truncate(HEADER_SIZE + len(from_data) * entry_size)
+
+        with mmap.mmap(findex.fileno(), 0) as index_mmap:
+            with memoryview(index_mmap)[HEADER_SIZE:] as suffix_array:
+                phdiffpatch.create_suffix_array(from_data,
+                                                suffix_array,
+                                                threads)
+
+            index_mmap.flush()
@@ -1,7 +1,19 @@
 from .apply import read_header_hdiffpatch
+from .apply import read_header_segmented
+from .apply import read_header_in_place
+from .apply import read_header_zstd
+from .apply import read_header_trimmed
+from .apply import read_header_sparse
+from .apply import read_patch_type
 from .apply import PatchReader
 from .common import file_size
+from .common import PATCH_TYPE_SEGMENTED
+from .common import PATCH_TYPE_IN_PLACE
+from .common import PATCH_TYPE_ZSTD
+from .common import PATCH_TYPE_TRIMMED
+from .common import PATCH_TYPE_SPARSE
 from .compression.heatshrink import HeatshrinkDecompressor
+from .compression.zstd import ZstdDecompressor
 
 
 def _compression_info(patch_reader):
@@ -15,6 +27,10 @@ def _compression_info(patch_reader):
                 'window-sz2': decompressor.window_sz2,
                 'lookahead-sz2': decompressor.lookahead_sz2
             }
+        elif isinstance(decompressor, ZstdDecompressor):
+            info = {
+                'window-log': decompressor.window_log
+            }
 
     return info
 
@@ -26,6 +42,8 @@ def patch_info_hdiffpatch(fpatch):
 
     if to_size > 0:
         patch_reader = PatchReader(fpatch, compression)
+        # Compression parameters are read from the compressed data.
+        patch_reader.read(1)
 
     return (patch_size,
             compression,
@@ -33,11 +51,103 @@ def patch_info_hdiffpatch(fpatch):
             to_size)
 
 
+def patch_info_segmented(fpatch):
+    """The segments are read from the index only, without decompressing
+    any patch data.
+
+    """
+
+    patch_size = file_size(fpatch)
+    compression, to_size, segment_size, segments = \
+        read_header_segmented(fpatch)
+
+    return (patch_size,
+            compression,
+            to_size,
+            segment_size,
+            segments)
+
+
+def patch_info_trimmed(fpatch):
+    patch_size = file_size(fpatch)
+    (compression,
+     to_size,
+     prefix_size,
+     suffix_size,
+     _) = read_header_trimmed(fpatch)
+    patch_reader = None
+
+    if to_size > prefix_size + suffix_size:
+        patch_reader = PatchReader(fpatch, compression)
+        patch_reader.read(1)
+
+    return (patch_size,
+            compression,
+            _compression_info(patch_reader),
+            to_size,
+            prefix_size,
+            suffix_size)
+
+
+def patch_info_sparse(fpatch):
+    patch_size = file_size(fpatch)
+    (compression,
+     to_size,
+     from_extents,
+     to_extents,
+     _) = read_header_sparse(fpatch)
+    patch_reader = None
+
+    if to_extents:
+        patch_reader = PatchReader(fpatch, compression)
+        patch_reader.read(1)
+
+    return (patch_size,
+            compression,
+            _compression_info(patch_reader),
+            to_size,
+            from_extents,
+            to_extents)
+
+
+def patch_info_in_place(fpatch):
+    patch_size = file_size(fpatch)
+
+    return (patch_size, ) + read_header_in_place(fpatch)
+
+
+def patch_info_zstd(fpatch):
+    patch_size = file_size(fpatch)
+    to_size, from_size = read_header_zstd(fpatch)
+    window_log = None
+
+    if patch_size > fpatch.tell():
+        window_log = fpatch.read(1)[0]
+
+    return (patch_size,
+            'zstd',
+            {'window-log': window_log},
+            to_size,
+            from_size)
+
+
 def patch_info(fpatch):
-    return 'hdiffpatch', patch_info_hdiffpatch(fpatch)
+    patch_type = read_patch_type(fpatch)
 
+    if patch_type == PATCH_TYPE_SEGMENTED:
+        return 'segmented', patch_info_segmented(fpatch)
+    elif patch_type == PATCH_TYPE_IN_PLACE:
+        return 'in-place', patch_info_in_place(fpatch)
+    elif patch_type == PATCH_TYPE_ZSTD:
+        return 'zstd', patch_info_zstd(fpatch)
+    elif patch_type == PATCH_TYPE_TRIMMED:
+        return 'trimmed', patch_info_trimmed(fpatch)
+    elif patch_type == PATCH_TYPE_SPARSE:
+        return 'sparse', patch_info_sparse(fpatch)
+    else:
+        return 'hdiffpatch', patch_info_hdiffpatch(fpatch)
 
 
-def patch_info_filename(patchfile, fsize=None):
+def patch_info_filename(patchfile):
     with open(patchfile, 'rb') as fpatch:
-        return patch_info(fpatch, fsize)
+        return patch_info(fpatch)
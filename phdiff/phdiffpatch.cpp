@@ -1,12 +1,18 @@
 #include <Python.h>
+#include <string>
 #include "HDiffPatch/libHDiffPatch/HDiff/diff.h"
 #include "HDiffPatch/libHDiffPatch/HPatch/patch.h"
 #include "HDiffPatch/file_for_patch.h"
 #include "HDiffPatch/libHDiffPatch/HDiff/private_diff/libdivsufsort/divsufsort.h"
+#include "HDiffPatch/libHDiffPatch/HDiff/private_diff/libdivsufsort/divsufsort64.h"
+
+/* Suffix arrays of bigger data have 64 bits entries, as in HDiffPatch. */
+#define SUFFIX_ARRAY_32_BIT_MAXIMUM_SIZE  ((Py_ssize_t)0x7fffffff)
 
 typedef int32_t (*create_t)(const uint8_t *buf_p,
                             int32_t *suffix_array_p,
-                            int32_t length);
+                            int32_t length,
+                            int threads);
 
 static PyObject *create(PyObject *self_p,
                         PyObject* args_p,
@@ -18,11 +24,14 @@ static PyObject *create(PyObject *self_p,
     PyObject *from_p;
     PyObject *suffix_array_buffer_p;
     int32_t *suffix_array_p;
+    int threads;
 
+    threads = 1;
     res = PyArg_ParseTuple(args_p,
-                           "OO",
+                           "OO|i",
                            &from_p,
-                           &suffix_array_buffer_p);
+                           &suffix_array_buffer_p,
+                           &threads);
 
     if (res == 0) {
         return (NULL);
@@ -46,10 +55,14 @@ static PyObject *create(PyObject *self_p,
     suffix_array_p = (int32_t *)suffix_array_view.buf;
     suffix_array_p[0] = (int32_t)from_view.len;
 
-    /* Execute the SA-IS algorithm. */
+    /* Execute the SA-IS algorithm. Both buffers are pinned by their
+       views, so other threads may run meanwhile. */
+    Py_BEGIN_ALLOW_THREADS
     res = create_callback((uint8_t *)from_view.buf,
                           &suffix_array_p[1],
-                          (int32_t)from_view.len);
+                          (int32_t)from_view.len,
+                          threads);
+    Py_END_ALLOW_THREADS
 
     if (res != 0) {
         goto err2;
@@ -72,7 +85,257 @@ static PyObject *create(PyObject *self_p,
 
 static PyObject *m_divsufsort(PyObject *self_p, PyObject* args_p)
 {
-    return (create(self_p, args_p, divsufsort));
+    return (create(self_p, args_p, divsufsort_mt));
+}
+
+static Py_ssize_t suffix_array_entry_size(Py_ssize_t size)
+{
+    if (size > SUFFIX_ARRAY_32_BIT_MAXIMUM_SIZE) {
+        return (8);
+    } else {
+        return (4);
+    }
+}
+
+/**
+ * Check that given suffix array buffer has room for the suffix array
+ * of from data of given size. Returns 0 if so, or -1 with an exception
+ * set.
+ */
+static int check_suffix_array_size(Py_buffer *suffix_array_view_p,
+                                   Py_ssize_t from_size)
+{
+    Py_ssize_t size;
+
+    size = from_size * suffix_array_entry_size(from_size);
+
+    if (suffix_array_view_p->len != size) {
+        PyErr_Format(PyExc_ValueError,
+                     "Expected suffix array size %zd, but got %zd.",
+                     size,
+                     suffix_array_view_p->len);
+
+        return (-1);
+    }
+
+    return (0);
+}
+
+/**
+ * def create_suffix_array(from_data, suffix_array, threads=1)
+ *
+ * Write the suffix array of from_data to the writable buffer
+ * suffix_array, with 32 bits entries if from_data is at most 2 GiB - 1
+ * bytes, and 64 bits entries otherwise, in native byte order.
+ */
+static PyObject *m_create_suffix_array(PyObject *self_p, PyObject* args_p)
+{
+    int res;
+    Py_buffer from_view;
+    Py_buffer suffix_array_view;
+    PyObject *from_p;
+    PyObject *suffix_array_p;
+    int threads;
+
+    threads = 1;
+    res = PyArg_ParseTuple(args_p,
+                           "OO|i",
+                           &from_p,
+                           &suffix_array_p,
+                           &threads);
+
+    if (res == 0) {
+        return (NULL);
+    }
+
+    res = PyObject_GetBuffer(from_p, &from_view, PyBUF_CONTIG_RO);
+
+    if (res == -1) {
+        return (NULL);
+    }
+
+    res = PyObject_GetBuffer(suffix_array_p, &suffix_array_view, PyBUF_CONTIG);
+
+    if (res == -1) {
+        goto err1;
+    }
+
+    res = check_suffix_array_size(&suffix_array_view, from_view.len);
+
+    if (res != 0) {
+        goto err2;
+    }
+
+    if (from_view.len > 0) {
+        Py_BEGIN_ALLOW_THREADS
+
+        if (suffix_array_entry_size(from_view.len) == 8) {
+            res = divsufsort64_mt((const sauchar_t *)from_view.buf,
+                                  (saidx64_t *)suffix_array_view.buf,
+                                  (saidx64_t)from_view.len,
+                                  threads);
+        } else {
+            res = divsufsort_mt((const sauchar_t *)from_view.buf,
+                                (saidx_t *)suffix_array_view.buf,
+                                (saidx_t)from_view.len,
+                                threads);
+        }
+
+        Py_END_ALLOW_THREADS
+
+        if (res != 0) {
+            PyErr_SetString(PyExc_RuntimeError, "Suffix array creation failed.");
+            goto err2;
+        }
+    }
+
+    PyBuffer_Release(&suffix_array_view);
+    PyBuffer_Release(&from_view);
+    Py_INCREF(Py_None);
+
+    return (Py_None);
+
+ err2:
+    PyBuffer_Release(&suffix_array_view);
+
+ err1:
+    PyBuffer_Release(&from_view);
+
+    return (NULL);
+}
+
+/* Bytes compared by each memcmp() call when searching for the common
+   prefix and suffix. */
+#define COMMON_SIZE_CHUNK_SIZE  4096
+
+static size_t common_prefix_size(const uint8_t *a_p,
+                                 const uint8_t *b_p,
+                                 size_t size)
+{
+    size_t offset;
+    size_t chunk_size;
+
+    offset = 0;
+
+    while (offset < size) {
+        chunk_size = size - offset;
+
+        if (chunk_size > COMMON_SIZE_CHUNK_SIZE) {
+            chunk_size = COMMON_SIZE_CHUNK_SIZE;
+        }
+
+        if (memcmp(&a_p[offset], &b_p[offset], chunk_size) != 0) {
+            break;
+        }
+
+        offset += chunk_size;
+    }
+
+    while ((offset < size) && (a_p[offset] == b_p[offset])) {
+        offset++;
+    }
+
+    return (offset);
+}
+
+static size_t common_suffix_size(const uint8_t *a_end_p,
+                                 const uint8_t *b_end_p,
+                                 size_t size)
+{
+    size_t offset;
+    size_t chunk_size;
+
+    offset = 0;
+
+    while (offset < size) {
+        chunk_size = size - offset;
+
+        if (chunk_size > COMMON_SIZE_CHUNK_SIZE) {
+            chunk_size = COMMON_SIZE_CHUNK_SIZE;
+        }
+
+        if (memcmp(a_end_p - offset - chunk_size,
+                   b_end_p - offset - chunk_size,
+                   chunk_size) != 0) {
+            break;
+        }
+
+        offset += chunk_size;
+    }
+
+    while ((offset < size) && (a_end_p[-1 - (Py_ssize_t)offset]
+                               == b_end_p[-1 - (Py_ssize_t)offset])) {
+        offset++;
+    }
+
+    return (offset);
+}
+
+/**
+ * def common_sizes(from_data, to_data) -> (prefix_size, suffix_size)
+ *
+ * Returns the sizes of the longest common prefix of from_data and
+ * to_data, and of the longest common suffix of the data after the
+ * prefix.
+ */
+static PyObject *m_common_sizes(PyObject *self_p, PyObject* args_p)
+{
+    int res;
+    Py_buffer from_view;
+    Py_buffer to_view;
+    PyObject *from_p;
+    PyObject *to_p;
+    size_t size;
+    size_t prefix_size;
+    size_t suffix_size;
+
+    res = PyArg_ParseTuple(args_p, "OO", &from_p, &to_p);
+
+    if (res == 0) {
+        return (NULL);
+    }
+
+    res = PyObject_GetBuffer(from_p, &from_view, PyBUF_CONTIG_RO);
+
+    if (res == -1) {
+        return (NULL);
+    }
+
+    res = PyObject_GetBuffer(to_p, &to_view, PyBUF_CONTIG_RO);
+
+    if (res == -1) {
+        goto err1;
+    }
+
+    size = (size_t)from_view.len;
+
+    if ((size_t)to_view.len < size) {
+        size = (size_t)to_view.len;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+
+    prefix_size = common_prefix_size((const uint8_t *)from_view.buf,
+                                     (const uint8_t *)to_view.buf,
+                                     size);
+    suffix_size = common_suffix_size(
+        (const uint8_t *)from_view.buf + from_view.len,
+        (const uint8_t *)to_view.buf + to_view.len,
+        size - prefix_size);
+
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&to_view);
+    PyBuffer_Release(&from_view);
+
+    return (Py_BuildValue("nn",
+                          (Py_ssize_t)prefix_size,
+                          (Py_ssize_t)suffix_size));
+
+ err1:
+    PyBuffer_Release(&from_view);
+
+    return (NULL);
 }
 
 static int parse_create_patch_args(PyObject *args_p,
@@ -80,24 +343,41 @@ static int parse_create_patch_args(PyObject *args_p,
                                    Py_buffer *to_view_p,
                                    unsigned int *match_score_p,
                                    unsigned int *block_size_p,
-                                   int *patch_type_p)
+                                   int *patch_type_p,
+                                   int *threads_p,
+                                   PyObject **write_pp,
+                                   PyObject **suffix_array_pp)
 {
     int res;
     PyObject *from_p;
     PyObject *to_p;
 
+    *threads_p = 1;
+    *write_pp = Py_None;
+    *suffix_array_pp = Py_None;
     res = PyArg_ParseTuple(args_p,
-                           "OOIIi",
+                           "OOIIi|iOO",
                            &from_p,
                            &to_p,
                            match_score_p,
                            block_size_p,
-                           patch_type_p);
+                           patch_type_p,
+                           threads_p,
+                           write_pp,
+                           suffix_array_pp);
 
     if (res == 0) {
         return (-1);
     }
 
+    if (*write_pp == Py_None) {
+        *write_pp = NULL;
+    }
+
+    if (*suffix_array_pp == Py_None) {
+        *suffix_array_pp = NULL;
+    }
+
     res = PyObject_GetBuffer(from_p, from_view_p, PyBUF_CONTIG_RO);
 
     if (res == -1) {
@@ -186,32 +466,153 @@ static PyObject *m_pack_size(PyObject *self_p, PyObject *arg_p)
 }
 
 
+#define PATCH_CHUNK_SIZE  (1 << 20)
+
+/* Patch data output stream. The patch data is collected in memory,
+   or, if there is a Python write callback, given to it in chunks of
+   about PATCH_CHUNK_SIZE bytes. Only sequential writes are
+   supported, which is what HDiffPatch does without a compress
+   plugin. */
+struct patch_output_t {
+    hpatch_TStreamOutput base;
+    PyObject *write_p;
+    std::vector<unsigned char> buffer;
+};
+
+static hpatch_BOOL patch_output_flush(struct patch_output_t *self_p)
+{
+    PyGILState_STATE gil_state;
+    PyObject *chunk_p;
+    PyObject *result_p;
+
+    if ((self_p->write_p == NULL) || self_p->buffer.empty()) {
+        return (hpatch_TRUE);
+    }
+
+    gil_state = PyGILState_Ensure();
+    result_p = NULL;
+
+    if (!PyErr_Occurred()) {
+        chunk_p = PyBytes_FromStringAndSize((const char *)self_p->buffer.data(),
+                                            (Py_ssize_t)self_p->buffer.size());
+
+        if (chunk_p != NULL) {
+            result_p = PyObject_CallFunctionObjArgs(self_p->write_p,
+                                                    chunk_p,
+                                                    NULL);
+            Py_DECREF(chunk_p);
+        }
+    }
+
+    Py_XDECREF(result_p);
+    PyGILState_Release(gil_state);
+    self_p->buffer.clear();
+
+    return (result_p != NULL);
+}
+
+static hpatch_BOOL patch_output_write(const hpatch_TStreamOutput *stream_p,
+                                      hpatch_StreamPos_t write_to_pos,
+                                      const unsigned char *data_p,
+                                      const unsigned char *data_end_p)
+{
+    struct patch_output_t *self_p;
+
+    self_p = (struct patch_output_t *)stream_p->streamImport;
+
+    if (write_to_pos != self_p->base.streamSize) {
+        return (hpatch_FALSE);
+    }
+
+    self_p->buffer.insert(self_p->buffer.end(), data_p, data_end_p);
+    self_p->base.streamSize += (hpatch_StreamPos_t)(data_end_p - data_p);
+
+    if (self_p->buffer.size() >= PATCH_CHUNK_SIZE) {
+        return (patch_output_flush(self_p));
+    }
+
+    return (hpatch_TRUE);
+}
+
+static void patch_output_init(struct patch_output_t *self_p,
+                              PyObject *write_p)
+{
+    self_p->base.streamImport = self_p;
+    self_p->base.streamSize = 0;
+    self_p->base.read_writed = NULL;
+    self_p->base.write = patch_output_write;
+    self_p->write_p = write_p;
+
+    if (write_p != NULL) {
+        self_p->buffer.reserve(PATCH_CHUNK_SIZE);
+    }
+}
+
+/**
+ * Returns the patch data as a byte array, or its size if written to a
+ * callback.
+ */
+static PyObject *patch_output_result(struct patch_output_t *self_p,
+                                     const std::string& error)
+{
+    if (PyErr_Occurred()) {
+        return (NULL);
+    }
+
+    if (!error.empty()) {
+        PyErr_SetString(PyExc_RuntimeError, error.c_str());
+
+        return (NULL);
+    }
+
+    if (self_p->write_p != NULL) {
+        return (PyLong_FromUnsignedLongLong(self_p->base.streamSize));
+    }
+
+    return (PyByteArray_FromStringAndSize((const char *)self_p->buffer.data(),
+                                          (Py_ssize_t)self_p->buffer.size()));
+}
+
 static PyObject *create_patch_suffix_array(uint8_t *from_p,
                                            uint8_t *to_p,
                                            Py_ssize_t from_size,
                                            Py_ssize_t to_size,
                                            unsigned int match_score,
-                                           int patch_type)
+                                           int patch_type,
+                                           int threads,
+                                           const void *suffix_array_p,
+                                           PyObject *write_p)
 {
-    std::vector<unsigned char> diff;
+    struct patch_output_t patch_data;
+    std::string error;
+
+    patch_output_init(&patch_data, write_p);
+
+    Py_BEGIN_ALLOW_THREADS
 
     try {
         create_compressed_diff(&to_p[0],
                                &to_p[to_size],
                                &from_p[0],
                                &from_p[from_size],
-                               diff,
+                               patch_data.buffer,
                                NULL,
                                match_score,
-                               patch_type);
-    } catch (const std::exception& e) {
-        PyErr_SetString(PyExc_RuntimeError, e.what());
+                               patch_type,
+                               threads,
+                               suffix_array_p);
+        patch_data.base.streamSize = patch_data.buffer.size();
 
-        return (NULL);
+        if (!patch_output_flush(&patch_data)) {
+            error = "Patch write failed.";
+        }
+    } catch (const std::exception& e) {
+        error = e.what();
     }
 
-    return (PyByteArray_FromStringAndSize((const char *)diff.data(),
-                                          diff.size()));
+    Py_END_ALLOW_THREADS
+
+    return (patch_output_result(&patch_data, error));
 }
 
 static PyObject *create_patch_match_blocks(uint8_t *from_p,
@@ -219,73 +620,38 @@ static PyObject *create_patch_match_blocks(uint8_t *from_p,
                                            Py_ssize_t from_size,
                                            Py_ssize_t to_size,
                                            unsigned int match_block_size,
-                                           int patch_type)
+                                           int patch_type,
+                                           PyObject *write_p)
 {
-    int res;
     hpatch_TStreamInput from_data;
     hpatch_TStreamInput to_data;
-    hpatch_TFileStreamOutput patch_data;
-    PyObject *byte_array_p;
-    size_t members_read;
+    struct patch_output_t patch_data;
+    std::string error;
 
     mem_as_hStreamInput(&from_data, &from_p[0], &from_p[from_size]);
     mem_as_hStreamInput(&to_data, &to_p[0], &to_p[to_size]);
-    hpatch_TFileStreamOutput_init(&patch_data);
-    hpatch_TFileStreamOutput_tmpfile(&patch_data, ~(hpatch_StreamPos_t)0);
-
-    create_compressed_diff_stream(&to_data,
-                                  &from_data,
-                                  &patch_data.base,
-                                  NULL,
-                                  match_block_size,
-                                  patch_type);
-
-    byte_array_p = PyByteArray_FromStringAndSize("", 1);
-
-    if (byte_array_p == NULL) {
-        goto out1;
-    }
-
-    res = PyByteArray_Resize(byte_array_p, (Py_ssize_t)patch_data.out_length);
-
-    if (res != 0) {
-        goto out2;
-    }
-
-    res = fseek(patch_data.m_file, 0, SEEK_SET);
-
-    if (res != 0) {
-        PyErr_SetString(PyExc_RuntimeError, "internal error: fseek failed");
-
-        goto out2;
-    }
-
-    members_read = fread(PyByteArray_AsString(byte_array_p),
-                         1,
-                         (size_t)patch_data.out_length,
-                         patch_data.m_file);
-    hpatch_TFileStreamOutput_close(&patch_data);
+    patch_output_init(&patch_data, write_p);
 
-    if (members_read != patch_data.out_length) {
-        PyErr_SetString(PyExc_RuntimeError, "internal error: fread failed");
+    Py_BEGIN_ALLOW_THREADS
 
-        goto out3;
+    try {
+        create_compressed_diff_stream(&to_data,
+                                      &from_data,
+                                      &patch_data.base,
+                                      NULL,
+                                      match_block_size,
+                                      patch_type);
+
+        if (!patch_output_flush(&patch_data)) {
+            error = "Patch write failed.";
+        }
+    } catch (const std::exception& e) {
+        error = e.what();
     }
 
-    return (byte_array_p);
-
- out1:
-    hpatch_TFileStreamOutput_close(&patch_data);
-
-    return (NULL);
-
- out2:
-    hpatch_TFileStreamOutput_close(&patch_data);
-
- out3:
-    Py_DECREF(byte_array_p);
+    Py_END_ALLOW_THREADS
 
-    return (NULL);
+    return (patch_output_result(&patch_data, error));
 }
 
 /**
@@ -293,7 +659,18 @@ static PyObject *create_patch_match_blocks(uint8_t *from_p,
  *                  to_data,
  *                  match_score,
  *                  match_block_size,
- *                  patch_type) -> patch_data
+ *                  patch_type,
+ *                  threads=1,
+ *                  write=None,
+ *                  suffix_array=None) -> patch_data or patch_size
+ *
+ * `threads` is only used by the suffix array algorithm, that is when
+ * `match_block_size` is zero, as is `suffix_array`, the suffix array
+ * of from_data as created by create_suffix_array(), instead of
+ * creating it.
+ *
+ * If `write` is given the patch data is passed to it in chunks as
+ * bytes objects while it is created, and the patch size is returned.
  */
 static PyObject *m_create_patch(PyObject *self_p, PyObject* args_p)
 {
@@ -303,6 +680,10 @@ static PyObject *m_create_patch(PyObject *self_p, PyObject* args_p)
     unsigned int match_score;
     unsigned int match_block_size;
     int patch_type;
+    int threads;
+    PyObject *write_p;
+    PyObject *suffix_array_p;
+    Py_buffer suffix_array_view;
     PyObject *patch_p;
 
     res = parse_create_patch_args(args_p,
@@ -310,181 +691,939 @@ static PyObject *m_create_patch(PyObject *self_p, PyObject* args_p)
                                   &to_view,
                                   &match_score,
                                   &match_block_size,
-                                  &patch_type);
+                                  &patch_type,
+                                  &threads,
+                                  &write_p,
+                                  &suffix_array_p);
 
     if (res != 0) {
         return (NULL);
     }
 
+    suffix_array_view.buf = NULL;
+
+    if (suffix_array_p != NULL) {
+        if (match_block_size != 0) {
+            PyErr_SetString(PyExc_ValueError,
+                            "A suffix array is only used by the suffix "
+                            "array algorithm.");
+            goto err1;
+        }
+
+        res = PyObject_GetBuffer(suffix_array_p,
+                                 &suffix_array_view,
+                                 PyBUF_CONTIG_RO);
+
+        if (res == -1) {
+            goto err1;
+        }
+
+        res = check_suffix_array_size(&suffix_array_view, from_view.len);
+
+        if (res != 0) {
+            goto err2;
+        }
+    }
+
     if (match_block_size == 0) {
         patch_p = create_patch_suffix_array((uint8_t *)from_view.buf,
                                             (uint8_t *)to_view.buf,
                                             from_view.len,
                                             to_view.len,
                                             match_score,
-                                            patch_type);
+                                            patch_type,
+                                            threads,
+                                            suffix_array_view.buf,
+                                            write_p);
     } else {
         patch_p = create_patch_match_blocks((uint8_t *)from_view.buf,
                                             (uint8_t *)to_view.buf,
                                             from_view.len,
                                             to_view.len,
                                             match_block_size,
-                                            patch_type);
+                                            patch_type,
+                                            write_p);
+    }
+
+    if (suffix_array_p != NULL) {
+        PyBuffer_Release(&suffix_array_view);
     }
 
     PyBuffer_Release(&from_view);
     PyBuffer_Release(&to_view);
 
     return (patch_p);
+
+ err2:
+    PyBuffer_Release(&suffix_array_view);
+
+ err1:
+    PyBuffer_Release(&from_view);
+    PyBuffer_Release(&to_view);
+
+    return (NULL);
 }
 
 static int parse_apply_patch_args(PyObject *args_p,
-                                   char **from_pp,
-                                   char **patch_pp,
-                                   Py_ssize_t *from_size_p,
-                                   Py_ssize_t *patch_size_p)
+                                  Py_buffer *from_view_p,
+                                  Py_buffer *patch_view_p,
+                                  PyObject **to_pp)
 {
     int res;
-    PyObject *from_bytes_p;
-    PyObject *patch_bytes_p;
+    PyObject *from_p;
+    PyObject *patch_p;
 
+    *to_pp = Py_None;
     res = PyArg_ParseTuple(args_p,
-                           "OO",
-                           &from_bytes_p,
-                           &patch_bytes_p);
+                           "OO|O",
+                           &from_p,
+                           &patch_p,
+                           to_pp);
 
     if (res == 0) {
         return (-1);
     }
 
-    res = PyBytes_AsStringAndSize(from_bytes_p, from_pp, from_size_p);
+    if (*to_pp == Py_None) {
+        *to_pp = NULL;
+    }
 
-    if (res != 0) {
-        return (-1);
+    res = PyObject_GetBuffer(from_p, from_view_p, PyBUF_CONTIG_RO);
+
+    if (res == -1) {
+        return (res);
     }
 
-    res = PyBytes_AsStringAndSize(patch_bytes_p, patch_pp, patch_size_p);
+    res = PyObject_GetBuffer(patch_p, patch_view_p, PyBUF_CONTIG_RO);
 
-    if (res != 0) {
-        return (-1);
+    if (res == -1) {
+        goto err1;
     }
 
     return (res);
-}
+
+ err1:
+    PyBuffer_Release(from_view_p);
+
+    return (res);
+}
 
 #define PATCH_CACHE_SIZE_MIN       (1024 * 8)
 #define PATCH_CACHE_SIZE_BEST_MIN  ((size_t)1 << 21)
 #define PATCH_CACHE_SIZE_DEFAULT   ((size_t)1 << 26)
 #define PATCH_CACHE_SIZE_BEST_MAX  ((size_t)1 << 30)
 
-static uint8_t* get_patch_mem_cache(size_t patchCacheSize,
-                                    hpatch_StreamPos_t oldDataSize,
-                                    size_t* out_memCacheSize)
+/* Work memory of the patch algorithm, kept between patches by patch
+   appliers. */
+struct work_cache_t {
+    uint8_t *buf_p;
+    size_t size;
+};
+
+static void work_cache_init(struct work_cache_t *self_p)
 {
-    uint8_t *temp_cache_p = NULL;
-    size_t temp_cache_size;
+    self_p->buf_p = NULL;
+    self_p->size = 0;
+}
+
+static void work_cache_destroy(struct work_cache_t *self_p)
+{
+    free(self_p->buf_p);
+    work_cache_init(self_p);
+}
+
+/**
+ * Make sure the cache is big enough for patching from data of given
+ * size, using at most maximum_size bytes. The allocated cache is
+ * reused if big enough, and replaced otherwise. The size to use is
+ * written to size_p. Returns 0 on success, or -1 with an exception
+ * set.
+ */
+static int work_cache_reserve(struct work_cache_t *self_p,
+                              size_t maximum_size,
+                              hpatch_StreamPos_t from_size,
+                              size_t *size_p)
+{
+    size_t size;
+
+    if (maximum_size < PATCH_CACHE_SIZE_MIN) {
+        maximum_size = PATCH_CACHE_SIZE_MIN;
+    }
 
-    if (patchCacheSize < PATCH_CACHE_SIZE_MIN) {
-        patchCacheSize = PATCH_CACHE_SIZE_MIN;
+    size = maximum_size;
+
+    if (size > from_size + PATCH_CACHE_SIZE_BEST_MIN) {
+        size = (size_t)(from_size + PATCH_CACHE_SIZE_BEST_MIN);
     }
 
-    temp_cache_size = patchCacheSize;
+    if (self_p->size >= size) {
+        *size_p = size;
 
-    if (temp_cache_size > oldDataSize + PATCH_CACHE_SIZE_BEST_MIN) {
-        temp_cache_size = (size_t)(oldDataSize + PATCH_CACHE_SIZE_BEST_MIN);
+        return (0);
     }
 
-    while (!temp_cache_p) {
-        temp_cache_p = (uint8_t *)malloc(temp_cache_size);
+    work_cache_destroy(self_p);
+
+    while (self_p->buf_p == NULL) {
+        self_p->buf_p = (uint8_t *)malloc(size);
+
+        if (self_p->buf_p == NULL) {
+            if (size < PATCH_CACHE_SIZE_MIN * 2) {
+                PyErr_NoMemory();
 
-        if ((!temp_cache_p) && (temp_cache_size >= PATCH_CACHE_SIZE_MIN * 2)) {
-            temp_cache_size >>= 1;
+                return (-1);
+            }
+
+            size >>= 1;
         }
     }
 
-    *out_memCacheSize = (temp_cache_p ? temp_cache_size : 0);
+    self_p->size = size;
+    *size_p = size;
 
-    return (temp_cache_p);
+    return (0);
 }
 
 /**
- * def apply_patch(from_data, patch_data) -> to_data
+ * Apply a patch in memory using given work cache. See m_apply_patch().
  */
-static PyObject *m_apply_patch(PyObject *self_p, PyObject* args_p)
+static PyObject *apply_patch_buffers(struct work_cache_t *cache_p,
+                                     size_t cache_size,
+                                     PyObject* args_p)
 {
     int res;
-    uint8_t *from_p;
-    uint8_t *patch_p;
-    Py_ssize_t from_size;
-    Py_ssize_t patch_size;
+    Py_buffer from_view;
+    Py_buffer patch_view;
+    Py_buffer to_view;
+    PyObject *to_p;
     hpatch_TStreamOutput to_data;
     hpatch_TStreamInput patch_data;
     hpatch_TStreamInput from_data;
-    uint8_t *temp_cache_p;
     size_t temp_cache_size;
     hpatch_BOOL patch_result;
     hpatch_compressedDiffInfo patch_info;
-    PyObject *byte_array_p;
-    uint8_t *to_p;
+    PyObject *result_p;
+    uint8_t *to_data_p;
 
-    res = parse_apply_patch_args(args_p,
-                                  (char **)&from_p,
-                                  (char **)&patch_p,
-                                  &from_size,
-                                  &patch_size);
+    res = parse_apply_patch_args(args_p, &from_view, &patch_view, &to_p);
 
     if (res != 0) {
         return (NULL);
     }
 
-    mem_as_hStreamInput(&from_data, &from_p[0], &from_p[from_size]);
-    mem_as_hStreamInput(&patch_data, &patch_p[0], &patch_p[patch_size]);
+    mem_as_hStreamInput(&from_data,
+                        (uint8_t *)from_view.buf,
+                        (uint8_t *)from_view.buf + from_view.len);
+    mem_as_hStreamInput(&patch_data,
+                        (uint8_t *)patch_view.buf,
+                        (uint8_t *)patch_view.buf + patch_view.len);
 
-    if (!getCompressedDiffInfo(&patch_info, &patch_data)){
-        return (NULL);
+    if (!getCompressedDiffInfo(&patch_info, &patch_data)) {
+        PyErr_SetString(PyExc_RuntimeError, "Corrupt patch data.");
+        goto err1;
+    }
+
+    if (from_data.streamSize != patch_info.oldDataSize) {
+        PyErr_Format(PyExc_RuntimeError,
+                     "Expected from size %llu, but got %llu.",
+                     (unsigned long long)patch_info.oldDataSize,
+                     (unsigned long long)from_data.streamSize);
+        goto err1;
+    }
+
+    res = work_cache_reserve(cache_p,
+                             cache_size,
+                             from_data.streamSize,
+                             &temp_cache_size);
+
+    if (res != 0) {
+        goto err1;
     }
 
-    if (from_data.streamSize != patch_info.oldDataSize){
+    if (to_p != NULL) {
+        res = PyObject_GetBuffer(to_p, &to_view, PyBUF_CONTIG);
+
+        if (res == -1) {
+            goto err1;
+        }
+
+        if ((hpatch_StreamPos_t)to_view.len != patch_info.newDataSize) {
+            PyErr_Format(PyExc_ValueError,
+                         "Expected to size %llu, but got %llu.",
+                         (unsigned long long)patch_info.newDataSize,
+                         (unsigned long long)to_view.len);
+            goto err2;
+        }
+
+        result_p = PyLong_FromUnsignedLongLong(patch_info.newDataSize);
+
+        if (result_p == NULL) {
+            goto err2;
+        }
+
+        to_data_p = (uint8_t *)to_view.buf;
+    } else {
+        result_p = PyByteArray_FromStringAndSize("", 1);
+
+        if (result_p == NULL) {
+            goto err1;
+        }
+
+        res = PyByteArray_Resize(result_p,
+                                 (Py_ssize_t)patch_info.newDataSize);
+
+        if (res != 0) {
+            goto err3;
+        }
+
+        to_data_p = (uint8_t *)PyByteArray_AsString(result_p);
+    }
+
+    mem_as_hStreamOutput(&to_data,
+                         &to_data_p[0],
+                         &to_data_p[patch_info.newDataSize]);
+
+    /* All data is pinned by the buffer views, and a new to byte array
+       is not yet visible to Python. */
+    Py_BEGIN_ALLOW_THREADS
+    patch_result = patch_decompress_with_cache(&to_data,
+                                               &from_data,
+                                               &patch_data,
+                                               NULL,
+                                               &cache_p->buf_p[0],
+                                               &cache_p->buf_p[temp_cache_size]);
+    Py_END_ALLOW_THREADS
+
+    if (patch_result != hpatch_TRUE) {
+        PyErr_SetString(PyExc_RuntimeError, "Patch apply failed.");
+        goto err3;
+    }
+
+    if (to_p != NULL) {
+        PyBuffer_Release(&to_view);
+    }
+
+    PyBuffer_Release(&patch_view);
+    PyBuffer_Release(&from_view);
+
+    return (result_p);
+
+ err3:
+    Py_DECREF(result_p);
+
+ err2:
+    if (to_p != NULL) {
+        PyBuffer_Release(&to_view);
+    }
+
+ err1:
+    PyBuffer_Release(&patch_view);
+    PyBuffer_Release(&from_view);
+
+    return (NULL);
+}
+
+/**
+ * def apply_patch(from_data, patch_data[, to_data]) -> to_data or to_size
+ *
+ * All data may be any object supporting the buffer protocol. The
+ * patched data is written to to_data if given, which must be writable
+ * and of the to size, and the to size is returned. Otherwise a new
+ * byte array is returned.
+ */
+static PyObject *m_apply_patch(PyObject *self_p, PyObject* args_p)
+{
+    struct work_cache_t cache;
+    PyObject *result_p;
+
+    work_cache_init(&cache);
+    result_p = apply_patch_buffers(&cache, PATCH_CACHE_SIZE_DEFAULT, args_p);
+    work_cache_destroy(&cache);
+
+    return (result_p);
+}
+
+struct python_stream_t {
+    PyObject *callback_p;
+    hpatch_StreamPos_t position;
+};
+
+/**
+ * Call given Python callback with a memoryview of given buffer as
+ * last argument. Returns the number of bytes the callback reported,
+ * or -1 if the callback raised an exception.
+ */
+static Py_ssize_t call_with_memoryview(PyObject *callback_p,
+                                       PyObject *position_p,
+                                       unsigned char *buf_p,
+                                       unsigned char *buf_end_p,
+                                       int flags)
+{
+    PyObject *view_p;
+    PyObject *result_p;
+    PyObject *type_p;
+    PyObject *value_p;
+    PyObject *traceback_p;
+    Py_ssize_t size;
+
+    view_p = PyMemoryView_FromMemory((char *)buf_p,
+                                     (Py_ssize_t)(buf_end_p - buf_p),
+                                     flags);
+
+    if (view_p == NULL) {
+        return (-1);
+    }
+
+    if (position_p != NULL) {
+        result_p = PyObject_CallFunctionObjArgs(callback_p,
+                                                position_p,
+                                                view_p,
+                                                NULL);
+    } else {
+        result_p = PyObject_CallFunctionObjArgs(callback_p, view_p, NULL);
+    }
+
+    /* The buffer is owned by HDiffPatch, make sure Python code can
+       not access it after the callback returned. */
+    PyErr_Fetch(&type_p, &value_p, &traceback_p);
+    Py_XDECREF(PyObject_CallMethod(view_p, "release", NULL));
+    PyErr_Clear();
+    PyErr_Restore(type_p, value_p, traceback_p);
+    Py_DECREF(view_p);
+
+    if (result_p == NULL) {
+        return (-1);
+    }
+
+    if (result_p == Py_None) {
+        size = (Py_ssize_t)(buf_end_p - buf_p);
+    } else {
+        size = PyLong_AsSsize_t(result_p);
+    }
+
+    Py_DECREF(result_p);
+
+    return (size);
+}
+
+static hpatch_BOOL python_stream_input_read(const hpatch_TStreamInput *stream_p,
+                                            hpatch_StreamPos_t read_from_pos,
+                                            unsigned char *out_data_p,
+                                            unsigned char *out_data_end_p)
+{
+    struct python_stream_t *self_p;
+    PyObject *position_p;
+    Py_ssize_t size;
+    PyGILState_STATE gil_state;
+    hpatch_BOOL res;
+
+    self_p = (struct python_stream_t *)stream_p->streamImport;
+    gil_state = PyGILState_Ensure();
+    res = hpatch_FALSE;
+
+    if (PyErr_Occurred()) {
+        goto out;
+    }
+
+    position_p = PyLong_FromUnsignedLongLong(read_from_pos);
+
+    if (position_p == NULL) {
+        goto out;
+    }
+
+    size = call_with_memoryview(self_p->callback_p,
+                                position_p,
+                                out_data_p,
+                                out_data_end_p,
+                                PyBUF_WRITE);
+    Py_DECREF(position_p);
+
+    if (size != (Py_ssize_t)(out_data_end_p - out_data_p)) {
+        if (!PyErr_Occurred()) {
+            PyErr_SetString(PyExc_RuntimeError, "Short read.");
+        }
+
+        goto out;
+    }
+
+    res = hpatch_TRUE;
+
+ out:
+    PyGILState_Release(gil_state);
+
+    return (res);
+}
+
+static hpatch_BOOL python_stream_output_write(const hpatch_TStreamOutput *stream_p,
+                                              hpatch_StreamPos_t write_to_pos,
+                                              const unsigned char *data_p,
+                                              const unsigned char *data_end_p)
+{
+    struct python_stream_t *self_p;
+    Py_ssize_t size;
+    PyGILState_STATE gil_state;
+    hpatch_BOOL res;
+
+    self_p = (struct python_stream_t *)stream_p->streamImport;
+    gil_state = PyGILState_Ensure();
+    res = hpatch_FALSE;
+
+    if (PyErr_Occurred()) {
+        goto out;
+    }
+
+    if (write_to_pos != self_p->position) {
+        PyErr_SetString(PyExc_RuntimeError, "Non-sequential write.");
+
+        goto out;
+    }
+
+    size = call_with_memoryview(self_p->callback_p,
+                                NULL,
+                                (unsigned char *)data_p,
+                                (unsigned char *)data_end_p,
+                                PyBUF_READ);
+
+    if (size != (Py_ssize_t)(data_end_p - data_p)) {
+        if (!PyErr_Occurred()) {
+            PyErr_SetString(PyExc_RuntimeError, "Short write.");
+        }
+
+        goto out;
+    }
+
+    self_p->position += (hpatch_StreamPos_t)size;
+    res = hpatch_TRUE;
+
+ out:
+    PyGILState_Release(gil_state);
+
+    return (res);
+}
+
+static void python_stream_as_input(hpatch_TStreamInput *stream_p,
+                                   struct python_stream_t *self_p,
+                                   PyObject *callback_p,
+                                   hpatch_StreamPos_t size)
+{
+    self_p->callback_p = callback_p;
+    self_p->position = 0;
+    stream_p->streamImport = self_p;
+    stream_p->streamSize = size;
+    stream_p->read = python_stream_input_read;
+    stream_p->_private_reserved = NULL;
+}
+
+static void python_stream_as_output(hpatch_TStreamOutput *stream_p,
+                                    struct python_stream_t *self_p,
+                                    PyObject *callback_p,
+                                    hpatch_StreamPos_t size)
+{
+    self_p->callback_p = callback_p;
+    self_p->position = 0;
+    stream_p->streamImport = self_p;
+    stream_p->streamSize = size;
+    stream_p->read_writed = NULL;
+    stream_p->write = python_stream_output_write;
+}
+
+/**
+ * Apply a patch from and to Python streams using given work cache. See
+ * m_apply_patch_stream().
+ */
+static PyObject *apply_patch_streams(struct work_cache_t *cache_p,
+                                     size_t cache_size,
+                                     PyObject *from_readinto_p,
+                                     unsigned long long from_size,
+                                     PyObject *patch_readinto_p,
+                                     unsigned long long patch_size,
+                                     PyObject *to_write_p)
+{
+    int res;
+    struct python_stream_t from_stream;
+    struct python_stream_t patch_stream;
+    struct python_stream_t to_stream;
+    hpatch_TStreamInput from_data;
+    hpatch_TStreamInput patch_data;
+    hpatch_TStreamOutput to_data;
+    hpatch_compressedDiffInfo patch_info;
+    size_t temp_cache_size;
+    hpatch_BOOL patch_result;
+
+    python_stream_as_input(&from_data,
+                           &from_stream,
+                           from_readinto_p,
+                           from_size);
+    python_stream_as_input(&patch_data,
+                           &patch_stream,
+                           patch_readinto_p,
+                           patch_size);
+
+    if (!getCompressedDiffInfo(&patch_info, &patch_data)) {
+        if (!PyErr_Occurred()) {
+            PyErr_SetString(PyExc_RuntimeError, "Corrupt patch data.");
+        }
+
         return (NULL);
     }
 
-    byte_array_p = PyByteArray_FromStringAndSize("", 1);
+    if (from_data.streamSize != patch_info.oldDataSize) {
+        PyErr_Format(PyExc_RuntimeError,
+                     "Expected from size %llu, but got %llu.",
+                     (unsigned long long)patch_info.oldDataSize,
+                     (unsigned long long)from_data.streamSize);
 
-    if (byte_array_p == NULL) {
         return (NULL);
     }
 
-    res = PyByteArray_Resize(byte_array_p, (Py_ssize_t)patch_info.newDataSize);
+    python_stream_as_output(&to_data,
+                            &to_stream,
+                            to_write_p,
+                            patch_info.newDataSize);
+    res = work_cache_reserve(cache_p,
+                             cache_size,
+                             from_data.streamSize,
+                             &temp_cache_size);
 
     if (res != 0) {
         return (NULL);
     }
 
-    to_p = (uint8_t *)PyByteArray_AsString(byte_array_p);
-    mem_as_hStreamOutput(&to_data, &to_p[0], &to_p[patch_info.newDataSize]);
-    temp_cache_p = get_patch_mem_cache(PATCH_CACHE_SIZE_DEFAULT,
-                                       from_data.streamSize,
-                                       &temp_cache_size);
-
+    /* The stream callbacks take the GIL when calling into Python. */
+    Py_BEGIN_ALLOW_THREADS
     patch_result = patch_decompress_with_cache(&to_data,
                                                &from_data,
                                                &patch_data,
                                                NULL,
-                                               &temp_cache_p[0],
-                                               &temp_cache_p[temp_cache_size]);
+                                               &cache_p->buf_p[0],
+                                               &cache_p->buf_p[temp_cache_size]);
+    Py_END_ALLOW_THREADS
+
+    if (patch_result != hpatch_TRUE) {
+        if (!PyErr_Occurred()) {
+            PyErr_SetString(PyExc_RuntimeError, "Patch apply failed.");
+        }
+
+        return (NULL);
+    }
+
+    if (to_stream.position != patch_info.newDataSize) {
+        PyErr_SetString(PyExc_RuntimeError, "Incomplete to data.");
+
+        return (NULL);
+    }
+
+    return (PyLong_FromUnsignedLongLong(to_stream.position));
+}
+
+/**
+ * def apply_patch_stream(from_readinto,
+ *                        from_size,
+ *                        patch_readinto,
+ *                        patch_size,
+ *                        to_write,
+ *                        cache_size) -> to_size
+ *
+ * `from_readinto` and `patch_readinto` are called as
+ * readinto(position, buffer) and must fill the whole buffer.
+ * `to_write` is called as write(buffer) with consecutive chunks of
+ * the to data. At most `cache_size` bytes of work memory is used.
+ */
+static PyObject *m_apply_patch_stream(PyObject *self_p, PyObject* args_p)
+{
+    int res;
+    PyObject *from_readinto_p;
+    PyObject *patch_readinto_p;
+    PyObject *to_write_p;
+    unsigned long long from_size;
+    unsigned long long patch_size;
+    Py_ssize_t cache_size;
+    struct work_cache_t cache;
+    PyObject *result_p;
 
-    if (patch_result != 1) {
-        exit(1);
+    res = PyArg_ParseTuple(args_p,
+                           "OKOKOn",
+                           &from_readinto_p,
+                           &from_size,
+                           &patch_readinto_p,
+                           &patch_size,
+                           &to_write_p,
+                           &cache_size);
+
+    if (res == 0) {
+        return (NULL);
     }
 
-    return (byte_array_p);
+    if (cache_size < 0) {
+        PyErr_SetString(PyExc_ValueError, "Negative cache size.");
+
+        return (NULL);
+    }
+
+    work_cache_init(&cache);
+    result_p = apply_patch_streams(&cache,
+                                   (size_t)cache_size,
+                                   from_readinto_p,
+                                   from_size,
+                                   patch_readinto_p,
+                                   patch_size,
+                                   to_write_p);
+    work_cache_destroy(&cache);
+
+    return (result_p);
+}
+
+struct patch_applier_t {
+    PyObject_HEAD
+    struct work_cache_t cache;
+    Py_ssize_t cache_size;
+    int busy;
+};
+
+/**
+ * Mark given applier as used by the calling thread, as the work cache
+ * is used with the GIL released. Returns 0 on success, or -1 with an
+ * exception set if already in use.
+ */
+static int patch_applier_acquire(struct patch_applier_t *self_p)
+{
+    if (self_p->busy) {
+        PyErr_SetString(PyExc_RuntimeError,
+                        "The patch applier is already in use.");
+
+        return (-1);
+    }
+
+    self_p->busy = 1;
+
+    return (0);
+}
+
+static void patch_applier_release(struct patch_applier_t *self_p)
+{
+    self_p->busy = 0;
+}
+
+/**
+ * PatchApplier(cache_size=67108864)
+ *
+ * Applies patches using a work cache of at most cache_size bytes,
+ * which is kept between patches until closed.
+ */
+static int patch_applier_init(PyObject *self_p,
+                              PyObject *args_p,
+                              PyObject *kwargs_p)
+{
+    struct patch_applier_t *applier_p;
+    static const char *kwlist[] = { "cache_size", NULL };
+    Py_ssize_t cache_size;
+    int res;
+
+    applier_p = (struct patch_applier_t *)self_p;
+    cache_size = PATCH_CACHE_SIZE_DEFAULT;
+    res = PyArg_ParseTupleAndKeywords(args_p,
+                                      kwargs_p,
+                                      "|n",
+                                      (char **)kwlist,
+                                      &cache_size);
+
+    if (res == 0) {
+        return (-1);
+    }
+
+    if (cache_size < 0) {
+        PyErr_SetString(PyExc_ValueError, "Negative cache size.");
+
+        return (-1);
+    }
+
+    if (patch_applier_acquire(applier_p) != 0) {
+        return (-1);
+    }
+
+    work_cache_destroy(&applier_p->cache);
+    applier_p->cache_size = cache_size;
+    patch_applier_release(applier_p);
+
+    return (0);
+}
+
+static void patch_applier_dealloc(PyObject *self_p)
+{
+    PyTypeObject *type_p;
+
+    type_p = Py_TYPE(self_p);
+    work_cache_destroy(&((struct patch_applier_t *)self_p)->cache);
+    type_p->tp_free(self_p);
+    Py_DECREF(type_p);
 }
 
+/**
+ * def apply_patch(from_data, patch_data[, to_data]) -> to_data or to_size
+ */
+static PyObject *patch_applier_apply_patch(PyObject *self_p,
+                                           PyObject *args_p)
+{
+    struct patch_applier_t *applier_p;
+    PyObject *result_p;
+
+    applier_p = (struct patch_applier_t *)self_p;
+
+    if (patch_applier_acquire(applier_p) != 0) {
+        return (NULL);
+    }
+
+    result_p = apply_patch_buffers(&applier_p->cache,
+                                   (size_t)applier_p->cache_size,
+                                   args_p);
+    patch_applier_release(applier_p);
+
+    return (result_p);
+}
+
+/**
+ * def apply_patch_stream(from_readinto,
+ *                        from_size,
+ *                        patch_readinto,
+ *                        patch_size,
+ *                        to_write) -> to_size
+ */
+static PyObject *patch_applier_apply_patch_stream(PyObject *self_p,
+                                                  PyObject *args_p)
+{
+    int res;
+    struct patch_applier_t *applier_p;
+    PyObject *from_readinto_p;
+    PyObject *patch_readinto_p;
+    PyObject *to_write_p;
+    unsigned long long from_size;
+    unsigned long long patch_size;
+    PyObject *result_p;
+
+    applier_p = (struct patch_applier_t *)self_p;
+    res = PyArg_ParseTuple(args_p,
+                           "OKOKO",
+                           &from_readinto_p,
+                           &from_size,
+                           &patch_readinto_p,
+                           &patch_size,
+                           &to_write_p);
+
+    if (res == 0) {
+        return (NULL);
+    }
+
+    if (patch_applier_acquire(applier_p) != 0) {
+        return (NULL);
+    }
+
+    result_p = apply_patch_streams(&applier_p->cache,
+                                   (size_t)applier_p->cache_size,
+                                   from_readinto_p,
+                                   from_size,
+                                   patch_readinto_p,
+                                   patch_size,
+                                   to_write_p);
+    patch_applier_release(applier_p);
+
+    return (result_p);
+}
+
+/**
+ * def close()
+ *
+ * Free the work cache. It is allocated again if the applier is used
+ * after being closed.
+ */
+static PyObject *patch_applier_close(PyObject *self_p, PyObject *args_p)
+{
+    struct patch_applier_t *applier_p;
+
+    applier_p = (struct patch_applier_t *)self_p;
+
+    if (patch_applier_acquire(applier_p) != 0) {
+        return (NULL);
+    }
+
+    work_cache_destroy(&applier_p->cache);
+    patch_applier_release(applier_p);
+    Py_INCREF(Py_None);
+
+    return (Py_None);
+}
+
+static PyObject *patch_applier_enter(PyObject *self_p, PyObject *args_p)
+{
+    Py_INCREF(self_p);
+
+    return (self_p);
+}
+
+static PyObject *patch_applier_exit(PyObject *self_p, PyObject *args_p)
+{
+    return (patch_applier_close(self_p, NULL));
+}
+
+static PyObject *patch_applier_get_cache_size(PyObject *self_p,
+                                              void *closure_p)
+{
+    return (PyLong_FromSsize_t(
+                ((struct patch_applier_t *)self_p)->cache_size));
+}
+
+static PyObject *patch_applier_get_allocated_cache_size(PyObject *self_p,
+                                                        void *closure_p)
+{
+    return (PyLong_FromSize_t(
+                ((struct patch_applier_t *)self_p)->cache.size));
+}
+
+static PyMethodDef patch_applier_methods[] = {
+    { "apply_patch", patch_applier_apply_patch, METH_VARARGS },
+    { "apply_patch_stream", patch_applier_apply_patch_stream, METH_VARARGS },
+    { "close", patch_applier_close, METH_NOARGS },
+    { "__enter__", patch_applier_enter, METH_NOARGS },
+    { "__exit__", patch_applier_exit, METH_VARARGS },
+    { NULL }
+};
+
+static PyGetSetDef patch_applier_getset[] = {
+    { "cache_size", patch_applier_get_cache_size, NULL, NULL, NULL },
+    {
+        "allocated_cache_size",
+        patch_applier_get_allocated_cache_size,
+        NULL,
+        NULL,
+        NULL
+    },
+    { NULL }
+};
+
+static PyType_Slot patch_applier_slots[] = {
+    { Py_tp_init, (void *)patch_applier_init },
+    { Py_tp_dealloc, (void *)patch_applier_dealloc },
+    { Py_tp_methods, (void *)patch_applier_methods },
+    { Py_tp_getset, (void *)patch_applier_getset },
+    { Py_tp_new, (void *)PyType_GenericNew },
+    { 0, NULL }
+};
+
+static PyType_Spec patch_applier_spec = {
+    "phdiffpatch.PatchApplier",
+    sizeof(struct patch_applier_t),
+    0,
+    Py_TPFLAGS_DEFAULT,
+    patch_applier_slots
+};
+
 static PyMethodDef module_methods[] = {
     { "pack_size", m_pack_size, METH_O },
     { "divsufsort", m_divsufsort, METH_VARARGS },
+    { "create_suffix_array", m_create_suffix_array, METH_VARARGS },
+    { "common_sizes", m_common_sizes, METH_VARARGS },
     { "create_patch", m_create_patch, METH_VARARGS },
     { "apply_patch", m_apply_patch, METH_VARARGS },
+    { "apply_patch_stream", m_apply_patch_stream, METH_VARARGS },
     { NULL }
 };
 
@@ -499,6 +1638,7 @@ static PyModuleDef module = {
 PyMODINIT_FUNC PyInit_phdiffpatch(void)
 {
     PyObject *m_p;
+    PyObject *type_p;
 
     /* Module creation. */
     m_p = PyModule_Create(&module);
@@ -507,5 +1647,21 @@ PyMODINIT_FUNC PyInit_phdiffpatch(void)
         return (NULL);
     }
 
+    type_p = PyType_FromSpec(&patch_applier_spec);
+
+    if (type_p == NULL) {
+        goto err1;
+    }
+
+    if (PyModule_AddObject(m_p, "PatchApplier", type_p) != 0) {
+        Py_DECREF(type_p);
+        goto err1;
+    }
+
     return (m_p);
+
+ err1:
+    Py_DECREF(m_p);
+
+    return (NULL);
 }
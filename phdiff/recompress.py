@@ -0,0 +1,208 @@
+"""Change the compression of existing patches without diffing again.
+
+"""
+
+import io
+import os
+from .errors import Error
+from .apply import PatchReader
+from .apply import read_patch_type
+from .apply import read_header_hdiffpatch
+from .apply import read_header_segmented
+from .apply import read_header_in_place
+from .apply import read_header_trimmed
+from .apply import read_header_sparse
+from .common import PATCH_TYPE_HDIFFPATCH
+from .common import PATCH_TYPE_SEGMENTED
+from .common import PATCH_TYPE_IN_PLACE
+from .common import PATCH_TYPE_TRIMMED
+from .common import PATCH_TYPE_SPARSE
+from .common import compression_string_to_number
+from .common import pack_size
+from .sparse import pack_extents
+from .sparse import extents_size
+from .common import run_jobs
+from .create import pack_header
+from .create import create_compressor
+from .create import compress_segment
+from .create import write_segments
+
+
+# Size of the decompressed patch data chunks given to the compressor.
+CHUNK_SIZE = 1024 * 1024
+
+
+def recompress_hdiffpatch(finpatch,
+                          foutpatch,
+                          patch_type,
+                          compression,
+                          compressor):
+    """Recompress a hdiffpatch, trimmed or sparse patch.
+
+    """
+
+    if patch_type == PATCH_TYPE_TRIMMED:
+        (from_compression,
+         to_size,
+         prefix_size,
+         suffix_size,
+         patch_size) = read_header_trimmed(finpatch)
+        header = pack_size(prefix_size) + pack_size(suffix_size)
+        data_size = to_size - prefix_size - suffix_size
+    elif patch_type == PATCH_TYPE_SPARSE:
+        (from_compression,
+         to_size,
+         from_extents,
+         to_extents,
+         patch_size) = read_header_sparse(finpatch)
+        header = pack_extents(from_extents) + pack_extents(to_extents)
+        data_size = extents_size(to_extents)
+    else:
+        from_compression, to_size, patch_size = \
+            read_header_hdiffpatch(finpatch)
+        header = b''
+        data_size = to_size
+
+    foutpatch.write(pack_header(patch_type,
+                                compression_string_to_number(compression)))
+    foutpatch.write(pack_size(to_size))
+    foutpatch.write(header)
+    foutpatch.write(pack_size(patch_size))
+
+    if data_size > 0:
+        patch_reader = PatchReader(finpatch, from_compression)
+        buf = bytearray(min(patch_size, CHUNK_SIZE))
+        left = patch_size
+
+        while left > 0:
+            size = patch_reader.readinto(memoryview(buf)[:min(left,
+                                                              len(buf))])
+            foutpatch.write(compressor.compress(bytes(buf[:size])))
+            left -= size
+
+    foutpatch.write(compressor.flush())
+
+
+def recompress_segments(finpatch,
+                        foutpatch,
+                        from_compression,
+                        segments,
+                        compression,
+                        heatshrink_window_sz2,
+                        heatshrink_lookahead_sz2,
+                        **zstd_kwargs):
+    def recompress_segment(segment):
+        segment = segments[segment]
+        finpatch.seek(segment.patch_offset, os.SEEK_SET)
+        patch_reader = PatchReader(
+            io.BytesIO(finpatch.read(segment.compressed_size)),
+            from_compression)
+
+        return compress_segment(patch_reader.read(segment.patch_size),
+                                compression,
+                                heatshrink_window_sz2,
+                                heatshrink_lookahead_sz2,
+                                **zstd_kwargs)
+
+    write_segments(foutpatch, len(segments), recompress_segment, 1)
+
+
+def recompress_patch(inpatch,
+                     outpatch,
+                     compression,
+                     heatshrink_window_sz2=8,
+                     heatshrink_lookahead_sz2=7,
+                     zstd_level=22,
+                     zstd_threads=0,
+                     zstd_window_log=None,
+                     zstd_long_distance_matching=False):
+    """Decompress the patch data of `inpatch` and write it compressed
+    with `compression` to `outpatch`. The compression parameters are
+    the same as in create_patch().
+
+    The patch data is streamed in chunks, or one segment at a time for
+    segmented and in-place patches. Zstd patches cannot be
+    recompressed, as their compression is the diff.
+
+    """
+
+    zstd_kwargs = {
+        'zstd_level': zstd_level,
+        'zstd_threads': zstd_threads,
+        'zstd_window_log': zstd_window_log,
+        'zstd_long_distance_matching': zstd_long_distance_matching
+    }
+    compression_number = compression_string_to_number(compression)
+
+    with open(inpatch, 'rb') as finpatch:
+        patch_type = read_patch_type(finpatch)
+
+        if patch_type not in [PATCH_TYPE_HDIFFPATCH,
+                              PATCH_TYPE_SEGMENTED,
+                              PATCH_TYPE_IN_PLACE,
+                              PATCH_TYPE_TRIMMED,
+                              PATCH_TYPE_SPARSE]:
+            raise Error('Zstd patches cannot be recompressed.')
+
+        with open(outpatch, 'wb') as foutpatch:
+            if patch_type in [PATCH_TYPE_HDIFFPATCH,
+                              PATCH_TYPE_TRIMMED,
+                              PATCH_TYPE_SPARSE]:
+                recompress_hdiffpatch(finpatch,
+                                      foutpatch,
+                                      patch_type,
+                                      compression,
+                                      create_compressor(
+                                          compression,
+                                          heatshrink_window_sz2,
+                                          heatshrink_lookahead_sz2,
+                                          **zstd_kwargs))
+
+                return
+
+            if patch_type == PATCH_TYPE_SEGMENTED:
+                (from_compression,
+                 to_size,
+                 segment_size,
+                 segments) = read_header_segmented(finpatch)
+                sizes = [to_size, segment_size]
+            else:
+                (from_compression,
+                 memory_size,
+                 segment_size,
+                 shift_size,
+                 from_size,
+                 to_size,
+                 segments) = read_header_in_place(finpatch)
+                sizes = [
+                    memory_size,
+                    segment_size,
+                    shift_size,
+                    from_size,
+                    to_size
+                ]
+
+            foutpatch.write(pack_header(patch_type, compression_number))
+
+            for size in sizes:
+                foutpatch.write(pack_size(size))
+
+            recompress_segments(finpatch,
+                                foutpatch,
+                                from_compression,
+                                segments,
+                                compression,
+                                heatshrink_window_sz2,
+                                heatshrink_lookahead_sz2,
+                                **zstd_kwargs)
+
+
+def recompress_patches(jobs, workers=None, **kwargs):
+    """Recompress one patch per ``(inpatch, outpatch)`` tuple in `jobs`,
+    using a thread pool of `workers` threads. `kwargs` are passed to
+    recompress_patch(). Returns the execution time in seconds of each
+    patch.
+
+    """
+
+    return run_jobs(recompress_patch, jobs, workers, **kwargs)
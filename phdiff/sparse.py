@@ -0,0 +1,247 @@
+"""Data extents of mostly zero filled files, such as disk images.
+
+The data extents of a file are found by its contents only, so that
+they are the same for a sparse and a fully allocated copy. The file
+is split into blocks of BLOCK_SIZE bytes, and zero filled blocks
+separate data extents if at least MINIMUM_ZERO_SIZE bytes in a row.
+Holes reported by SEEK_HOLE are known to be zero filled and are not
+read.
+
+Extents are ``(offset, size)`` tuples, and are packed as the number of
+extents followed by the gap before and the size of each extent.
+
+"""
+
+import os
+import errno
+import bisect
+from .errors import Error
+from .common import file_size
+from .common import pack_size
+from .common import unpack_size
+
+
+BLOCK_SIZE = 4096
+
+MINIMUM_ZERO_SIZE = 64 * 1024
+
+# Size of the chunks read when searching for zero filled blocks.
+READ_SIZE = 1024 * 1024
+
+ZERO_BLOCK = bytes(BLOCK_SIZE)
+
+ZERO_CHUNK = bytes(READ_SIZE)
+
+
+def data_regions(fin, size):
+    """Returns the ``(begin, end)`` regions of given file that are not
+    holes, or the whole file if holes are not supported.
+
+    """
+
+    if not hasattr(os, 'SEEK_DATA'):
+        return [(0, size)]
+
+    fd = fin.fileno()
+    regions = []
+    offset = 0
+
+    try:
+        while offset < size:
+            try:
+                begin = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                # No data after offset.
+                if e.errno == errno.ENXIO:
+                    break
+
+                raise
+
+            end = os.lseek(fd, begin, os.SEEK_HOLE)
+            regions.append((begin, min(end, size)))
+            offset = end
+    except OSError:
+        return [(0, size)]
+
+    return regions
+
+
+def data_extents(fin, minimum_zero_size=MINIMUM_ZERO_SIZE):
+    """Returns the data extents of given file.
+
+    """
+
+    size = file_size(fin)
+    extents = []
+
+    def add(begin, end):
+        if extents and begin - extents[-1][1] < minimum_zero_size:
+            extents[-1][1] = max(end, extents[-1][1])
+        else:
+            extents.append([begin, end])
+
+    for begin, end in data_regions(fin, size):
+        offset = begin - begin % BLOCK_SIZE
+
+        fin.seek(offset, os.SEEK_SET)
+
+        while offset < end:
+            chunk = fin.read(min(READ_SIZE, end - offset))
+
+            if len(chunk) == 0:
+                raise Error('Out of data.')
+
+            if chunk != ZERO_CHUNK[:len(chunk)]:
+                for i in range(0, len(chunk), BLOCK_SIZE):
+                    block = chunk[i:i + BLOCK_SIZE]
+
+                    if block != ZERO_BLOCK[:len(block)]:
+                        add(offset + i, min(offset + i + BLOCK_SIZE, size))
+
+            offset += len(chunk)
+
+    return [(begin, end - begin) for begin, end in extents]
+
+
+def pack_extents(extents):
+    packed = [pack_size(len(extents))]
+    end = 0
+
+    for offset, size in extents:
+        packed.append(pack_size(offset - end))
+        packed.append(pack_size(size))
+        end = offset + size
+
+    return b''.join(packed)
+
+
+def unpack_extents(fin):
+    extents = []
+    end = 0
+
+    for _ in range(unpack_size(fin)):
+        offset = end + unpack_size(fin)
+        size = unpack_size(fin)
+        extents.append((offset, size))
+        end = offset + size
+
+    return extents
+
+
+def extents_size(extents):
+    return sum([size for _, size in extents])
+
+
+def read_extents(fin, extents):
+    """Returns the data of given extents of `fin`, concatenated.
+
+    """
+
+    data = bytearray(extents_size(extents))
+    view = memoryview(data)
+    position = 0
+
+    for offset, size in extents:
+        fin.seek(offset, os.SEEK_SET)
+
+        if fin.readinto(view[position:position + size]) != size:
+            raise Error('Out of data.')
+
+        position += size
+
+    return data
+
+
+class SparseReader(object):
+    """Read the concatenated data of given extents of `fin` at any
+    position.
+
+    """
+
+    def __init__(self, fin, extents):
+        self._fin = fin
+        self._extents = extents
+        self._positions = []
+        position = 0
+
+        for _, size in extents:
+            self._positions.append(position)
+            position += size
+
+        self.size = position
+
+    def readinto(self, position, buf):
+        view = memoryview(buf).cast('B')
+        index = bisect.bisect_right(self._positions, position) - 1
+        offset = 0
+
+        while offset < len(view):
+            if index < 0 or index >= len(self._extents):
+                raise Error('Out of from data.')
+
+            extent_offset, extent_size = self._extents[index]
+            extent_position = position + offset - self._positions[index]
+            size = min(extent_size - extent_position, len(view) - offset)
+            self._fin.seek(extent_offset + extent_position, os.SEEK_SET)
+
+            if self._fin.readinto(view[offset:offset + size]) != size:
+                raise Error('Out of from data.')
+
+            offset += size
+            index += 1
+
+        return len(view)
+
+
+class SparseWriter(object):
+    """Write the concatenated data of given extents to `fto`, seeking
+    over the gaps between them, so that they become holes in files.
+
+    """
+
+    def __init__(self, fto, extents, size):
+        self._fto = fto
+        self._extents = extents
+        self._size = size
+        self._index = 0
+        self._extent_left = 0
+
+    def write(self, data):
+        view = memoryview(data).cast('B')
+        offset = 0
+
+        while offset < len(view):
+            if self._extent_left == 0:
+                if self._index >= len(self._extents):
+                    raise Error('Too much to data.')
+
+                extent_offset, self._extent_left = self._extents[self._index]
+                self._fto.seek(extent_offset, os.SEEK_SET)
+                self._index += 1
+
+                continue
+
+            size = min(self._extent_left, len(view) - offset)
+            self._fto.write(view[offset:offset + size])
+            self._extent_left -= size
+            offset += size
+
+        return len(view)
+
+    def finish(self):
+        """Make the to data `size` bytes, with a trailing hole if it ends
+        with zeros.
+
+        """
+
+        if self._extent_left > 0 or self._index < len(self._extents):
+            raise Error('Too little to data.')
+
+        self._fto.truncate(self._size)
+
+        # Truncate does not extend memory buffers.
+        if self._fto.seek(0, os.SEEK_END) < self._size:
+            self._fto.seek(self._size - 1, os.SEEK_SET)
+            self._fto.write(b'\x00')
+
+        self._fto.seek(self._size, os.SEEK_SET)
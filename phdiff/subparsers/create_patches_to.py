@@ -0,0 +1,51 @@
+from humanfriendly import format_size
+from humanfriendly import format_timespan
+from ..create import create_patches_to
+from ..common import COMPRESSIONS
+
+
+def _do_create_patches_to(args):
+    fleet_patches = create_patches_to(args.tofile,
+                                      args.fromfiles,
+                                      args.outdir,
+                                      args.compression,
+                                      workers=args.workers,
+                                      match_block_size=args.match_block_size,
+                                      zstd_level=args.zstd_level)
+
+    print('{:40} {:>12} {:>12}'.format('Patch', 'Size', 'Time'))
+
+    for fleet_patch in fleet_patches:
+        print('{:40} {:>12} {:>12}'.format(
+            fleet_patch.patchfile,
+            format_size(fleet_patch.patch_size),
+            format_timespan(fleet_patch.elapsed)))
+
+
+def add_subparser(subparsers):
+    subparser = subparsers.add_parser(
+        'create_patches_to',
+        description='Create one patch per from file to the same to file.')
+    subparser.add_argument(
+        '-c', '--compression',
+        choices=sorted(COMPRESSIONS),
+        default='lzma',
+        help='Compression algorithm (default: %(default)s).')
+    subparser.add_argument(
+        '-w', '--workers',
+        type=int,
+        help='Number of worker threads (default: executor default).')
+    subparser.add_argument(
+        '--match-block-size',
+        type=int,
+        default=64,
+        help='Match block size (default: %(default)s).')
+    subparser.add_argument(
+        '--zstd-level',
+        type=int,
+        default=22,
+        help='Zstd compression level (default: %(default)s).')
+    subparser.add_argument('tofile', help='To file.')
+    subparser.add_argument('outdir', help='Patch output directory.')
+    subparser.add_argument('fromfiles', nargs='+', help='From files.')
+    subparser.set_defaults(func=_do_create_patches_to)
@@ -0,0 +1,47 @@
+import os
+from humanfriendly import format_size
+from ..recompress import recompress_patches
+from ..common import COMPRESSIONS
+
+
+def _do_recompress_patch(args):
+    jobs = [
+        (inpatch, os.path.join(args.outdir, os.path.basename(inpatch)))
+        for inpatch in args.inpatches
+    ]
+    os.makedirs(args.outdir, exist_ok=True)
+    recompress_patches(jobs,
+                       workers=args.workers,
+                       compression=args.compression,
+                       zstd_level=args.zstd_level)
+
+    print('{:40} {:>12} {:>12}'.format('Patch', 'Before', 'After'))
+
+    for inpatch, outpatch in jobs:
+        print('{:40} {:>12} {:>12}'.format(
+            outpatch,
+            format_size(os.path.getsize(inpatch)),
+            format_size(os.path.getsize(outpatch))))
+
+
+def add_subparser(subparsers):
+    subparser = subparsers.add_parser(
+        'recompress_patch',
+        description='Change the compression of patches.')
+    subparser.add_argument(
+        '-c', '--compression',
+        choices=sorted(COMPRESSIONS),
+        required=True,
+        help='New compression algorithm.')
+    subparser.add_argument(
+        '-w', '--workers',
+        type=int,
+        help='Number of worker threads (default: executor default).')
+    subparser.add_argument(
+        '--zstd-level',
+        type=int,
+        default=22,
+        help='Zstd compression level (default: %(default)s).')
+    subparser.add_argument('outdir', help='Patch output directory.')
+    subparser.add_argument('inpatches', nargs='+', help='Patches.')
+    subparser.set_defaults(func=_do_recompress_patch)
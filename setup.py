@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import os
 import re
 from setuptools import setup
 from setuptools import find_packages
@@ -31,6 +32,12 @@ HDIFFPATCH_SOURCES = [
 HDIFFPATCH_SOURCES += ["phdiff/phdiffpatch.cpp"]
 HDIFFPATCH_SOURCES += ["phdiff/HDiffPatch/file_for_patch.c"]
 
+# Build with PHDIFF_OPENMP=1 to sort suffix arrays on multiple threads.
+if os.environ.get('PHDIFF_OPENMP', '0') != '0':
+    OPENMP_ARGS = ['-fopenmp']
+else:
+    OPENMP_ARGS = []
+
 setup(name='phdiff',
       version=find_version(),
       description='Binary delta encoding tools.',      
@@ -52,7 +59,10 @@ setup(name='phdiff',
           'heatshrink2'
       ],
       ext_modules=[        
-          Extension(name="phdiff.phdiffpatch", sources=HDIFFPATCH_SOURCES)
+          Extension(name="phdiff.phdiffpatch",
+                    sources=HDIFFPATCH_SOURCES,
+                    extra_compile_args=OPENMP_ARGS,
+                    extra_link_args=OPENMP_ARGS)
       ],
       test_suite="tests",
       entry_points={
@@ -2,8 +2,34 @@ import logging
 import unittest
 import hashlib
 import os
+import random
+import tracemalloc
+import io
+import tempfile
+import asyncio
+import threading
+import time
+from unittest import mock
+import zstandard
 
 import phdiff
+from phdiff import phdiffpatch
+from phdiff.create import select_algorithm
+from phdiff.create import create_patch_match_blocks
+from phdiff.create import create_compressor
+from phdiff.create import select_compression
+from phdiff.create import write_segments
+from phdiff.create import pack_header
+from phdiff.common import pack_size
+from phdiff.common import pack_size_fixed
+from phdiff.compression.zstd import ZstdDecompressor
+from phdiff.compression.crle import CrleCompressor
+from phdiff.compression.crle import CrleDecompressor
+from phdiff.common import unpack_size
+from phdiff.apply import PatchReader
+from phdiff.apply import read_header_hdiffpatch
+from phdiff.apply import read_patch_type
+from phdiff.aio import CancellableApplier
 
 class DetoolsTest(unittest.TestCase):
 
@@ -37,13 +63,14 @@ class DetoolsTest(unittest.TestCase):
                            patched_filename,
                            **kwargs):
         dir_path = os.path.dirname(os.path.realpath(__file__))
-        phdiff.apply_patch(dir_path+from_filename, dir_path+patch_filename, dir_path+to_filename)
+        phdiff.apply_patch(dir_path+from_filename, dir_path+patch_filename, dir_path+to_filename, **kwargs)
         self.assertEqual(self.md5(dir_path+patched_filename), self.md5(dir_path+to_filename))
 
     def assert_create_and_apply_patch(self,
                                       from_filename,
                                       to_filename,
                                       patch_filename,
+                                      apply_kwargs=None,
                                       **kwargs):
         self.assert_create_patch(from_filename,
                                  to_filename,
@@ -53,7 +80,7 @@ class DetoolsTest(unittest.TestCase):
                                 from_filename+".patched",
                                 patch_filename,
                                 to_filename,
-                                **kwargs)
+                                **(apply_kwargs or {}))
 
   
 
@@ -129,6 +156,1496 @@ class DetoolsTest(unittest.TestCase):
             compression='lz4',
             match_block_size=64)                                     
 
+    def test_create_and_apply_patch_random_match_blocks_hdiffpatch_plzma(self):
+        self.assert_create_and_apply_patch(
+            '/files/from.bin',
+            '/files/to.bin',
+            '/files/match-blocks-hdiffpatch.patch.plzma',
+            compression='plzma',
+            match_block_size=64)
+
+    def test_create_and_apply_patch_random_match_blocks_hdiffpatch_pbz2(self):
+        self.assert_create_and_apply_patch(
+            '/files/from.bin',
+            '/files/to.bin',
+            '/files/match-blocks-hdiffpatch.patch.pbz2',
+            compression='pbz2',
+            match_block_size=64)
+
+    def test_create_and_apply_patch_foo_match_blocks_streaming_none(self):
+        self.assert_create_and_apply_patch(
+            '/files/old.bin',
+            '/files/new.bin',
+            '/files/match-blocks-streaming.patch',
+            compression='none',
+            match_block_size=8,
+            apply_kwargs={'streaming': True, 'cache_size': 0})
+
+    def test_create_and_apply_patch_random_match_blocks_streaming_lzma(self):
+        self.assert_create_and_apply_patch(
+            '/files/from.bin',
+            '/files/to.bin',
+            '/files/match-blocks-streaming.patch.lzma',
+            compression='lzma',
+            match_block_size=64,
+            apply_kwargs={'streaming': True, 'cache_size': 0})
+
+    def test_create_and_apply_patch_random_match_blocks_streaming_crle(self):
+        self.assert_create_and_apply_patch(
+            '/files/from.bin',
+            '/files/to.bin',
+            '/files/match-blocks-streaming.patch.crle',
+            compression='crle',
+            match_block_size=64,
+            apply_kwargs={'streaming': True})
+
+    def test_create_and_apply_patch_random_match_blocks_streaming_zstd(self):
+        self.assert_create_and_apply_patch(
+            '/files/from.bin',
+            '/files/to.bin',
+            '/files/match-blocks-streaming.patch.zstd',
+            compression='zstd',
+            match_block_size=64,
+            apply_kwargs={'streaming': True})
+
+
+    def test_create_and_apply_patch_random_match_blocks_mmap_lzma(self):
+        self.assert_create_and_apply_patch(
+            '/files/from.bin',
+            '/files/to.bin',
+            '/files/match-blocks-mmap.patch.lzma',
+            compression='lzma',
+            match_block_size=64,
+            apply_kwargs={'use_mmap': True})
+
+    def test_create_and_apply_patch_empty_from_mmap(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__)) + '/files/'
+
+        with open(dir_path + 'empty.bin', 'wb'):
+            pass
+
+        self.assert_create_and_apply_patch(
+            '/files/empty.bin',
+            '/files/to.bin',
+            '/files/empty-mmap.patch',
+            compression='none',
+            algorithm='suffix-array',
+            apply_kwargs={'use_mmap': True})
+
+    def test_apply_patch_to_buffer(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__)) + '/files/'
+        self.assert_create_patch('/files/from.bin',
+                                 '/files/to.bin',
+                                 '/files/to-buffer.patch',
+                                 compression='none',
+                                 match_block_size=64)
+
+        with open(dir_path + 'from.bin', 'rb') as fin:
+            from_data = bytearray(fin.read())
+
+        with open(dir_path + 'to.bin', 'rb') as fin:
+            to_data = fin.read()
+
+        with open(dir_path + 'to-buffer.patch', 'rb') as fpatch:
+            _, to_size, patch_size = read_header_hdiffpatch(fpatch)
+            patch_data = memoryview(fpatch.read(patch_size))
+
+        buf = bytearray(to_size)
+        self.assertEqual(phdiff.phdiffpatch.apply_patch(from_data,
+                                                        patch_data,
+                                                        buf),
+                         len(to_data))
+        self.assertEqual(buf, to_data)
+        self.assertEqual(phdiff.phdiffpatch.apply_patch(from_data,
+                                                        patch_data),
+                         to_data)
+
+        with self.assertRaises(ValueError) as cm:
+            phdiff.phdiffpatch.apply_patch(from_data,
+                                           patch_data,
+                                           bytearray(to_size + 1))
+
+        self.assertEqual(str(cm.exception),
+                         'Expected to size {}, but got {}.'.format(
+                             to_size,
+                             to_size + 1))
+
+        with self.assertRaises(RuntimeError) as cm:
+            phdiff.phdiffpatch.apply_patch(from_data[1:], patch_data)
+
+        self.assertEqual(str(cm.exception),
+                         'Expected from size {}, but got {}.'.format(
+                             len(from_data),
+                             len(from_data) - 1))
+
+        with self.assertRaises(RuntimeError) as cm:
+            phdiff.phdiffpatch.apply_patch(from_data, patch_data[:-10])
+
+        self.assertEqual(str(cm.exception), 'Patch apply failed.')
+
+    def test_patch_applier(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__)) + '/files/'
+        self.assert_create_patch('/files/from.bin',
+                                 '/files/to.bin',
+                                 '/files/applier.patch',
+                                 compression='zstd',
+                                 match_block_size=64)
+
+        with phdiff.PatchApplier(cache_size=1024 * 1024) as applier:
+            self.assertEqual(applier.cache_size, 1024 * 1024)
+            self.assertEqual(applier.allocated_cache_size, 0)
+
+            for streaming in [False, True, False]:
+                self.assert_apply_patch('/files/from.bin',
+                                        '/files/applier.patched',
+                                        '/files/applier.patch',
+                                        '/files/to.bin',
+                                        streaming=streaming,
+                                        applier=applier)
+                self.assertEqual(applier.allocated_cache_size, 1024 * 1024)
+
+        self.assertEqual(applier.allocated_cache_size, 0)
+
+        with self.assertRaises(ValueError) as cm:
+            phdiff.PatchApplier(-1)
+
+        self.assertEqual(str(cm.exception), 'Negative cache size.')
+
+    def test_patch_applier_pool(self):
+        with phdiff.PatchApplierPool(size=2, cache_size=8192) as pool:
+            with pool.checkout() as applier_1:
+                with pool.checkout() as applier_2:
+                    self.assertIsNot(applier_1, applier_2)
+                    self.assertEqual(applier_2.cache_size, 8192)
+
+            with pool.checkout() as applier_3:
+                self.assertIs(applier_3, applier_1)
+
+    def test_apply_patch_streaming_and_mmap(self):
+        with self.assertRaises(phdiff.Error) as cm:
+            phdiff.apply_patch('from.bin',
+                               'foo.patch',
+                               'to.bin',
+                               streaming=True,
+                               use_mmap=True)
+
+        self.assertEqual(str(cm.exception),
+                         'Streaming and memory mapping cannot be combined.')
+
+    def test_create_and_apply_patch_suffix_array_threads(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__)) + '/files/'
+        rng = random.Random(1)
+        from_data = bytes(rng.getrandbits(8) for _ in range(300000))
+        to_data = bytearray(from_data)
+
+        for _ in range(100):
+            offset = rng.randrange(len(to_data) - 16)
+            to_data[offset:offset + 16] = bytes(16)
+
+        with open(dir_path + 'large-from.bin', 'wb') as fout:
+            fout.write(from_data)
+
+        with open(dir_path + 'large-to.bin', 'wb') as fout:
+            fout.write(to_data)
+
+        patches = []
+
+        for threads in [1, 2, 4]:
+            self.assert_create_and_apply_patch(
+                '/files/large-from.bin',
+                '/files/large-to.bin',
+                '/files/suffix-array-threads.patch',
+                compression='lzma',
+                match_block_size=0,
+                threads=threads)
+
+            with open(dir_path + 'suffix-array-threads.patch', 'rb') as fin:
+                patches.append(fin.read())
+
+        # Identical for any number of threads.
+        self.assertEqual(patches[1], patches[0])
+        self.assertEqual(patches[2], patches[0])
+
+    def test_create_and_apply_patch_random_suffix_array_lzma(self):
+        self.assert_create_and_apply_patch(
+            '/files/from.bin',
+            '/files/to.bin',
+            '/files/suffix-array.patch.lzma',
+            compression='lzma',
+            algorithm='suffix-array',
+            match_score=0)
+
+    def test_create_and_apply_patch_random_auto_zstd(self):
+        self.assert_create_and_apply_patch(
+            '/files/from.bin',
+            '/files/to.bin',
+            '/files/auto.patch.zstd',
+            compression='zstd',
+            algorithm='auto')
+
+    def test_create_patch_bad_algorithm(self):
+        with self.assertRaises(phdiff.Error) as cm:
+            self.assert_create_patch('/files/from.bin',
+                                     '/files/to.bin',
+                                     '/files/bad.patch',
+                                     compression='none',
+                                     algorithm='foo')
+
+        self.assertEqual(
+            str(cm.exception),
+            "Expected algorithm suffix-array, match-blocks, zstd or auto, "
+            "but got foo.")
+
+    def test_select_algorithm(self):
+        self.assertEqual(select_algorithm(1000, 1000, None), 'suffix-array')
+        self.assertEqual(select_algorithm(1000, 1000, 1000000),
+                         'suffix-array')
+        self.assertEqual(select_algorithm(10 ** 9, 10 ** 9, 4 * 10 ** 9),
+                         'match-blocks')
+
+    def test_create_and_apply_patch_random_match_blocks_zstd_options(self):
+        self.assert_create_and_apply_patch(
+            '/files/from.bin',
+            '/files/to.bin',
+            '/files/match-blocks-options.patch.zstd',
+            compression='zstd',
+            match_block_size=64,
+            zstd_level=3,
+            zstd_threads=2,
+            zstd_window_log=20,
+            zstd_long_distance_matching=True)
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+
+        with open(dir_path + '/files/match-blocks-options.patch.zstd', 'rb') as fpatch:
+            _, info = phdiff.patch_info(fpatch)
+
+        self.assertEqual(info[1], 'zstd')
+        self.assertEqual(info[2], {'window-log': 20})
+
+    def test_zstd_decompress_without_header(self):
+        compressed = zstandard.ZstdCompressor(level=22).compress(b'1234' * 100)
+        decompressor = ZstdDecompressor(len(compressed))
+
+        self.assertEqual(decompressor.decompress(compressed, 400),
+                         b'1234' * 100)
+        self.assertEqual(decompressor.window_log, 27)
+        self.assertTrue(decompressor.eof)
+
+    def test_zstd_decompress_bounded(self):
+        data = os.urandom(1000) + bytes(16 * 1024 * 1024) + b'end'
+        compressed = zstandard.ZstdCompressor(level=3).compress(data)
+        decompressor = ZstdDecompressor(len(compressed))
+        hasher = hashlib.sha256()
+        chunk = decompressor.decompress(compressed, 1000)
+        tracemalloc.start()
+
+        while not decompressor.eof:
+            hasher.update(chunk)
+            chunk = decompressor.decompress(b'', 65536)
+            self.assertLessEqual(len(chunk), 65536)
+
+        hasher.update(chunk)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertLess(peak, 1024 * 1024)
+        self.assertEqual(hasher.digest(), hashlib.sha256(data).digest())
+
+        decompressor = ZstdDecompressor(len(compressed))
+        buf = bytearray(len(data))
+        size = decompressor.decompress_into(compressed[:10], buf)
+
+        while not decompressor.eof:
+            if decompressor.needs_input:
+                data_chunk = compressed[10:]
+                compressed = compressed[:10]
+            else:
+                data_chunk = b''
+
+            size += decompressor.decompress_into(data_chunk,
+                                                 memoryview(buf)[size:])
+
+        self.assertEqual(size, len(data))
+        self.assertEqual(bytes(buf), data)
+
+    def test_pack_size_fixed(self):
+        for value in [0, 1, 63, 64, 1000, 2 ** 40, 2 ** 64 - 1]:
+            packed = pack_size_fixed(value, 10)
+            self.assertEqual(len(packed), 10)
+            self.assertEqual(unpack_size(io.BytesIO(packed)), value)
+
+    def test_create_patch_match_blocks_not_seekable(self):
+        class NotSeekable(io.BytesIO):
+            def seekable(self):
+                return False
+
+        dir_path = os.path.dirname(os.path.realpath(__file__)) + '/files/'
+
+        with open(dir_path + 'from.bin', 'rb') as ffrom:
+            with open(dir_path + 'to.bin', 'rb') as fto:
+                fseekable = io.BytesIO()
+                create_patch_match_blocks(ffrom, fto, fseekable, 'lzma', 64,
+                                          False, 8, 7)
+                fnotseekable = NotSeekable()
+                create_patch_match_blocks(ffrom, fto, fnotseekable, 'lzma', 64,
+                                          False, 8, 7)
+
+        for fpatch in [fseekable, fnotseekable]:
+            with open(dir_path + 'not-seekable.patch', 'wb') as fout:
+                fout.write(fpatch.getvalue())
+
+            self.assert_apply_patch('/files/from.bin',
+                                    '/files/not-seekable.patched',
+                                    '/files/not-seekable.patch',
+                                    '/files/to.bin')
+
+    def test_create_and_apply_patches(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__)) + '/files/'
+        create_jobs = [
+            (dir_path + 'from.bin',
+             dir_path + 'to.bin',
+             dir_path + 'batch-{}.patch'.format(i))
+            for i in range(4)
+        ]
+        apply_jobs = [
+            (from_filename, patch_filename, patch_filename + '.patched')
+            for from_filename, _, patch_filename in create_jobs
+        ]
+
+        times = phdiff.create_patches(create_jobs,
+                                      workers=2,
+                                      compression='lzma',
+                                      match_block_size=64)
+        self.assertEqual(len(times), len(create_jobs))
+        times = phdiff.apply_patches(apply_jobs, workers=2)
+        self.assertEqual(len(times), len(apply_jobs))
+
+        for _, _, to_filename in apply_jobs:
+            self.assertEqual(self.md5(to_filename),
+                             self.md5(dir_path + 'to.bin'))
+
+    def test_create_patches_to(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__)) + '/files/'
+        outdir = dir_path + 'fleet'
+        from_filenames = [dir_path + 'from.bin', dir_path + 'old.bin']
+
+        fleet_patches = phdiff.create_patches_to(dir_path + 'to.bin',
+                                                 from_filenames,
+                                                 outdir,
+                                                 'lzma',
+                                                 workers=2)
+        self.assertEqual([fleet_patch.fromfile
+                          for fleet_patch in fleet_patches],
+                         from_filenames)
+
+        for fleet_patch in fleet_patches:
+            self.assertEqual(fleet_patch.patchfile,
+                             os.path.join(
+                                 outdir,
+                                 os.path.basename(fleet_patch.fromfile)
+                                 + '.patch'))
+            self.assertEqual(fleet_patch.patch_size,
+                             self.getSize(fleet_patch.patchfile))
+            to_filename = fleet_patch.patchfile + '.patched'
+            phdiff.apply_patch(fleet_patch.fromfile,
+                               fleet_patch.patchfile,
+                               to_filename)
+            self.assertEqual(self.md5(to_filename),
+                             self.md5(dir_path + 'to.bin'))
+
+        with self.assertRaises(phdiff.Error) as cm:
+            phdiff.create_patches_to(dir_path + 'to.bin',
+                                     [dir_path + 'from.bin'] * 2,
+                                     outdir,
+                                     'lzma')
+
+        self.assertEqual(str(cm.exception),
+                         'Expected from files with unique names.')
+
+    def test_create_and_apply_patch_segmented(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__)) + '/files/'
+        from_filename = dir_path + 'from.bin'
+        to_filename = dir_path + 'to.bin'
+        patch_filename = dir_path + 'segmented.patch'
+        patched_filename = dir_path + 'segmented.patch.patched'
+
+        with open(to_filename, 'rb') as fin:
+            to_data = fin.read()
+
+        for algorithm in ['suffix-array', 'match-blocks']:
+            phdiff.create_patch(from_filename,
+                                to_filename,
+                                patch_filename,
+                                'lzma',
+                                algorithm=algorithm,
+                                segment_size=256,
+                                threads=2)
+            patch_type, info = phdiff.patch_info_filename(patch_filename)
+            self.assertEqual(patch_type, 'segmented')
+            self.assertEqual(info[1:4], ('lzma', len(to_data), 256))
+            self.assertEqual(len(info[4]), 4)
+
+            for kwargs in [{}, {'workers': 2}, {'use_mmap': True},
+                           {'streaming': True}]:
+                phdiff.apply_patch(from_filename,
+                                   patch_filename,
+                                   patched_filename,
+                                   **kwargs)
+                self.assertEqual(self.md5(patched_filename),
+                                 self.md5(to_filename))
+
+            self.assertEqual(phdiff.apply_patch_range(from_filename,
+                                                      patch_filename,
+                                                      200,
+                                                      500),
+                             to_data[200:700])
+
+        with self.assertRaises(phdiff.Error) as cm:
+            phdiff.apply_patch_range(from_filename,
+                                     patch_filename,
+                                     len(to_data),
+                                     1)
+
+        self.assertEqual(
+            str(cm.exception),
+            'Expected a range within the {} bytes to data, but got 1 bytes '
+            'at offset {}.'.format(len(to_data), len(to_data)))
+
+    def test_write_segments_bounded(self):
+        written = []
+        ahead = []
+
+        class Writer(io.BytesIO):
+
+            def write(self, data):
+                written.append(data)
+
+                return super().write(data)
+
+        def create_segment(segment):
+            # The first write is the index.
+            ahead.append(segment - (len(written) - 1))
+
+            return 1, bytes([segment])
+
+        fpatch = Writer()
+        write_segments(fpatch, 100, create_segment, 2)
+
+        self.assertEqual(len(ahead), 100)
+        self.assertLessEqual(max(ahead), 4)
+        self.assertEqual(fpatch.getvalue()[-100:], bytes(range(100)))
+
+    def test_apply_patch_resumable(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__)) + '/files/'
+        from_filename = dir_path + 'from.bin'
+        patch_filename = dir_path + 'resumable.patch'
+        to_filename = dir_path + 'resumable.patch.patched'
+        checkpoint_filename = to_filename + '.checkpoint'
+        phdiff.create_patch(from_filename,
+                            dir_path + 'to.bin',
+                            patch_filename,
+                            'lzma',
+                            segment_size=256)
+
+        class Interrupted(Exception):
+            pass
+
+        class InterruptingApplier(object):
+
+            def __init__(self, applier, number_of_segments):
+                self.applier = applier
+                self.number_of_segments = number_of_segments
+                self.calls = 0
+
+            def apply_patch(self, *args):
+                if self.calls == self.number_of_segments:
+                    raise Interrupted()
+
+                self.calls += 1
+
+                return self.applier.apply_patch(*args)
+
+        if os.path.exists(checkpoint_filename):
+            os.remove(checkpoint_filename)
+
+        with phdiff.PatchApplier() as applier:
+            with self.assertRaises(Interrupted):
+                phdiff.apply_patch_resumable(
+                    from_filename,
+                    patch_filename,
+                    to_filename,
+                    applier=InterruptingApplier(applier, 2))
+
+            self.assertTrue(os.path.exists(checkpoint_filename))
+            resuming_applier = InterruptingApplier(applier, 4)
+            phdiff.apply_patch_resumable(from_filename,
+                                         patch_filename,
+                                         to_filename,
+                                         applier=resuming_applier)
+
+        # Only the last two of four segments are applied when resuming.
+        self.assertEqual(resuming_applier.calls, 2)
+        self.assertFalse(os.path.exists(checkpoint_filename))
+        self.assertEqual(self.md5(to_filename),
+                         self.md5(dir_path + 'to.bin'))
+
+        # Other patches cannot be resumed.
+        phdiff.create_patch(from_filename,
+                            dir_path + 'to.bin',
+                            patch_filename,
+                            'lzma')
+
+        with self.assertRaises(phdiff.Error) as cm:
+            phdiff.apply_patch_resumable(from_filename,
+                                         patch_filename,
+                                         to_filename)
+
+        self.assertEqual(
+            str(cm.exception),
+            'Only segmented patches, created with a segment size, can be '
+            'applied resumably.')
+
+    def test_create_and_apply_patch_in_place(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__)) + '/files/'
+        from_filename = dir_path + 'in-place-from.bin'
+        to_filename = dir_path + 'in-place-to.bin'
+        patch_filename = dir_path + 'in-place.patch'
+        memory_filename = dir_path + 'in-place.patch.patched'
+        rng = random.Random(0)
+        from_data = rng.randbytes(256 * 1024)
+        to_data = bytearray(from_data[1000:])
+
+        for _ in range(100):
+            to_data[rng.randrange(len(to_data))] = rng.getrandbits(8)
+
+        to_data = rng.randbytes(3000) + to_data + rng.randbytes(20000)
+
+        with open(from_filename, 'wb') as fout:
+            fout.write(from_data)
+
+        with open(to_filename, 'wb') as fout:
+            fout.write(to_data)
+
+        segment_size = 16384
+        phdiff.create_patch(from_filename,
+                            to_filename,
+                            patch_filename,
+                            'crle',
+                            algorithm='match-blocks',
+                            memory_size=512 * 1024,
+                            segment_size=segment_size)
+
+        with open(memory_filename, 'wb') as fout:
+            fout.write(from_data)
+
+        tracemalloc.start()
+
+        try:
+            phdiff.apply_patch_in_place(memory_filename, patch_filename)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.assertLess(peak, 8 * segment_size)
+        patch_type, info = phdiff.patch_info_filename(patch_filename)
+        self.assertEqual(patch_type, 'in-place')
+        self.assertEqual(info[1:7],
+                         ('crle',
+                          512 * 1024,
+                          segment_size,
+                          262144,
+                          len(from_data),
+                          len(to_data)))
+
+        with open(memory_filename, 'rb') as fin:
+            self.assertEqual(fin.read(), to_data)
+
+        with self.assertRaises(phdiff.Error) as cm:
+            phdiff.apply_patch(from_filename,
+                               patch_filename,
+                               memory_filename)
+
+        self.assertEqual(
+            str(cm.exception),
+            'An in-place patch must be applied with apply_patch_in_place().')
+
+        with self.assertRaises(phdiff.Error) as cm:
+            phdiff.create_patch(from_filename,
+                                to_filename,
+                                patch_filename,
+                                'crle',
+                                memory_size=256 * 1024,
+                                segment_size=segment_size)
+
+        self.assertEqual(
+            str(cm.exception),
+            'Expected from size plus shift size 294912 to fit in memory '
+            'size 262144.')
+
+    def test_create_and_apply_patch_zstd_algorithm(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__)) + '/files/'
+        from_filename = dir_path + 'from.bin'
+        to_filename = dir_path + 'to.bin'
+        patch_filename = dir_path + 'zstd-algorithm.patch'
+        patched_filename = dir_path + 'zstd-algorithm.patch.patched'
+        phdiff.create_patch(from_filename,
+                            to_filename,
+                            patch_filename,
+                            'zstd',
+                            algorithm='zstd',
+                            zstd_level=3)
+        patch_type, info = phdiff.patch_info_filename(patch_filename)
+        self.assertEqual(patch_type, 'zstd')
+        self.assertEqual(info[1:],
+                         ('zstd',
+                          {'window-log': 11},
+                          self.getSize(to_filename),
+                          self.getSize(from_filename)))
+
+        for kwargs in [{}, {'streaming': True}, {'use_mmap': True}]:
+            phdiff.apply_patch(from_filename,
+                               patch_filename,
+                               patched_filename,
+                               **kwargs)
+            self.assertEqual(self.md5(patched_filename),
+                             self.md5(to_filename))
+
+        # The zstd algorithm defaults to a fast level, unlike zstd
+        # compression.
+        with open(patch_filename, 'rb') as fin:
+            level_3_patch = fin.read()
+
+        with mock.patch('phdiff.create.ZstdPatchFromCompressor',
+                        wraps=phdiff.create.ZstdPatchFromCompressor) as cls:
+            phdiff.create_patch(from_filename,
+                                to_filename,
+                                patch_filename,
+                                'zstd',
+                                algorithm='zstd')
+
+        self.assertEqual(cls.call_args[0][2], 3)
+
+        with open(patch_filename, 'rb') as fin:
+            self.assertEqual(fin.read(), level_3_patch)
+
+        with self.assertRaises(phdiff.Error) as cm:
+            phdiff.create_patch(from_filename,
+                                to_filename,
+                                patch_filename,
+                                'lzma',
+                                algorithm='zstd')
+
+        self.assertEqual(str(cm.exception),
+                         'The zstd algorithm requires zstd compression.')
+
+        # From and to data larger than the largest window. The from file
+        # is a hole, so nothing is allocated.
+        with tempfile.TemporaryDirectory() as directory:
+            large_from_filename = os.path.join(directory, 'from.bin')
+
+            with open(large_from_filename, 'wb') as fout:
+                fout.truncate(2 ** 31 - 100)
+
+            with self.assertRaises(phdiff.Error) as cm:
+                phdiff.create_patch(large_from_filename,
+                                    to_filename,
+                                    os.path.join(directory, 'patch'),
+                                    'zstd',
+                                    algorithm='zstd')
+
+        self.assertEqual(
+            str(cm.exception),
+            'Expected from and to sizes of at most 2147483648 bytes in '
+            'total for a zstd patch-from patch, but got {}.'.format(
+                2 ** 31 - 100 + self.getSize(to_filename)))
+
+    def test_recompress_patch(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__)) + '/files/'
+        from_filename = dir_path + 'from.bin'
+        to_filename = dir_path + 'to.bin'
+        patch_filenames = [
+            dir_path + 'recompress.patch',
+            dir_path + 'recompress-segmented.patch'
+        ]
+        phdiff.create_patch(from_filename,
+                            to_filename,
+                            patch_filenames[0],
+                            'lzma')
+        phdiff.create_patch(from_filename,
+                            to_filename,
+                            patch_filenames[1],
+                            'lzma',
+                            segment_size=256)
+        jobs = [
+            (patch_filename, patch_filename + '.lz4')
+            for patch_filename in patch_filenames
+        ]
+        times = phdiff.recompress_patches(jobs, workers=2, compression='lz4')
+        self.assertEqual(len(times), len(jobs))
+
+        for _, recompressed_filename in jobs:
+            self.assertEqual(
+                phdiff.patch_info_filename(recompressed_filename)[1][1],
+                'lz4')
+            phdiff.recompress_patch(recompressed_filename,
+                                    recompressed_filename + '.crle',
+                                    'crle')
+
+            for filename in [recompressed_filename,
+                             recompressed_filename + '.crle']:
+                phdiff.apply_patch(from_filename,
+                                   filename,
+                                   filename + '.patched')
+                self.assertEqual(self.md5(filename + '.patched'),
+                                 self.md5(to_filename))
+
+    def test_patch_reader_readinto(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__)) + '/files/'
+
+        for compression in phdiff._COMPRESSIONS:
+            patch_filename = dir_path + 'patch-reader.patch.' + compression
+            phdiff.create_patch(dir_path + 'from.bin',
+                                dir_path + 'to.bin',
+                                patch_filename,
+                                compression=compression,
+                                match_block_size=64)
+
+            with open(patch_filename, 'rb') as fpatch:
+                _, _, patch_size = read_header_hdiffpatch(fpatch)
+                expected = PatchReader(fpatch, compression).read(patch_size)
+
+            with open(patch_filename, 'rb') as fpatch:
+                read_header_hdiffpatch(fpatch)
+                patch_reader = PatchReader(fpatch,
+                                           compression,
+                                           block_size=37)
+                buf = bytearray(patch_size)
+                view = memoryview(buf)
+
+                for offset in range(0, patch_size, 100):
+                    chunk = view[offset:offset + 100]
+                    self.assertEqual(patch_reader.readinto(chunk), len(chunk))
+
+            self.assertEqual(buf, expected)
+
+    def test_create_and_apply_patch_from_index(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__)) + '/files/'
+        self.assert_create_patch('/files/from.bin',
+                                 '/files/to.bin',
+                                 '/files/from-index-none.patch',
+                                 compression='lzma',
+                                 algorithm='suffix-array')
+
+        with phdiff.create_from_index(dir_path + 'from.bin',
+                                      dir_path + 'from.bin.index') as index:
+            self.assertEqual(index.from_size, self.getSize(dir_path + 'from.bin'))
+
+            for from_index in [index, dir_path + 'from.bin.index']:
+                self.assert_create_and_apply_patch('/files/from.bin',
+                                                   '/files/to.bin',
+                                                   '/files/from-index.patch',
+                                                   compression='lzma',
+                                                   from_index=from_index)
+
+                with open(dir_path + 'from-index.patch', 'rb') as fin:
+                    with open(dir_path + 'from-index-none.patch', 'rb') as fin2:
+                        self.assertEqual(fin.read(), fin2.read())
+
+            with self.assertRaises(phdiff.Error) as cm:
+                phdiff.create_patch(dir_path + 'to.bin',
+                                    dir_path + 'from.bin',
+                                    dir_path + 'from-index.patch',
+                                    'none',
+                                    from_index=index)
+
+            self.assertEqual(
+                str(cm.exception),
+                "From index '{}' does not match the from data.".format(
+                    dir_path + 'from.bin.index'))
+
+            with self.assertRaises(phdiff.Error) as cm:
+                phdiff.create_patch(dir_path + 'from.bin',
+                                    dir_path + 'to.bin',
+                                    dir_path + 'from-index.patch',
+                                    'none',
+                                    algorithm='match-blocks',
+                                    from_index=index)
+
+            self.assertEqual(
+                str(cm.exception),
+                'A from index can only be used by the suffix-array algorithm.')
+
+        with self.assertRaises(phdiff.Error) as cm:
+            phdiff.FromIndex(dir_path + 'from.bin')
+
+        self.assertEqual(str(cm.exception), 'Not a from index.')
+
+    def test_crle(self):
+        compressor = CrleCompressor()
+        self.assertEqual(compressor.flush(), b'\x00\x00')
+        compressor = CrleCompressor()
+        self.assertEqual(compressor.compress(b'abcdddddddde') + compressor.flush(),
+                         b'\x00\x03abc\x01\x08d\x00\x01e')
+
+        rng = random.Random(2)
+        data = bytearray(8 * 1024 * 1024)
+
+        for _ in range(len(data) // 64):
+            data[rng.randrange(len(data))] = rng.getrandbits(8)
+
+        data += rng.randbytes(3 * 1024 * 1024)
+        compressor = CrleCompressor()
+        compressed = b''.join([compressor.compress(data[offset:offset + 1000])
+                               for offset in range(0, len(data), 1000)])
+        compressed += compressor.flush()
+        decompressor = CrleDecompressor(len(compressed))
+        decompressed = bytearray(len(data))
+        view = memoryview(decompressed)
+        size = 0
+
+        for offset in range(0, len(compressed), 4096):
+            chunk = compressed[offset:offset + 4096]
+
+            while True:
+                size += decompressor.decompress_into(chunk, view[size:])
+                chunk = b''
+
+                if decompressor.needs_input or decompressor.eof:
+                    break
+
+        self.assertTrue(decompressor.eof)
+        self.assertEqual(decompressed, data)
+
+    def test_block_compression(self):
+        rng = random.Random(0)
+        data = bytearray(b''.join([bytes(range(256))] * 12000))
+
+        for _ in range(1000):
+            data[rng.randrange(len(data))] = rng.getrandbits(8)
+
+        data = bytes(data)
+
+        for compression in ['plzma', 'pbz2']:
+            compressor = create_compressor(compression, 8, 7)
+            compressed = b''
+
+            for offset in range(0, len(data), 100000):
+                compressed += compressor.compress(data[offset:offset + 100000])
+
+            compressed += compressor.flush()
+            patch_reader = PatchReader(io.BytesIO(compressed),
+                                       compression,
+                                       block_size=4096)
+            decompressed = bytearray(len(data))
+            view = memoryview(decompressed)
+
+            for offset in range(0, len(data), 300000):
+                patch_reader.readinto(view[offset:offset + 300000])
+
+            self.assertEqual(decompressed, data)
+            self.assertTrue(patch_reader.eof)
+
+    def test_patch_reader_bad_block_size(self):
+        with self.assertRaises(phdiff.Error) as cm:
+            PatchReader(io.BytesIO(), 'none', block_size=0)
+
+        self.assertEqual(str(cm.exception),
+                         'Expected a positive block size, but got 0.')
+
+    def test_create_and_apply_patch_auto_compression(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        from_filename = dir_path + '/files/from.bin'
+        to_filename = dir_path + '/files/to.bin'
+        patch_filename = dir_path + '/files/auto-compression.patch'
+        patched_filename = dir_path + '/files/auto-compression.patched'
+
+        for algorithm in ['match-blocks', 'suffix-array']:
+            phdiff.create_patch(from_filename,
+                                to_filename,
+                                patch_filename,
+                                'auto',
+                                algorithm=algorithm)
+            phdiff.apply_patch(from_filename, patch_filename, patched_filename)
+            self.assertEqual(self.md5(patched_filename),
+                             self.md5(to_filename))
+
+            with open(patch_filename, 'rb') as fpatch:
+                patch_type, info = phdiff.patch_info(fpatch)
+
+            self.assertEqual(patch_type, 'hdiffpatch')
+            self.assertNotEqual(info[1], 'auto')
+
+        with self.assertRaises(phdiff.Error) as cm:
+            phdiff.create_patch(from_filename,
+                                to_filename,
+                                patch_filename,
+                                'auto',
+                                maximum_compression_time=-1)
+
+        self.assertEqual(str(cm.exception),
+                         'No compression is within the time and speed limits.')
+
+        with self.assertRaises(phdiff.Error) as cm:
+            phdiff.create_patch(from_filename,
+                                to_filename,
+                                patch_filename,
+                                'auto',
+                                segment_size=256)
+
+        self.assertEqual(
+            str(cm.exception),
+            'Automatic compression selection cannot be used by zstd, '
+            'segmented or in-place patches.')
+
+    def test_select_compression(self):
+        patch = b''.join([bytes(range(256))] * 64)
+        selected, candidates = select_compression(patch)
+
+        self.assertEqual(selected.size,
+                         min([candidate.size for candidate in candidates]))
+        self.assertIn('none', [candidate.compression
+                               for candidate in candidates])
+
+        # Only the compressed data of the selected candidate is kept.
+        self.assertEqual([candidate
+                          for candidate in candidates
+                          if candidate.compressed is not None],
+                         [selected])
+        self.assertEqual(len(selected.compressed), selected.size)
+
+        limited, _ = select_compression(patch,
+                                        minimum_decompression_speed=0,
+                                        maximum_compression_time=3600,
+                                        workers=1)
+        self.assertEqual(limited.size, selected.size)
+        self.assertEqual(limited.compression, selected.compression)
+        self.assertEqual(limited.parameters, selected.parameters)
+
+    def test_patch_cache(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        from_filename = dir_path + '/files/from.bin'
+        to_filename = dir_path + '/files/to.bin'
+        patched_filename = dir_path + '/files/cache.patched'
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = phdiff.PatchCache(directory,
+                                      1024 * 1024,
+                                      algorithm='match-blocks')
+            results = []
+
+            def open_patch():
+                with cache.open(from_filename, to_filename, 'lzma') as fpatch:
+                    results.append(fpatch.read())
+
+            threads = [threading.Thread(target=open_patch) for _ in range(4)]
+
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(cache.misses, 1)
+            self.assertEqual(cache.hits, 3)
+            self.assertEqual(len(set(results)), 1)
+            self.assertEqual(len(cache), 1)
+            self.assertEqual(cache.size, len(results[0]))
+
+            # Threads are not part of the key.
+            with cache.open(from_filename,
+                            to_filename,
+                            'lzma',
+                            threads=2) as fpatch:
+                self.assertEqual(fpatch.read(), results[0])
+
+                phdiff.apply_patch(from_filename,
+                                   fpatch.name,
+                                   patched_filename)
+
+            self.assertEqual(self.md5(patched_filename),
+                             self.md5(to_filename))
+            self.assertEqual(cache.misses, 1)
+
+            # Parameters given their default values use the cached patch.
+            self.assertEqual(
+                cache.key(from_filename, to_filename, 'lzma'),
+                cache.key(from_filename,
+                          to_filename,
+                          'lzma',
+                          match_block_size=64,
+                          trim=False))
+
+            with cache.open(from_filename,
+                            to_filename,
+                            'lzma',
+                            match_block_size=64,
+                            algorithm='match-blocks') as fpatch:
+                self.assertEqual(fpatch.read(), results[0])
+
+            self.assertEqual(cache.misses, 1)
+            self.assertNotEqual(
+                cache.key(from_filename, to_filename, 'lzma'),
+                cache.key(from_filename,
+                          to_filename,
+                          'lzma',
+                          match_block_size=128))
+
+            # A cache too small for both patches keeps the most recently
+            # used patch only.
+            bz2_filename = dir_path + '/files/cache.patch.bz2'
+            phdiff.create_patch(from_filename,
+                                to_filename,
+                                bz2_filename,
+                                'bz2',
+                                algorithm='match-blocks')
+            cache = phdiff.PatchCache(
+                directory,
+                cache.size + os.path.getsize(bz2_filename) - 1,
+                algorithm='match-blocks')
+            self.assertEqual(len(cache), 1)
+
+            with cache.open(from_filename, to_filename, 'bz2') as fpatch:
+                bz2_patch = fpatch.read()
+
+            self.assertEqual(cache.misses, 1)
+            self.assertEqual(len(cache), 1)
+            self.assertEqual(cache.size, len(bz2_patch))
+            self.assertEqual(self.getSize(bz2_filename), len(bz2_patch))
+            self.assertEqual(len(os.listdir(directory)), 1)
+
+            cache.clear()
+            self.assertEqual(cache.size, 0)
+            self.assertEqual(os.listdir(directory), [])
+
+            # A patch larger than the cache is still created once for
+            # concurrent requests.
+            cache = phdiff.PatchCache(directory, 0, algorithm='match-blocks')
+            create_patch = phdiff.cache.create_patch
+            results = []
+
+            def create_patch_once_all_wait(*args, **kwargs):
+                while cache.hits < 3:
+                    time.sleep(0.001)
+
+                create_patch(*args, **kwargs)
+
+            with mock.patch('phdiff.cache.create_patch',
+                            side_effect=create_patch_once_all_wait) as create:
+                threads = [
+                    threading.Thread(target=open_patch) for _ in range(4)
+                ]
+
+                for thread in threads:
+                    thread.start()
+
+                for thread in threads:
+                    thread.join()
+
+            self.assertEqual(create.call_count, 1)
+            self.assertEqual(cache.misses, 1)
+            self.assertEqual(len(results), 4)
+            self.assertEqual(len(set(results)), 1)
+            self.assertEqual(len(cache), 0)
+            self.assertEqual(os.listdir(directory), [])
+
+    def test_patch_cache_cancelled(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        from_filename = dir_path + '/files/from.bin'
+        to_filename = dir_path + '/files/to.bin'
+        create_patch = phdiff.cache.create_patch
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = phdiff.PatchCache(directory,
+                                      1024 * 1024,
+                                      algorithm='match-blocks')
+            results = []
+            errors = []
+
+            def open_patch(cancelled=None):
+                try:
+                    with cache.open(from_filename,
+                                    to_filename,
+                                    'lzma',
+                                    cancelled=cancelled) as fpatch:
+                        results.append(fpatch.read())
+                except phdiff.Error as e:
+                    errors.append(str(e))
+
+            # The creator is cancelled while a request is waiting, which
+            # then creates the patch itself.
+            creator_cancelled = threading.Event()
+
+            def cancel_once_waiting(*args, **kwargs):
+                while cache.hits < 1:
+                    time.sleep(0.001)
+
+                creator_cancelled.set()
+                create_patch(*args, **kwargs)
+
+            with mock.patch('phdiff.cache.create_patch',
+                            side_effect=cancel_once_waiting) as create:
+                creator = threading.Thread(target=open_patch,
+                                           args=(creator_cancelled, ))
+                creator.start()
+
+                while create.call_count < 1:
+                    time.sleep(0.001)
+
+                create.side_effect = create_patch
+                waiter = threading.Thread(target=open_patch)
+                waiter.start()
+                creator.join()
+                waiter.join()
+
+            self.assertEqual(create.call_count, 2)
+            self.assertEqual(errors, ['Cancelled.'])
+            self.assertEqual(len(results), 1)
+            self.assertEqual(cache.misses, 2)
+            self.assertEqual(len(cache), 1)
+            cache.clear()
+
+            # A cancelled waiter stops waiting while the patch is
+            # created.
+            results = []
+            errors = []
+            waiter_cancelled = threading.Event()
+            created = threading.Event()
+
+            def create_once_waiter_cancelled(*args, **kwargs):
+                created.wait()
+                create_patch(*args, **kwargs)
+
+            with mock.patch('phdiff.cache.create_patch',
+                            side_effect=create_once_waiter_cancelled):
+                creator = threading.Thread(target=open_patch)
+                creator.start()
+
+                while cache.misses < 3:
+                    time.sleep(0.001)
+
+                waiter = threading.Thread(target=open_patch,
+                                          args=(waiter_cancelled, ))
+                waiter.start()
+
+                while cache.hits < 2:
+                    time.sleep(0.001)
+
+                waiter_cancelled.set()
+                waiter.join()
+                self.assertEqual(errors, ['Cancelled.'])
+                self.assertEqual(results, [])
+                created.set()
+                creator.join()
+
+            self.assertEqual(len(results), 1)
+            self.assertEqual(len(cache), 1)
+
+    def test_create_and_apply_patch_trimmed(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        from_filename = dir_path + '/files/trimmed-from.bin'
+        to_filename = dir_path + '/files/trimmed-to.bin'
+        patch_filename = dir_path + '/files/trimmed.patch'
+        patched_filename = dir_path + '/files/trimmed.patched'
+        rng = random.Random(0)
+        from_data = rng.randbytes(65536)
+        to_data = from_data[:30000] + rng.randbytes(100) + from_data[30050:]
+
+        with open(from_filename, 'wb') as fout:
+            fout.write(from_data)
+
+        with open(to_filename, 'wb') as fout:
+            fout.write(to_data)
+
+        for algorithm, compression in [('suffix-array', 'lzma'),
+                                       ('match-blocks', 'lzma'),
+                                       ('match-blocks', 'auto')]:
+            phdiff.create_patch(from_filename,
+                                to_filename,
+                                patch_filename,
+                                compression,
+                                algorithm=algorithm,
+                                trim=True)
+            patch_type, info = phdiff.patch_info_filename(patch_filename)
+            self.assertEqual(patch_type, 'trimmed')
+            self.assertEqual(info[3:], (len(to_data), 30000, 35486))
+
+            for kwargs in [{}, {'streaming': True}, {'use_mmap': True}]:
+                phdiff.apply_patch(from_filename,
+                                   patch_filename,
+                                   patched_filename,
+                                   **kwargs)
+                self.assertEqual(self.md5(patched_filename),
+                                 self.md5(to_filename))
+
+            self.assertEqual(phdiff.apply_patch_range(from_filename,
+                                                      patch_filename,
+                                                      29990,
+                                                      200),
+                             to_data[29990:30190])
+
+        # Not trimmed by default.
+        phdiff.create_patch(from_filename,
+                            to_filename,
+                            patch_filename,
+                            'lzma')
+        self.assertEqual(phdiff.patch_info_filename(patch_filename)[0],
+                         'hdiffpatch')
+
+        # Too short from data.
+        phdiff.create_patch(from_filename,
+                            to_filename,
+                            patch_filename,
+                            'none',
+                            trim=True)
+
+        with open(from_filename, 'wb') as fout:
+            fout.write(from_data[:1000])
+
+        with self.assertRaises(phdiff.Error) as cm:
+            phdiff.apply_patch(from_filename, patch_filename, patched_filename)
+
+        self.assertEqual(str(cm.exception),
+                         'Expected from size at least 65486, but got 1000.')
+
+        # A prefix and suffix longer than the to data.
+        with open(from_filename, 'wb') as fout:
+            fout.write(from_data)
+
+        with open(patch_filename, 'rb') as fin:
+            fin.read(2)
+            self.assertEqual(unpack_size(fin), len(to_data))
+            patch = fin.read()
+
+        with open(patch_filename, 'wb') as fout:
+            fout.write(pack_header(8, 0))
+            fout.write(pack_size(1000))
+            fout.write(patch)
+
+        with self.assertRaises(phdiff.Error) as cm:
+            phdiff.apply_patch(from_filename, patch_filename, patched_filename)
+
+        self.assertEqual(
+            str(cm.exception),
+            'Corrupt patch: expected to size at least 65486, but got 1000.')
+
+    def test_patch_header_extended_type(self):
+        # Trimmed and sparse patches use the escape patch type 7,
+        # followed by the actual patch type.
+        self.assertEqual(pack_header(2, 1), b'\x21')
+        self.assertEqual(pack_header(8, 1), b'\x71\x08')
+        self.assertEqual(pack_header(9, 0), b'\x70\x09')
+        self.assertEqual(pack_header(200, 0), b'\x70\x88\x03')
+        self.assertEqual(read_patch_type(io.BytesIO(b'\x71\x08')), 8)
+        self.assertEqual(read_patch_type(io.BytesIO(b'\x70\x09')), 9)
+
+        for header, patch_type in [(b'\x60', 6), (b'\x70\x0a', 10)]:
+            with self.assertRaises(phdiff.Error) as cm:
+                read_patch_type(io.BytesIO(header))
+
+            self.assertEqual(str(cm.exception),
+                             'Bad patch type {}.'.format(patch_type))
+
+        with self.assertRaises(phdiff.Error) as cm:
+            read_patch_type(io.BytesIO(b'\x70'))
+
+        self.assertEqual(str(cm.exception), 'Failed to read first size byte.')
+
+    def test_common_sizes(self):
+        datas = [
+            (b'', b'', (0, 0)),
+            (b'abc', b'', (0, 0)),
+            (b'abcXdef', b'abcYYdef', (3, 3)),
+            (b'aaaa', b'aaaaaa', (4, 0)),
+            (b'xaaaa', b'aaaa', (0, 4)),
+            (10000 * b'x' + b'1' + 9000 * b'y',
+             10000 * b'x' + b'2' + 9000 * b'y',
+             (10000, 9000))
+        ]
+
+        for from_data, to_data, sizes in datas:
+            self.assertEqual(phdiffpatch.common_sizes(from_data, to_data),
+                             sizes)
+
+    def test_create_and_apply_patch_sparse(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        from_filename = dir_path + '/files/sparse-from.bin'
+        to_filename = dir_path + '/files/sparse-to.bin'
+        patch_filename = dir_path + '/files/sparse.patch'
+        patched_filename = dir_path + '/files/sparse.patched'
+        rng = random.Random(0)
+        size = 4 * 1024 * 1024
+        data = rng.randbytes(100000)
+
+        with open(from_filename, 'wb') as fout:
+            fout.truncate(size)
+            fout.seek(8192)
+            fout.write(data)
+            fout.seek(1024 * 1024)
+            # Allocated zeros.
+            fout.write(bytes(200000))
+            fout.seek(3 * 1024 * 1024)
+            fout.write(data)
+
+        with open(to_filename, 'wb') as fout:
+            fout.truncate(size)
+            fout.seek(8192)
+            fout.write(data[:5000] + b'12345' + data[5005:])
+            fout.seek(2 * 1024 * 1024)
+            fout.write(data)
+
+        phdiff.create_patch(from_filename,
+                            to_filename,
+                            patch_filename,
+                            'lzma',
+                            sparse=True)
+        patch_type, info = phdiff.patch_info_filename(patch_filename)
+        self.assertEqual(patch_type, 'sparse')
+        self.assertEqual(info[3:],
+                         (size,
+                          [(8192, 102400), (3 * 1024 * 1024, 102400)],
+                          [(8192, 102400), (2 * 1024 * 1024, 102400)]))
+
+        for kwargs in [{}, {'streaming': True}]:
+            phdiff.apply_patch(from_filename,
+                               patch_filename,
+                               patched_filename,
+                               **kwargs)
+            self.assertEqual(self.md5(patched_filename),
+                             self.md5(to_filename))
+
+        # The zeros are holes if the file system supports them.
+        if os.stat(from_filename).st_blocks * 512 < size:
+            self.assertLess(os.stat(patched_filename).st_blocks * 512, size)
+
+        self.assertEqual(phdiff.apply_patch_range(from_filename,
+                                                  patch_filename,
+                                                  size - 10,
+                                                  10),
+                         bytes(10))
+
+        with self.assertRaises(phdiff.Error) as cm:
+            phdiff.create_patch(from_filename,
+                                to_filename,
+                                patch_filename,
+                                'lzma',
+                                sparse=True,
+                                segment_size=4096)
+
+        self.assertEqual(
+            str(cm.exception),
+            'Sparse patches cannot be zstd, segmented or in-place patches, '
+            'or use a from index.')
+
+    def test_aio(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        from_filename = dir_path + '/files/from.bin'
+        to_filename = dir_path + '/files/to.bin'
+        patch_filename = dir_path + '/files/aio.patch'
+
+        class Writer(object):
+
+            def __init__(self):
+                self.data = bytearray()
+
+            def write(self, data):
+                self.data += data
+
+            async def drain(self):
+                pass
+
+        async def main():
+            writer = Writer()
+            patch_size = await phdiff.aio.create_patch(from_filename,
+                                                       to_filename,
+                                                       writer,
+                                                       'lzma')
+            self.assertEqual(patch_size, len(writer.data))
+            reader = asyncio.StreamReader()
+            reader.feed_data(bytes(writer.data))
+            reader.feed_eof()
+            to_size = await phdiff.aio.apply_patch(
+                from_filename,
+                reader,
+                dir_path + '/files/aio-reader.patched')
+            self.assertEqual(to_size, self.getSize(to_filename))
+
+            with phdiff.aio.PatchJobs(2) as jobs:
+                await phdiff.aio.create_patch(from_filename,
+                                              to_filename,
+                                              patch_filename,
+                                              'zstd',
+                                              jobs=jobs)
+                await asyncio.gather(*[
+                    phdiff.aio.apply_patch(
+                        from_filename,
+                        patch_filename,
+                        dir_path + '/files/aio-{}.patched'.format(i),
+                        jobs=jobs)
+                    for i in range(4)
+                ])
+
+            # Cancelled while reading the patch.
+            reader = asyncio.StreamReader()
+            reader.feed_data(b'\x01')
+            task = asyncio.ensure_future(phdiff.aio.apply_patch(
+                from_filename,
+                reader,
+                dir_path + '/files/aio-cancelled.patched'))
+            await asyncio.sleep(0.01)
+            task.cancel()
+
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(main())
+
+        for name in ['reader', '0', '1', '2', '3']:
+            self.assertEqual(
+                self.md5(dir_path + '/files/aio-{}.patched'.format(name)),
+                self.md5(to_filename))
+
+        self.assertFalse(
+            os.path.exists(dir_path + '/files/aio-cancelled.patched'))
+
+        # Cancelled while applying.
+        cancelled = threading.Event()
+        cancelled.set()
+
+        with phdiff.PatchApplier() as applier:
+            with self.assertRaises(phdiff.Error) as cm:
+                phdiff.apply_patch(from_filename,
+                                   patch_filename,
+                                   dir_path + '/files/aio-applier.patched',
+                                   streaming=True,
+                                   applier=CancellableApplier(applier,
+                                                              cancelled))
+
+        self.assertEqual(str(cm.exception), 'Cancelled.')
+
+        # Cancelled while creating, in the match blocks write callback.
+        class CancelledAfter(object):
+
+            def __init__(self, count):
+                self.count = count
+
+            def is_set(self):
+                self.count -= 1
+
+                return self.count < 0
+
+        for count in [0, 4]:
+            with self.assertRaises(phdiff.Error) as cm:
+                phdiff.create_patch(from_filename,
+                                    to_filename,
+                                    dir_path + '/files/aio-cancelled.patch',
+                                    'lzma',
+                                    cancelled=CancelledAfter(count))
+
+            self.assertEqual(str(cm.exception), 'Cancelled.')
+
+        jobs = phdiff.aio.default_jobs()
+        phdiff.aio.close_default_jobs()
+        self.assertIsNot(phdiff.aio.default_jobs(), jobs)
+        phdiff.aio.close_default_jobs()
 
 
 logging.basicConfig(level=logging.DEBUG)